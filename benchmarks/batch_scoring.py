@@ -0,0 +1,82 @@
+"""
+Compares the final evaluation of the quiz scores on a synthetic data set: the full recomputation
+(`quiz.recompute_user_scores`), rebuilding the incremental scoring engine and the NumPy batch scoring
+of ndw_chat.batch_scoring. All three have to produce the same scores.
+
+    python benchmarks/batch_scoring.py --answers 100000 --users 20000 --slots 10 --tracks 3
+"""
+
+import argparse
+import os
+import random
+import tempfile
+import time
+from typing import Callable
+
+os.environ.setdefault("NDW_HOME", tempfile.mkdtemp())
+
+from ndw_chat import quiz, util, batch_scoring
+from ndw_chat.db import db
+
+
+def create_data(answers: int, users: int, slots: int, tracks: int):
+    """ one estimation or choice question per slot and track, random answers of random users """
+    rand = random.Random(1)
+    util._config = util.Config(tracks=[util.TrackConfig(f"room{i + 1}", "") for i in range(tracks)], has_quiz=True)
+    questions = []
+    for slot in range(1, slots + 1):
+        for track in util.config().tracks:
+            if rand.random() < 0.6:
+                questions.append(quiz.QuizQuestion(track.name, slot, "estimate", "units", rand.choice([10, 2.5, 1000]),
+                                                   None, None, len(questions)))
+            else:
+                questions.append(quiz.QuizQuestion(track.name, slot, "choose", None, None, ["A", "B", "C"], "A",
+                                                   len(questions)))
+    quiz._quiz = quiz.Quiz(questions)
+    db("quiz_users").insert_multiple([quiz.QuizUser(user, f"user{user}", f"user{user}@example.com", 0).to_dict()
+                                      for user in range(1, users + 1)])
+    docs = []
+    for i in range(answers):
+        question = rand.choice(questions)
+        if question.estimation:
+            answer = str(rand.choice([rand.randint(0, 20), round(rand.uniform(0, 2000), 1)]))
+        else:
+            answer = rand.choice(question.choice)
+        docs.append(quiz.QuizAnswer(answer, question.id, rand.randint(1, users), 1.6e9 + i).to_dict())
+    db("quiz_answers").insert_multiple(docs)
+
+
+def measure(func: Callable[[], object]):
+    start = time.perf_counter()
+    result = func()
+    return result, time.perf_counter() - start
+
+
+def rebuild_engine() -> quiz.QuizUserScores:
+    quiz._engine = None
+    return quiz.user_scores()
+
+
+def cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--answers", type=int, default=100000)
+    parser.add_argument("--users", type=int, default=20000)
+    parser.add_argument("--slots", type=int, default=10)
+    parser.add_argument("--tracks", type=int, default=3)
+    args = parser.parse_args()
+
+    create_data(args.answers, args.users, args.slots, args.tracks)
+    print(f"{args.answers} answers of {args.users} users, {args.slots} slots with {args.tracks} tracks, "
+          f"NumPy: {'yes' if batch_scoring.numpy else 'no (full recomputation)'}")
+    expected, reference_time = measure(quiz.recompute_user_scores)
+    expected = expected.to_dict()
+    print(f"{'method':<22} {'seconds':>9} {'speedup':>9}")
+    for name, func in [("full recomputation", quiz.recompute_user_scores), ("scoring engine", rebuild_engine),
+                       ("batch scoring", batch_scoring.batch_user_scores)]:
+        result, duration = measure(func)
+        assert result.to_dict() == expected, f"{name}: different scores"
+        print(f"{name:<22} {duration:9.3f} {reference_time / duration:8.1f}x")
+
+
+if __name__ == '__main__':
+    cli()
@@ -0,0 +1,93 @@
+"""
+Cold start of the server against a large existing db.json: starts `python -m ndw_chat.main` with a
+temporary NDW_HOME and measures the time till the port accepts connections, till the first request
+(/tracks, which waits till the data is loaded) is answered and the startup phases that /ready reports.
+The first start migrates db.json to the journal snapshot, the following ones load the snapshot.
+
+    python benchmarks/cold_start.py --messages 200000 --runs 3
+"""
+
+import argparse
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from pathlib import Path
+
+import yaml
+
+TRACKS = ["room1", "room2", "room3"]
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def write_home(home: Path, port: int, messages: int):
+    with (home / "config.yaml").open("w") as f:
+        yaml.dump({"tracks": [{"name": track, "youtube_hash": ""} for track in TRACKS], "port": port,
+                   "password": "bench", "delete_after_days": 10000}, f)
+    rand = random.Random(1)
+    now = time.time()
+    docs = {str(i + 1): {"id": i, "track": rand.choice(TRACKS), "state": rand.choice(["raw", "visible", "archived"]),
+                         "time": now - messages + i, "content": f"Question number {i} from the audience?",
+                         "version": i + 1, "external_id": None} for i in range(messages)}
+    with (home / "db.json").open("w") as f:
+        json.dump({"messages": docs, "host_messages": {}}, f)
+
+
+def wait_for_port(port: int, start: float, timeout: float = 120) -> float:
+    while time.perf_counter() - start < timeout:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=1):
+                return time.perf_counter() - start
+        except OSError:
+            time.sleep(0.002)
+    raise TimeoutError("the server did not bind the port")
+
+
+def cold_start(home: Path, port: int) -> dict:
+    start = time.perf_counter()
+    server = subprocess.Popen([sys.executable, "-m", "ndw_chat.main"], env={**os.environ, "NDW_HOME": str(home)},
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        listening = wait_for_port(port, start)
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}/tracks", timeout=120) as response:
+            response.read()
+        first_request = time.perf_counter() - start
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}/ready", timeout=10) as response:
+            durations = json.loads(response.read())["durations"]
+    finally:
+        server.terminate()
+        server.wait()
+    return {"listening": listening, "first_request": first_request, "server": durations}
+
+
+def cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=200000, help="messages in the initial db.json")
+    parser.add_argument("--runs", type=int, default=3, help="starts, the first one migrates db.json")
+    args = parser.parse_args()
+
+    home = Path(tempfile.mkdtemp(prefix="ndw_cold_start_"))
+    port = free_port()
+    write_home(home, port, args.messages)
+    print(f"db.json with {args.messages} messages: {(home / 'db.json').stat().st_size / 1e6:.1f} MB")
+    print(f"{'run':<10} {'port bound':>11} {'first request':>14} {'server: listening':>18} {'ready':>8}")
+    for run in range(args.runs):
+        result = cold_start(home, port)
+        server = result["server"]
+        print(f"{'migrate' if run == 0 else 'restart':<10} {result['listening']:10.3f}s {result['first_request']:13.3f}s "
+              f"{server['listening']:17.3f}s {server['ready']:7.3f}s")
+    print("the server times are measured from the import of the server modules")
+
+
+if __name__ == '__main__':
+    cli()
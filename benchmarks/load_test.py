@@ -0,0 +1,252 @@
+"""
+Load test for the chat server.
+
+Starts the server in-process with a temporary NDW_HOME (or uses a running server via --url) and
+simulates viewers that send messages, websocket clients (moderators and hosts), moderators that
+change message states and a quiz audience that registers and answers in a burst.
+
+Reports throughput, p50/p99 latencies (from the POST to the delivery on the websockets) and the
+event loop lag of the server and writes them to a JSON file:
+
+    python benchmarks/load_test.py --viewers 50 --messages 20 --clients 20 --output results.json
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import aiohttp
+import yaml
+
+TRACKS = ["room1", "room2", "room3"]
+
+
+def percentiles(values: List[float]) -> Dict[str, Optional[float]]:
+    """ p50, p99 and max in milliseconds """
+    if not values:
+        return {"p50": None, "p99": None, "max": None, "count": 0}
+    values = sorted(values)
+
+    def p(q: float) -> float:
+        return values[min(len(values) - 1, int(q * len(values)))] * 1000
+
+    return {"p50": p(0.5), "p99": p(0.99), "max": values[-1] * 1000, "count": len(values)}
+
+
+def write_home(home: Path, port: int):
+    with (home / "config.yaml").open("w") as f:
+        yaml.dump({"tracks": [{"name": track, "youtube_hash": ""} for track in TRACKS], "has_quiz": True,
+                   "port": port, "password": "bench", "check_email_deliverability": False, "length_limit": 200,
+                   # all simulated viewers share one address
+                   "client_rate_limit": 0, "ingest_rate_limit": 0}, f)
+    with (home / "quiz.yaml").open("w") as f:
+        yaml.dump({"questions": [{"track": track, "slot": 1, "text": "How many?", "estimation": "pieces",
+                                  "estimation_solution": 100, "choice": None, "choice_solution": None}
+                                 for track in TRACKS]}, f)
+
+
+async def start_in_process_server(port: int):
+    home = Path(tempfile.mkdtemp(prefix="ndw_bench_"))
+    write_home(home, port)
+    os.environ["NDW_HOME"] = str(home)
+    from ndw_chat.main import start_server
+    return await start_server()
+
+
+class Client:
+    """ websocket client that records when it receives messages and state changes """
+
+    def __init__(self, session: aiohttp.ClientSession, url: str, password: str, track: Optional[str]):
+        self.session = session
+        self.url = url
+        self.password = password
+        self.track = track
+        self.received: Dict[str, float] = {}
+        """ message content → receive time """
+        self.states: Dict[int, float] = {}
+        """ message id → receive time of the set_state """
+        self.score_frames = 0
+        self.bytes = 0
+
+    async def run(self, connected: asyncio.Event):
+        ws = await self.session.ws_connect(self.url.replace("http", "ws") + "/ws")
+        initial = {"password": self.password}
+        if self.track:
+            initial["tracks"] = [self.track]
+        await ws.send_str(json.dumps(initial))
+        connected.set()
+        async for msg in ws:
+            now = time.perf_counter()
+            self.bytes += len(msg.data)
+            frame = json.loads(msg.data)
+            command = frame["command"]
+            args = frame["arguments"]
+            if command == "push_message":
+                self.received[args["content"]] = now
+            elif command == "push_messages":
+                for message in args["messages"]:
+                    self.received[message["content"]] = now
+            elif command == "set_state":
+                self.states[args["id"]] = now
+            elif command in ["scores", "scores_delta"]:
+                self.score_frames += 1
+
+
+async def get(session: aiohttp.ClientSession, url: str, path: str, **params) -> dict:
+    async with session.get(f"{url}/{path}", params=params) as response:
+        return await response.json()
+
+
+async def bench_messages(session, url: str, clients: List[Client], viewers: int, messages: int) -> dict:
+    sent: Dict[str, float] = {}
+    post_latencies = []
+
+    async def viewer(v: int):
+        for m in range(messages):
+            content = f"bench {v} {m}"
+            start = time.perf_counter()
+            sent[content] = start
+            async with session.post(f"{url}/send", json={"track": TRACKS[v % len(TRACKS)], "content": content}) as r:
+                await r.read()
+            post_latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(viewer(v) for v in range(viewers)))
+    duration = time.perf_counter() - start
+    expected = {content: [c for c in clients if c.track is None or content_track(content) == c.track]
+                for content in sent}
+    await wait_for(lambda: all(content in c.received for content, cs in expected.items() for c in cs))
+    delivery = [c.received[content] - sent[content] for content, cs in expected.items() for c in cs
+                if content in c.received]
+    return {"messages": len(sent), "duration_s": duration, "throughput_per_s": len(sent) / duration,
+            "post_latency_ms": percentiles(post_latencies), "delivery_latency_ms": percentiles(delivery),
+            "deliveries": len(delivery), "missing_deliveries": sum(len(cs) for cs in expected.values()) - len(delivery)}
+
+
+def content_track(content: str) -> str:
+    return TRACKS[int(content.split()[1]) % len(TRACKS)]
+
+
+async def wait_for(condition, timeout: float = 30):
+    start = time.perf_counter()
+    while not condition() and time.perf_counter() - start < timeout:
+        await asyncio.sleep(0.01)
+
+
+async def bench_moderation(session, url: str, password: str, clients: List[Client], changes: int) -> dict:
+    messages = (await get(session, url, "messages", password=password))[-changes:]
+    moderator = await session.ws_connect(url.replace("http", "ws") + "/ws")
+    await moderator.send_str(json.dumps({"password": password}))
+    sent = {}
+    start = time.perf_counter()
+    for message in messages:
+        sent[message["id"]] = time.perf_counter()
+        await moderator.send_str(json.dumps({"command": "set_state",
+                                             "arguments": {"id": message["id"], "state": "visible"}}))
+    tracks = {message["id"]: message["track"] for message in messages}
+    expected = {id: [c for c in clients if c.track is None or c.track == tracks[id]] for id in sent}
+    await wait_for(lambda: all(id in c.states for id, cs in expected.items() for c in cs))
+    duration = time.perf_counter() - start
+    await moderator.close()
+    latencies = [c.states[id] - sent[id] for id, cs in expected.items() for c in cs if id in c.states]
+    return {"changes": len(sent), "duration_s": duration, "throughput_per_s": len(sent) / duration,
+            "delivery_latency_ms": percentiles(latencies)}
+
+
+async def bench_quiz(session, url: str, password: str, clients: List[Client], users: int) -> dict:
+    moderator = await session.ws_connect(url.replace("http", "ws") + "/ws")
+    await moderator.send_str(json.dumps({"password": password}))
+    current = await get(session, url, "current_question", track=TRACKS[0])
+    question = current["current"] or current["next"]
+    for command, arguments in [("set_current_question", {"track": TRACKS[0], "question_id": question["id"]}),
+                               ("enable_current_question", {"track": TRACKS[0], "enabled": True})]:
+        await moderator.send_str(json.dumps({"command": command, "arguments": arguments}))
+    await asyncio.sleep(0.2)
+    await moderator.close()
+
+    async def timed(path: str, **params):
+        start = time.perf_counter()
+        result = await get(session, url, path, **params)
+        return time.perf_counter() - start, result
+
+    run_id = int(time.time())
+    registrations = await asyncio.gather(*(timed("register_quiz_user", pseudonym=f"user{run_id}-{u}",
+                                                 email=f"user{run_id}-{u}@example.com") for u in range(users)))
+    user_ids = [result["user_id"] for _, result in registrations if result["success"]]
+    score_frames_before = sum(c.score_frames for c in clients)
+    start = time.perf_counter()
+    answers = await asyncio.gather(*(timed("submit_quiz_answer", user_id=user_id, question_id=question["id"],
+                                           answer=str(i % 200)) for i, user_id in enumerate(user_ids)))
+    duration = time.perf_counter() - start
+    await asyncio.sleep(1)
+    return {"registrations": len(user_ids), "registration_latency_ms": percentiles([t for t, _ in registrations]),
+            "answers": sum(1 for _, result in answers if result["success"]), "duration_s": duration,
+            "answers_per_s": len(answers) / duration if duration else None,
+            "answer_latency_ms": percentiles([t for t, _ in answers]),
+            "score_frames_per_client": (sum(c.score_frames for c in clients) - score_frames_before) / len(clients)}
+
+
+def git_version() -> Optional[str]:
+    try:
+        return subprocess.check_output(["git", "describe", "--always", "--dirty"], cwd=Path(__file__).parent,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def run(args) -> dict:
+    runner = None
+    url = args.url
+    if not url:
+        runner = await start_in_process_server(args.port)
+        url = f"http://127.0.0.1:{args.port}"
+    results = {"version": git_version(), "python": platform.python_version(), "in_process": runner is not None,
+               "parameters": {k: v for k, v in vars(args).items() if k not in ["output", "password"]}}
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=args.viewers + 10)) as session:
+        clients = [Client(session, url, args.password, None if i % 2 == 0 else TRACKS[i % len(TRACKS)])
+                   for i in range(args.clients)]
+        connected = [asyncio.Event() for _ in clients]
+        tasks = [asyncio.ensure_future(c.run(e)) for c, e in zip(clients, connected)]
+        await asyncio.gather(*(e.wait() for e in connected))
+        await asyncio.sleep(0.5)
+        results["messages"] = await bench_messages(session, url, clients, args.viewers, args.messages)
+        results["moderation"] = await bench_moderation(session, url, args.password, clients, args.state_changes)
+        results["quiz"] = await bench_quiz(session, url, args.password, clients, args.quiz_users)
+        stats = await get(session, url, "stats", password=args.password)
+        results["loop_lag_ms"] = {k: v * 1000 for k, v in stats["loop_lag"].items()}
+        results["server_stats"] = stats
+        results["received_bytes_per_client"] = sum(c.bytes for c in clients) / len(clients)
+        for task in tasks:
+            task.cancel()
+    if runner:
+        await runner.cleanup()
+    return results
+
+
+def cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", help="url of a running server, starts a server in-process if omitted")
+    parser.add_argument("--port", type=int, default=18080, help="port of the in-process server")
+    parser.add_argument("--password", default="bench")
+    parser.add_argument("--viewers", type=int, default=50, help="number of concurrent viewers")
+    parser.add_argument("--messages", type=int, default=20, help="messages per viewer")
+    parser.add_argument("--clients", type=int, default=20, help="number of websocket clients")
+    parser.add_argument("--state-changes", type=int, default=200, help="number of set_state commands")
+    parser.add_argument("--quiz-users", type=int, default=200, help="users that answer in one burst")
+    parser.add_argument("--output", default="bench_results.json")
+    args = parser.parse_args()
+    results = asyncio.run(run(args))
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(json.dumps({k: v for k, v in results.items() if k != "server_stats"}, indent=2))
+
+
+if __name__ == '__main__':
+    cli()
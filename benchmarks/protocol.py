@@ -0,0 +1,102 @@
+"""
+Bandwidth and encode time per websocket event for the negotiable protocols (JSON and, if installed,
+MessagePack), each without and with permessage-deflate (one compression context per connection,
+like aiohttp and the browsers use it).
+
+The events are a mix of push_message and set_state frames, score deltas and full score frames
+of a quiz audience, the totals are estimated for the websocket clients of a venue:
+
+    python benchmarks/protocol.py --events 2000 --users 500 --clients 30 --rate 20
+"""
+
+import argparse
+import os
+import random
+import tempfile
+import time
+import zlib
+from typing import List, Callable, Union
+
+os.environ.setdefault("NDW_HOME", tempfile.mkdtemp())
+
+from ndw_chat.broadcast import ENCODERS, Frame, scores_delta
+from ndw_chat.quiz import QuizUser, QuizUserScore, QuizUserScores, QuizQuestion
+
+
+def events(count: int, users: int) -> List[dict]:
+    """ push_message and set_state frames with a scores_delta every 10 and a full scores frame every 100 events """
+    random.seed(1)
+    questions = {i: QuizQuestion("room1", i, f"How many things are there in question {i}?", "pieces", 10, None,
+                                 None, i).to_dict() for i in range(10)}
+    user_list = [QuizUser(i, f"viewer{i}", f"viewer{i}@example.com", 1.6e9) for i in range(users)]
+    old = {**QuizUserScores([], {}, questions).to_dict(), "version": 0}
+    frames = []
+    for i in range(count):
+        seq = {"seq": i + 1}
+        if i % 100 == 99 or i % 10 == 9:
+            scores = QuizUserScores([QuizUserScore(user, random.random()) for user in user_list[:users * i // count]],
+                                    {q: users * i // count for q in range(10)}, questions)
+            new = {**scores.to_dict(), "version": old["version"] + 1}
+            if i % 100 == 99:
+                frames.append({"command": "scores", "arguments": new})
+            else:
+                frames.append({"command": "scores_delta", "arguments": scores_delta(old, new)})
+            old = new
+        elif i % 3 == 2:
+            frames.append({"command": "set_state", "arguments": {"id": i - 1, "state": "visible"}, **seq})
+        else:
+            frames.append({"command": "push_message", "arguments": {
+                "id": i, "track": f"room{i % 3 + 1}", "state": "raw", "time": 1.6e9 + i,
+                "content": f"Question {i} from the audience about the experiment on stage?", "version": i + 1,
+                "external_id": None}, **seq})
+    return frames
+
+
+def deflated_size(encoded: List[Union[str, bytes]]) -> int:
+    """ size of the messages with permessage-deflate with context takeover """
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -zlib.MAX_WBITS)
+    size = 0
+    for data in encoded:
+        data = data.encode() if isinstance(data, str) else data
+        size += len(compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)) - 4
+    return size
+
+
+def measure(func: Callable[[], object], repeat: int = 3) -> float:
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        duration = time.perf_counter() - start
+        best = duration if best is None else min(best, duration)
+    return best
+
+
+def cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--events", type=int, default=2000)
+    parser.add_argument("--users", type=int, default=500, help="quiz users in the score frames")
+    parser.add_argument("--clients", type=int, default=30, help="moderator and host websocket clients")
+    parser.add_argument("--rate", type=float, default=20, help="events per second for the bandwidth estimate")
+    args = parser.parse_args()
+
+    messages = events(args.events, args.users)
+    print(f"{len(messages)} events, {args.clients} clients at {args.rate:g} events/s")
+    print(f"{'protocol':<18} {'bytes/event':>12} {'encode µs/event':>16} {'deflate µs/event':>17} "
+          f"{'kbit/s (all clients)':>21}")
+    for protocol in ENCODERS:
+        encoded = [Frame(message).encode(protocol) for message in messages]
+        size = sum(len(data) for data in encoded) / len(encoded)
+        encode_time = measure(lambda: [Frame(message).encode(protocol) for message in messages]) / len(messages)
+        deflated = deflated_size(encoded) / len(encoded)
+        deflate_time = measure(lambda: deflated_size(encoded)) / len(encoded)
+        for name, bytes_per_event, compress_time in [(protocol, size, 0),
+                                                     (f"{protocol}+deflate", deflated, deflate_time)]:
+            kbits = bytes_per_event * 8 * args.rate * args.clients / 1000
+            print(f"{name:<18} {bytes_per_event:12.1f} {encode_time * 1e6:16.2f} {compress_time * 1e6:17.2f} "
+                  f"{kbits:21.1f}")
+    print("encoding happens once per event and protocol, deflating once per event and client")
+
+
+if __name__ == '__main__':
+    cli()
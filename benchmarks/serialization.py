@@ -0,0 +1,67 @@
+"""
+Microbenchmark of the serialization of the /messages response and of the score broadcasts:
+the reflection based dataclasses_json methods with the json module against the generated methods
+of ndw_chat.serialization with the fast JSON library (if installed).
+
+    python benchmarks/serialization.py --messages 10000 --users 5000
+"""
+
+import argparse
+import json
+import os
+import tempfile
+import timeit
+from typing import Callable
+
+from dataclasses_json.api import DataClassJsonMixin
+
+os.environ.setdefault("NDW_HOME", tempfile.mkdtemp())
+
+from ndw_chat import serialization
+from ndw_chat.db import Message
+from ndw_chat.quiz import QuizUser, QuizUserScore, QuizUserScores, QuizQuestion
+
+reference_to_dict = DataClassJsonMixin.to_dict
+reference_from_dict = DataClassJsonMixin.from_dict.__func__
+
+
+def measure(name: str, reference: Callable, fast: Callable, number: int):
+    expected, actual = reference(), fast()
+    if isinstance(expected, str):
+        expected, actual = json.loads(expected), json.loads(actual)
+    assert expected == actual, f"{name}: different results"
+    reference_time = min(timeit.repeat(reference, number=number, repeat=3)) / number
+    fast_time = min(timeit.repeat(fast, number=number, repeat=3)) / number
+    print(f"{name:<28} {reference_time * 1000:10.3f} ms {fast_time * 1000:10.3f} ms "
+          f"{reference_time / fast_time:8.1f}x")
+
+
+def cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=10000)
+    parser.add_argument("--users", type=int, default=5000)
+    parser.add_argument("--number", type=int, default=5)
+    args = parser.parse_args()
+
+    messages = [Message(i, f"room{i % 3}", "raw", 1.6e9 + i, f"question number {i}?", i + 1)
+                for i in range(args.messages)]
+    docs = [message.to_dict() for message in messages]
+    questions = {i: QuizQuestion("room1", i, "text", "unit", 10, None, None, i).to_dict() for i in range(10)}
+    scores = QuizUserScores([QuizUserScore(QuizUser(i, f"user{i}", f"user{i}@example.com", 1.6e9), 1 / (i + 1))
+                             for i in range(args.users)], {i: args.users for i in range(10)}, questions)
+
+    print(f"fast JSON library: {'orjson' if serialization.orjson else 'no (json module)'}")
+    print(f"{'':<28} {'reference':>13} {'fast':>13} {'speedup':>9}")
+    measure(f"/messages ({args.messages})",
+            lambda: json.dumps([reference_to_dict(message) for message in messages]),
+            lambda: serialization.dumps([message.to_dict() for message in messages]), args.number)
+    measure(f"load messages ({args.messages})",
+            lambda: [reference_from_dict(Message, doc) for doc in docs],
+            lambda: [Message.from_dict(doc) for doc in docs], args.number)
+    measure(f"scores ({args.users} users)",
+            lambda: json.dumps({"command": "scores", "arguments": reference_to_dict(scores)}),
+            lambda: serialization.dumps({"command": "scores", "arguments": scores.to_dict()}), args.number)
+
+
+if __name__ == '__main__':
+    cli()
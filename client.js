@@ -95,17 +95,36 @@ class QuizState {
     }
 
     fetch_current_question() {
-        this.fetch("unanswered_question", {}, res => {
-            if (JSON.stringify(this.current_question) !== JSON.stringify(res["question"])) {
-                this.current_question = res["question"]
-                this.fetch("user_registered", {"user_id": this.user_id}, res => {
-                    this.registered = res["registered"]
-                    this.renderCurrentQuestion()
-                    this.updateUI()
-                })
+        this.fetch("unanswered_question", {}, res => this.set_current_question(res["question"]))
+    }
+
+    set_current_question(question) {
+        if (JSON.stringify(this.current_question) !== JSON.stringify(question)) {
+            this.current_question = question
+            this.fetch("user_registered", {"user_id": this.user_id}, res => {
+                this.registered = res["registered"]
+                this.renderCurrentQuestion()
+                this.updateUI()
+            })
+        }
+    }
 
+    /** subscribes to the pushed question changes, returns false if the browser does not support them */
+    listen_for_questions() {
+        if (typeof EventSource === "undefined") {
+            return false
+        }
+        let source = new EventSource(`${NDW_CHAT_SERVER_URL}/quiz_events?${new URLSearchParams({"track": this.track})}`)
+        source.addEventListener("question", event => {
+            let question = JSON.parse(event.data)["question"]
+            if (question != null && this.user_id != null) {
+                // the pushed question is the same for all viewers, check whether this user answered it
+                this.fetch_current_question()
+            } else {
+                this.set_current_question(question)
             }
         })
+        return true
     }
 
     register(pseudonym, email) {
@@ -168,7 +187,10 @@ class QuizState {
               'Content-Type': 'application/json'
             }
         }).then(res => {
-             res.json().then(onsuccess)
+             // 429: rate limited, the user can retry
+             if (res.ok) {
+                 res.json().then(onsuccess)
+             }
         })
     }
 }
@@ -188,7 +210,10 @@ function init_submit_question(element, track) {
                 "track": track,
                 "content": element.querySelector("textarea").value
             })
-        }).then(() => {
+        }).then(res => {
+            if (res.status === 429 || res.status === 503) {
+                return  // rate limited or the server is starting, keep the question for a retry
+            }
             element.querySelector(" .ndw_chat_successful").style.display = "block";
             setTimeout(() => element.querySelector(" .ndw_chat_successful").style.display = "none", 3000);
             element.querySelector("textarea").value = ""
@@ -201,7 +226,6 @@ function init_quiz(element, track) {
         return;
     }
     let quiz = new QuizState(track, element.querySelector(".quiz"));
-    quiz.fetch_current_question();
     quizzes[track] = quiz
     element.querySelector(".submit_answer").addEventListener("click", () => {
         quiz.handle_submit_answer()
@@ -213,7 +237,10 @@ function init_quiz(element, track) {
         quiz.show("register");
         quiz.disable("open_register_button");
     })
-    setInterval(() => quiz.fetch_current_question(), 10_000)
+    if (!quiz.listen_for_questions()) {
+        quiz.fetch_current_question();
+        setInterval(() => quiz.fetch_current_question(), 10_000)
+    }
 }
 
 document.querySelectorAll(".ndw_chat").forEach(element => {
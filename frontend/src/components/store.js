@@ -2,6 +2,11 @@ import {writable,} from 'svelte/store';
 import {check_password} from "./util";
 import {push} from "svelte-spa-router";
 import { setWsHeartbeat } from "ws-heartbeat/client";
+import {decode} from "@msgpack/msgpack";
+import * as appConfig from "../config";
+
+// "json" or "msgpack" (binary frames), the server falls back to json if it does not support it
+const WEBSOCKET_PROTOCOL = appConfig.WEBSOCKET_PROTOCOL ?? "json";
 
 export let hostMessageStore = writable("");
 export let messageStore = writable([]);
@@ -32,29 +37,42 @@ export class WebSocketHandler {
         this.currentQuestionId = -1;
         this.currentQuestionEnabled = false;
         this.quizAnswerCounts = {};
+        this.quizScores = [];
+        this.quizUsers = {};
+        this.quizQuestions = {};
+        this.scoresVersion = -1;
         this.messageIds = new Set();
+        this.epoch = null;
+        this.lastSeq = 0;
     }
 
     #socket_init() {
         this.socket = new WebSocket(this.server.replace("http", "ws") + "/ws");
+        this.socket.binaryType = "arraybuffer";
         setWsHeartbeat(this.socket, '{"kind":"ping"}');
         this.socket.addEventListener("message", event => {
-            let json = JSON.parse(event.data);
+            let json = typeof event.data === "string" ? JSON.parse(event.data) : decode(event.data);
             let command = json.command;
             let args = json.arguments;
             console.info(json);
+            if (json.seq !== undefined) {
+                this.lastSeq = json.seq;
+            }
             switch (command) {
-                case "push_message":
-                    if (args.track === this.track) {
-                        if (!this.messageIds.has(args.id)) {
-                            this.messageIds.add(args.id);
-                            messageStore.update(msgs => [...msgs, args]);
-                            if (this.message_shown(args.track, args.state)) {
-                                this.#notify(args);
-                            }
-                        }
+                case "hello":
+                    // the server replays the missed events if it still has them, otherwise fetch everything
+                    if (!args.resumed) {
+                        this.epoch = args.epoch;
+                        this.lastSeq = args.seq;
+                        this.#load_track_state();
                     }
                     break;
+                case "push_message":
+                    this.#push_message(args);
+                    break;
+                case "push_messages":
+                    args.messages.forEach(msg => this.#push_message(msg));
+                    break;
                 case "set_content":
                     this.#update_msg(args.id, msg => {
                         msg.content = args.content;
@@ -80,15 +98,31 @@ export class WebSocketHandler {
                     }
                     break;
                 case "scores":
-                    let {scores: scores, count: count, questions: questions} = args;
-                    q_scores.set(scores);
-                    const questionIds = Object.keys(count)
-                    q_answer_count.set(questionIds.sort().map(i => {
-                        return {"question": questions[i], "count": count[i]};
-                    }));
-                    this.quizAnswerCounts = count;
-                    q_questions.set(questions);
-                    this.#update_current_question_answers();
+                    this.scoresVersion = args.version;
+                    this.quizScores = args.scores;
+                    this.quizUsers = {};
+                    args.scores.filter(score => score.user != null).forEach(score => {
+                        this.quizUsers[score.user.id] = score.user;
+                    });
+                    this.quizAnswerCounts = args.count;
+                    this.quizQuestions = args.questions;
+                    q_questions.set(args.questions);
+                    this.#update_scores();
+                    break;
+                case "scores_delta":
+                    if (args.base_version !== this.scoresVersion) {
+                        this.#send("get_scores", {});
+                        break;
+                    }
+                    this.scoresVersion = args.version;
+                    Object.assign(this.quizUsers, args.users);
+                    let scores = this.quizScores.slice(0, args.length);
+                    for (const [rank, score] of Object.entries(args.ranks)) {
+                        scores[rank] = {user: this.quizUsers[score.user_id] ?? null, score: score.score};
+                    }
+                    this.quizScores = scores;
+                    this.quizAnswerCounts = {...this.quizAnswerCounts, ...args.count};
+                    this.#update_scores();
                     break;
                 case "has_quiz":
                     has_quiz.set(true);
@@ -114,14 +148,17 @@ export class WebSocketHandler {
                 if (!success) {
                     push("/");
                 }
-                this.socket.send(JSON.stringify({"password": this.password}))
-                if (this.track.length !== "") {
-                    this.#get_all_messages(
-                        messages => messageStore.set(messages.filter(msg => this.track === msg.track)))
-                    this.#get_host_message(message => {
-                        hostMessageStore.set(message)
-                    })
+                let initial = {"password": this.password};
+                if (this.track !== "") {
+                    initial["tracks"] = [this.track];
+                }
+                if (this.epoch !== null) {
+                    initial["resume"] = {"epoch": this.epoch, "seq": this.lastSeq};
                 }
+                if (WEBSOCKET_PROTOCOL !== "json") {
+                    initial["protocol"] = WEBSOCKET_PROTOCOL;
+                }
+                this.socket.send(JSON.stringify(initial))
             })
         })
 
@@ -130,6 +167,39 @@ export class WebSocketHandler {
         this.socket.addEventListener("close", () => setTimeout(() => this.#socket_init(), 20))
     }
 
+    #push_message(msg) {
+        if (msg.track === this.track) {
+            if (!this.messageIds.has(msg.id)) {
+                this.messageIds.add(msg.id);
+                messageStore.update(msgs => [...msgs, msg]);
+                if (this.message_shown(msg.track, msg.state)) {
+                    this.#notify(msg);
+                }
+            }
+        }
+    }
+
+    #load_track_state() {
+        if (this.track !== "") {
+            this.#get_all_messages(messages => {
+                messages.forEach(msg => this.messageIds.add(msg.id));
+                messageStore.set(messages);
+            })
+            this.#get_host_message(message => {
+                hostMessageStore.set(message)
+            })
+        }
+    }
+
+    #update_scores() {
+        q_scores.set(this.quizScores);
+        const questionIds = Object.keys(this.quizAnswerCounts)
+        q_answer_count.set(questionIds.sort().map(i => {
+            return {"question": this.quizQuestions[i], "count": this.quizAnswerCounts[i]};
+        }));
+        this.#update_current_question_answers();
+    }
+
     #update_current_question_answers() {
         if (this.currentQuestionId !== -1) {
             q_current_question_answers.set(this.quizAnswerCounts[this.currentQuestionId]);
@@ -193,7 +263,7 @@ export class WebSocketHandler {
     }
 
     #get_all_messages(callback) {
-        fetch(this.server + "/messages?" + new URLSearchParams({password: this.password}), {
+        fetch(this.server + "/messages?" + new URLSearchParams({password: this.password, track: this.track}), {
             method: "GET",
             headers: {
                 'Accept': 'application/json',
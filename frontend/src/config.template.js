@@ -1,2 +1,4 @@
 // copy to config.js
-export let SERVER_LOCATION = "http://localhost:8080"
\ No newline at end of file
+export let SERVER_LOCATION = "http://localhost:8080"
+// "json" or "msgpack" (smaller binary frames for the websocket)
+export let WEBSOCKET_PROTOCOL = "json"
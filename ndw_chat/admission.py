@@ -0,0 +1,158 @@
+"""
+Admission control for the ingest endpoints (/send, /send_batch, /register_quiz_user and /submit_quiz_answer).
+
+- token buckets per client address limit single clients, a batch takes a token per message and may
+  leave its bucket in debt, so a large batch delays the following requests instead of never being admitted
+- the answers are limited per quiz user and per client address, the latter with a larger burst
+  as many viewers can share an address
+- a global token bucket limits the requests of all clients together, answers of unknown quiz users
+  are not charged to it, so they cannot exhaust it for the registered users
+- requests are shed while the storage writer or the websocket queues are backlogged
+
+Rejected requests get a 429 response with a Retry-After header, see the `*_rate_*` and `shed_*`
+fields of Config for the limits.
+"""
+
+import functools
+import math
+import time
+from collections import OrderedDict
+from typing import Optional, Callable, Tuple, Dict, Awaitable
+
+from aiohttp import web
+from aiohttp.abc import Request
+
+from ndw_chat.executor import storage_pending
+from ndw_chat.metrics import counter
+from ndw_chat.util import config
+
+REJECTED = counter("ndw_rejected_requests_total", "ingest requests that were rejected with 429")
+
+OVERLOAD_RETRY_AFTER = 1
+MAX_KEYS = 100000
+""" number of clients with a token bucket, the least recently used ones are dropped """
+
+
+class TokenBucket:
+
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate: float, burst: float, now: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def take(self, now: float, count: int = 1) -> float:
+        """
+        takes count tokens if at least one is available, returns 0 or the seconds till the next token
+        is available if there is none
+        """
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= count
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+class RateLimiter:
+    """ token bucket per key, a rate of 0 disables the limit """
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.buckets: OrderedDict = OrderedDict()
+
+    def take(self, key, now: float, count: int = 1) -> float:
+        if self.rate <= 0:
+            return 0
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = TokenBucket(self.rate, self.burst, now)
+            if len(self.buckets) > MAX_KEYS:
+                self.buckets.popitem(last=False)
+        else:
+            self.buckets.move_to_end(key)
+        return bucket.take(now, count)
+
+
+class Admission:
+
+    def __init__(self, queued_frames: Callable[[], int]):
+        self.queued_frames = queued_frames
+        """ number of frames queued for the websocket clients """
+        self._limiters: Dict[str, RateLimiter] = {}
+
+    def limiter(self, name: str) -> RateLimiter:
+        if name not in self._limiters:
+            rate, burst = {
+                "client": (config().client_rate_limit, config().client_rate_burst),
+                "quiz_user": (config().quiz_user_rate_limit, config().quiz_user_rate_burst),
+                "answer_client": (config().answer_client_rate_limit, config().answer_client_rate_burst),
+                "ingest": (config().ingest_rate_limit, config().ingest_rate_burst)}[name]
+            self._limiters[name] = RateLimiter(rate, burst)
+        return self._limiters[name]
+
+    def overloaded(self) -> bool:
+        return storage_pending() > config().shed_storage_pending or \
+            self.queued_frames() > config().shed_queued_frames
+
+    def check(self, limiter: str, key: str, tokens: int = 1, ingest: bool = True) -> Optional[Tuple[str, float]]:
+        """
+        checks the rate limit of the key ("client" or "answer_client" address or "quiz_user" id), the load
+        and (if ingest) the global budget, returns None if the request is admitted and otherwise the reason
+        and the seconds after which to retry
+        """
+        now = time.monotonic()
+        retry_after = self.limiter(limiter).take(key, now, tokens)
+        if retry_after:
+            return limiter, retry_after
+        if self.overloaded():
+            return "overload", OVERLOAD_RETRY_AFTER
+        if not ingest:
+            return None
+        retry_after = self.limiter("ingest").take(None, now, tokens)
+        if retry_after:
+            return "ingest", retry_after
+        return None
+
+
+def client_address(request: Request) -> str:
+    """ the first address of `client_address_header` (if configured and set) or the peer address """
+    if config().client_address_header:
+        forwarded = request.headers.get(config().client_address_header)
+        if forwarded:
+            return forwarded.split(",")[0].strip()
+    return request.remote or ""
+
+
+def admitted(admission: Admission, endpoint: str,
+             tokens: Optional[Callable[[Request], Awaitable[int]]] = None,
+             quiz_user: Optional[Callable[[str], bool]] = None):
+    """
+    decorator for request handlers that answers with 429 instead of calling the handler
+    if the request is not admitted, tokens returns the number of tokens that the request takes (default 1),
+    quiz_user (whether the "user_id" parameter is a registered user) limits the requests per client address
+    and per user id and only charges the global budget for registered users
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(request: Request):
+            count = await tokens(request) if tokens else 1
+            if quiz_user:
+                user_id = request.query.get("user_id", "")
+                rejected = admission.check("answer_client", client_address(request), count, ingest=False) or \
+                    admission.check("quiz_user", user_id, count, ingest=quiz_user(user_id))
+            else:
+                rejected = admission.check("client", client_address(request), count)
+            if rejected:
+                reason, retry_after = rejected
+                REJECTED.inc(endpoint=endpoint, reason=reason)
+                return web.Response(status=429, headers={"Retry-After": str(math.ceil(retry_after))})
+            return await func(request)
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,139 @@
+"""
+Batch computation of the quiz scores for the final evaluation, with CSV export:
+
+    ndw_chat_scores --csv scores.csv
+
+The stored answers are loaded into columns (user, question, parsed value) and scored with NumPy:
+the estimation ranks come from one stable sort by (question, distance to the solution) and the points
+are reduced per user, slot and track with array operations. The result equals
+`quiz.recompute_user_scores`, the rare slots with points in more than one track are averaged with
+`statistics.mean`, as the exactly rounded mean can differ from a float sum divided by the number
+of tracks. Without NumPy (`pip install numpy`) `quiz.recompute_user_scores` is used.
+
+Run it while the server is stopped or on a copy of `NDW_HOME`.
+"""
+
+import argparse
+import csv
+import logging
+import statistics
+import sys
+from typing import List, TextIO
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from ndw_chat import quiz
+from ndw_chat.db import db
+from ndw_chat.quiz import QuizUserScores, QuizUserScore
+from ndw_chat.scoring import parse_float
+from ndw_chat.util import config
+
+
+def batch_user_scores() -> QuizUserScores:
+    """ the scores of all users, computed from all stored answers """
+    if numpy is None:
+        logging.warning("NumPy is not installed, the scores are computed without it")
+        return quiz.recompute_user_scores()
+    questions = quiz.get_questions()
+    slots = list(quiz.get_slots())
+    tracks = [t.name for t in config().tracks]
+    configured_tracks = len(tracks)
+    tracks += sorted({q.track for q in questions} - set(tracks))
+    answers = list(db("quiz_answers"))
+    count = len(answers)
+
+    question_ids = numpy.fromiter((a["question"] for a in answers), dtype=numpy.int64, count=count)
+    user_ids = numpy.fromiter((a["user"] for a in answers), dtype=numpy.int64, count=count)
+    users, first_answers, user_index = numpy.unique(user_ids, return_index=True, return_inverse=True)
+    estimation = numpy.array([bool(q.estimation) for q in questions], dtype=bool)
+    solutions = numpy.array([q.estimation_solution if q.estimation else 0 for q in questions], dtype=float)
+    slot_index = numpy.array([slots.index(q.slot) for q in questions], dtype=numpy.int64)
+    track_index = numpy.array([tracks.index(q.track) for q in questions], dtype=numpy.int64)
+
+    points = numpy.zeros(count)
+    choice = numpy.flatnonzero(~estimation[question_ids])
+    points[choice] = [answers[i]["answer"] == questions[answers[i]["question"]].choice_solution for i in choice]
+    estimated = numpy.flatnonzero(estimation[question_ids])
+    if len(estimated):
+        points[estimated] = _estimation_points(question_ids[estimated],
+                                               numpy.array([parse_float(answers[i]["answer"]) for i in estimated]),
+                                               solutions)
+
+    # the last answer of a user per slot and track counts
+    cell = (user_index * len(slots) + slot_index[question_ids]) * len(tracks) + track_index[question_ids]
+    _, last = numpy.unique(cell[::-1], return_index=True)
+    last = count - 1 - last
+    cells = numpy.zeros(len(users) * len(slots) * len(tracks))
+    cells[cell[last]] = points[last]
+    present = numpy.zeros(len(cells), dtype=bool)
+    present[cell[last]] = True
+    cells = cells.reshape(len(users), len(slots), len(tracks))
+    present = present.reshape(cells.shape)
+
+    means = cells[:, :, :configured_tracks].sum(axis=2) / max(configured_tracks, 1)
+    inexact = ((cells != 0).sum(axis=2) > 1) | present[:, :, configured_tracks:].any(axis=2)
+    for user, slot in zip(*numpy.nonzero(inexact)):
+        values = cells[user, slot, :configured_tracks].tolist() + \
+            cells[user, slot, configured_tracks:][present[user, slot, configured_tracks:]].tolist()
+        means[user, slot] = statistics.mean(values)
+    totals = numpy.zeros(len(users))
+    for slot in range(len(slots)):
+        totals += means[:, slot]
+
+    # users with equal scores stay in the order of their first answer
+    by_first_answer = numpy.argsort(first_answers)
+    ranking = by_first_answer[numpy.argsort(-totals[by_first_answer], kind="stable")]
+    registered = quiz.quiz_index().users
+    answer_counts = numpy.bincount(question_ids, minlength=len(questions))
+    return QuizUserScores([QuizUserScore(registered.get(int(users[i])), float(totals[i])) for i in ranking],
+                          {q.id: int(answer_counts[q.id]) for q in questions},
+                          {q.id: q.to_dict() for q in questions})
+
+
+def _estimation_points(question_ids: "numpy.ndarray", values: "numpy.ndarray",
+                       solutions: "numpy.ndarray") -> "numpy.ndarray":
+    """ 2 / (rank + 2) per answer, using the last rank of the answers with the same value """
+    order = numpy.lexsort((numpy.abs(solutions[question_ids] - values), question_ids))
+    sorted_questions = question_ids[order]
+    ranks = numpy.empty(len(values), dtype=numpy.int64)
+    ranks[order] = numpy.arange(len(values)) - numpy.searchsorted(sorted_questions, sorted_questions)
+    by_value = numpy.lexsort((values, question_ids))
+    grouped_questions, grouped_values = question_ids[by_value], values[by_value]
+    new_group = numpy.ones(len(values), dtype=bool)
+    new_group[1:] = (grouped_questions[1:] != grouped_questions[:-1]) | (grouped_values[1:] != grouped_values[:-1])
+    last_ranks = numpy.maximum.reduceat(ranks[by_value], numpy.flatnonzero(new_group))
+    points = numpy.empty(len(values))
+    points[by_value] = 2 / (last_ranks[numpy.cumsum(new_group) - 1] + 2)
+    return points
+
+
+def write_csv(scores: QuizUserScores, file: TextIO):
+    writer = csv.writer(file)
+    writer.writerow(["rank", "user_id", "pseudonym", "email", "score"])
+    for rank, score in enumerate(scores.scores, 1):
+        user = score.user
+        writer.writerow([rank, user.id if user else "", user.pseudonym if user else "", user.email if user else "",
+                         repr(score.score)])
+
+
+def cli(args: List[str] = None):
+    parser = argparse.ArgumentParser(description="Compute the quiz scores from all stored answers")
+    parser.add_argument("--csv", help="file for the scores, standard output by default")
+    parser.add_argument("--check", action="store_true", help="compare the scores with the full recomputation")
+    parsed = parser.parse_args(args)
+    scores = batch_user_scores()
+    if parsed.check and scores.to_dict() != quiz.recompute_user_scores().to_dict():
+        print("the batch scores differ from the full recomputation", file=sys.stderr)
+        sys.exit(1)
+    if parsed.csv:
+        with open(parsed.csv, "w", newline="") as f:
+            write_csv(scores, f)
+    else:
+        write_csv(scores, sys.stdout)
+
+
+if __name__ == '__main__':
+    cli()
@@ -0,0 +1,359 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict, deque
+from typing import Callable, Optional, Awaitable, Dict, Any, Iterable, Set, List, Deque, Tuple, Union
+
+from aiohttp import web
+
+from ndw_chat.executor import run_cpu
+from ndw_chat import serialization
+from ndw_chat.serialization import dumps, packb
+from ndw_chat.util import config
+
+
+class FanoutStats:
+
+    def __init__(self):
+        self.sent_frames = 0
+        self.dropped_frames = 0
+        self.coalesced_frames = 0
+        self.evicted_clients = 0
+        self.sent_bytes = 0
+        """ encoded size of the sent frames (before the websocket compression) """
+
+
+fanout_stats = FanoutStats()
+
+ENCODERS: Dict[str, Callable[[Any], Union[str, bytes]]] = {"json": dumps}
+""" websocket protocol → encoder, str frames are sent as text and bytes frames as binary messages """
+if serialization.msgpack:
+    ENCODERS["msgpack"] = packb
+
+
+def negotiate_protocol(requested: Optional[str]) -> str:
+    """ the requested protocol if it is supported, JSON otherwise """
+    return requested if requested in ENCODERS else "json"
+
+
+class Frame:
+    """ command for the websocket clients, encoded at most once per protocol """
+
+    __slots__ = ("message", "_encoded")
+
+    def __init__(self, message: dict):
+        self.message = message
+        self._encoded: Dict[str, Union[str, bytes]] = {}
+
+    def encode(self, protocol: str) -> Union[str, bytes]:
+        data = self._encoded.get(protocol)
+        if data is None:
+            data = self._encoded[protocol] = ENCODERS[protocol](self.message)
+        return data
+
+
+class Subscriber:
+    """
+    Authenticated websocket with the tracks and message states it subscribed to (None: all).
+
+    Frames are put into a bounded queue that is drained by a writer task per websocket, so a slow
+    client does not delay the others. A frame with a coalesce key replaces a queued frame with the
+    same key. When the queue is full, the `send_queue_policy` (see Config) decides whether the
+    oldest frame, the new frame or the client itself is dropped. Clients that dropped more than
+    `evict_after_dropped_frames` frames are disconnected, they reconnect and fetch the current state.
+    """
+
+    def __init__(self, websocket: web.WebSocketResponse, tracks: Optional[Iterable[str]] = None,
+                 states: Optional[Iterable[str]] = None, protocol: str = "json"):
+        self.websocket = websocket
+        self.protocol = protocol
+        """ encoding of the frames, see negotiate_protocol """
+        self.tracks = set(tracks) if tracks is not None else None
+        self.states = set(states) if states is not None else None
+        self.queue: OrderedDict = OrderedDict()
+        """ coalesce key (or unique object) → frame """
+        self.dropped_frames = 0
+        self.evicted = False
+        self._has_frames = asyncio.Event()
+        self._writer = asyncio.ensure_future(self._write())
+
+    def shows(self, state: str) -> bool:
+        return self.states is None or state in self.states
+
+    def receives(self, track: Optional[str] = None, state: Optional[str] = None,
+                 skip_state: Optional[str] = None) -> bool:
+        """ see Subscriptions.receivers """
+        return (track is None or self.tracks is None or track in self.tracks) and \
+               (state is None or self.shows(state)) and (skip_state is None or not self.shows(skip_state))
+
+    def send(self, frame: Frame, coalesce_key: Optional[str] = None):
+        if self.evicted:
+            return
+        if coalesce_key is not None and coalesce_key in self.queue:
+            self.queue[coalesce_key] = frame
+            fanout_stats.coalesced_frames += 1
+            return
+        if len(self.queue) >= config().send_queue_size:
+            if config().send_queue_policy == "evict":
+                self.evict()
+                return
+            self.dropped_frames += 1
+            fanout_stats.dropped_frames += 1
+            if self.dropped_frames > config().evict_after_dropped_frames:
+                self.evict()
+                return
+            if config().send_queue_policy == "drop_newest":
+                return
+            self.queue.popitem(last=False)
+        self.queue[coalesce_key if coalesce_key is not None else object()] = frame
+        self._has_frames.set()
+
+    async def _write(self):
+        try:
+            while True:
+                await self._has_frames.wait()
+                while self.queue:
+                    _, frame = self.queue.popitem(last=False)
+                    data = frame.encode(self.protocol)
+                    if isinstance(data, str):
+                        await self.websocket.send_str(data)
+                    else:
+                        await self.websocket.send_bytes(data)
+                    fanout_stats.sent_frames += 1
+                    fanout_stats.sent_bytes += len(data)
+                self._has_frames.clear()
+        except asyncio.CancelledError:
+            pass
+        except Exception as ex:
+            logging.info(f"Could not send to websocket: {ex}")
+            self.evict()
+
+    def evict(self):
+        """ drops all queued frames and closes the websocket """
+        if self.evicted:
+            return
+        logging.error(f"Evict slow websocket client with {len(self.queue)} queued frames")
+        self.evicted = True
+        fanout_stats.evicted_clients += 1
+        self.queue.clear()
+        self.close()
+        asyncio.ensure_future(self.websocket.close())
+
+    def close(self):
+        self._writer.cancel()
+
+
+class Subscriptions:
+    """ the authenticated websockets, grouped by the tracks they subscribed to """
+
+    def __init__(self):
+        self.subscribers: Dict[web.WebSocketResponse, Subscriber] = {}
+        self.by_track: Dict[Optional[str], Set[Subscriber]] = {None: set()}
+        """ track → subscribers, None → subscribers of all tracks """
+
+    def add(self, subscriber: Subscriber):
+        self.subscribers[subscriber.websocket] = subscriber
+        for track in (subscriber.tracks if subscriber.tracks is not None else [None]):
+            self.by_track.setdefault(track, set()).add(subscriber)
+
+    def remove(self, websocket: web.WebSocketResponse):
+        subscriber = self.subscribers.pop(websocket, None)
+        if subscriber:
+            subscriber.close()
+        for subscribers in self.by_track.values():
+            subscribers.discard(subscriber)
+
+    def stats(self) -> Dict[str, int]:
+        return {"clients": len(self.subscribers),
+                "queued_frames": sum(len(s.queue) for s in self.subscribers.values()),
+                "max_queued_frames": max((len(s.queue) for s in self.subscribers.values()), default=0),
+                **vars(fanout_stats)}
+
+    def receivers(self, track: Optional[str] = None, state: Optional[str] = None,
+                  skip_state: Optional[str] = None) -> List[Subscriber]:
+        """
+        subscribers of the track (or all subscribers if track is None) that show messages
+        with the passed state but not messages with the skip_state
+        """
+        if track is None:
+            subscribers = self.subscribers.values()
+        else:
+            subscribers = self.by_track[None] | self.by_track.get(track, set())
+        return [s for s in subscribers if s.receives(None, state, skip_state)]
+
+
+class Viewer:
+    """ unauthenticated read-only stream of a track, only the latest frame is kept """
+
+    def __init__(self, track: str, frame: bytes):
+        self.track = track
+        self.frame: Optional[bytes] = frame
+        self._has_frame = asyncio.Event()
+        self._has_frame.set()
+
+    def send(self, frame: bytes):
+        self.frame = frame
+        self._has_frame.set()
+
+    async def next(self, timeout: float) -> Optional[bytes]:
+        """ the latest not yet returned frame or None if there was none within the timeout """
+        try:
+            await asyncio.wait_for(self._has_frame.wait(), timeout)
+        except asyncio.TimeoutError:
+            return None
+        self._has_frame.clear()
+        frame, self.frame = self.frame, None
+        return frame
+
+
+class ViewerChannels:
+    """
+    Server-sent event streams of the viewers, grouped by track. A published event is encoded once
+    and replaces the not yet sent event of every viewer of the track, so slow viewers only skip
+    intermediate states.
+    """
+
+    def __init__(self):
+        self.by_track: Dict[str, Set[Viewer]] = {}
+
+    @staticmethod
+    def encode(event: str, data: dict) -> bytes:
+        return f"event: {event}\ndata: {dumps(data)}\n\n".encode()
+
+    def add(self, track: str, frame: bytes) -> Viewer:
+        viewer = Viewer(track, frame)
+        self.by_track.setdefault(track, set()).add(viewer)
+        return viewer
+
+    def remove(self, viewer: Viewer):
+        self.by_track.get(viewer.track, set()).discard(viewer)
+
+    def publish(self, track: str, event: str, data: dict):
+        frame = self.encode(event, data)
+        for viewer in self.by_track.get(track, ()):
+            viewer.send(frame)
+
+    def count(self) -> int:
+        return sum(len(viewers) for viewers in self.by_track.values())
+
+
+class Event:
+
+    def __init__(self, seq: int, frame: Frame, track: str, state: Optional[str], skip_state: Optional[str],
+                 coalesce_key: Optional[str]):
+        self.seq = seq
+        self.frame = frame
+        self.track = track
+        self.state = state
+        self.skip_state = skip_state
+        self.coalesce_key = coalesce_key
+
+
+class EventLog:
+    """
+    Bounded log of the last `event_log_size` (see Config) track events. Clients pass the epoch
+    and the seq of the last event they received when they reconnect and only get the events
+    they missed, as long as these are still in the log and the server has not been restarted.
+    """
+
+    def __init__(self):
+        self.epoch = str(time.time())
+        self.seq = 0
+        self.events: Deque[Event] = deque()
+
+    def next_seq(self) -> int:
+        self.seq += 1
+        return self.seq
+
+    def add(self, event: Event):
+        self.events.append(event)
+        while len(self.events) > config().event_log_size:
+            self.events.popleft()
+
+    def since(self, epoch: str, seq: int) -> Optional[List[Event]]:
+        """ events after seq or None if events are missing from the log """
+        if epoch != self.epoch or seq > self.seq:
+            return None
+        if seq < self.seq and (not self.events or self.events[0].seq > seq + 1):
+            return None
+        return [event for event in self.events if event.seq > seq]
+
+
+def _user_id(score: dict) -> Optional[int]:
+    return score["user"]["id"] if score["user"] else None
+
+
+def scores_delta(old: dict, new: dict) -> dict:
+    """
+    Difference between two versions of the scores dict (as returned by `QuizUserScores.to_dict`
+    plus a version): the ranks whose user or score changed, the users that are new, the
+    changed answer counts and the new length of the ranking. The questions are omitted.
+    """
+    old_scores = old["scores"]
+    known_users = {_user_id(score) for score in old_scores}
+    ranks = {}
+    users = {}
+    for rank, score in enumerate(new["scores"]):
+        user_id = _user_id(score)
+        if rank >= len(old_scores) or _user_id(old_scores[rank]) != user_id or \
+                old_scores[rank]["score"] != score["score"]:
+            ranks[rank] = {"user_id": user_id, "score": score["score"]}
+            if user_id not in known_users:
+                users[user_id] = score["user"]
+    return {"version": new["version"], "base_version": old["version"], "length": len(new["scores"]),
+            "ranks": ranks, "users": users,
+            "count": {q: c for q, c in new["count"].items() if old["count"].get(q) != c}}
+
+
+def _encode_scores(scores: Any, version: int, old: dict, protocols: Iterable[str]) -> Tuple[dict, Frame]:
+    """
+    the scores dict of the QuizUserScores with the passed version and the scores_delta frame
+    against old, encoded for the passed protocols
+    """
+    snapshot = {**scores.to_dict(), "version": version}
+    frame = Frame({"command": "scores_delta", "arguments": scores_delta(old, snapshot)})
+    for protocol in protocols:
+        frame.encode(protocol)
+    return snapshot, frame
+
+
+class ScoreBroadcaster:
+    """
+    Coalesces score updates: `schedule` only marks the scores as changed and at most
+    `score_broadcasts_per_second` (see Config) updates are sent. Every update is sent as a
+    `scores_delta` against the previously sent version, clients that miss a version request the
+    full `scores` again. The deltas are computed and encoded (for the protocols of the connected
+    clients) in the CPU pool, so the event loop only enqueues the frame.
+    """
+
+    def __init__(self, compute: Callable[[], Any], send: Callable[[Frame], Awaitable],
+                 protocols: Callable[[], Iterable[str]] = lambda: ["json"]):
+        self.compute = compute
+        self.send = send
+        """ sends the scores_delta frame to all subscribers """
+        self.protocols = protocols
+        """ protocols of the subscribers """
+        self.snapshot: Optional[dict] = None
+        """ last sent scores with their version """
+        self._changed = False
+        self._task: Optional[asyncio.Task] = None
+
+    def current(self) -> dict:
+        """ the full scores of the last sent version """
+        if not self.snapshot:
+            self.snapshot = {**self.compute().to_dict(), "version": 0}
+        return self.snapshot
+
+    def schedule(self):
+        self._changed = True
+        if not self._task or self._task.done():
+            self._task = asyncio.ensure_future(self._run())
+
+    async def _run(self):
+        while self._changed:
+            self._changed = False
+            old = self.current()
+            self.snapshot, frame = await run_cpu(_encode_scores, self.compute(), old["version"] + 1, old,
+                                                 set(self.protocols()))
+            await self.send(frame)
+            await asyncio.sleep(1 / config().score_broadcasts_per_second)
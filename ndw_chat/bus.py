@@ -0,0 +1,316 @@
+"""
+Event bus that connects the workers of a multi process setup (`workers` in Config).
+
+Every worker publishes the journal records of its changes and the track events it propagates.
+The other workers apply the records to their in-memory tables and indexes and propagate the
+events to their own websocket clients. Worker 0 is the primary: it is the only one that writes
+the storage files and runs the retention. Bus messages are delivered in publishing order per worker.
+
+Every message carries the epoch (one per bus instance) and the sequence number of its worker.
+Duplicates are dropped, and a gap in the sequence numbers, or a new subscription after a lost
+connection, makes the receiver ask the other workers to resend the messages it missed. The last
+HISTORY_SIZE messages of every worker can be resent.
+
+- "local": in-process bus between the buses created in the same process (a no-op for one worker)
+- "resp": Redis protocol PUBLISH/SUBSCRIBE, works with Redis or the stand-in server
+  (`python -m ndw_chat.bus --port 6379`)
+"""
+
+import argparse
+import asyncio
+import collections
+import logging
+import time
+import uuid
+from typing import Callable, List, Dict, Set, Any, Tuple, Deque, Optional
+
+from ndw_chat.serialization import dumps, loads
+from ndw_chat.util import config, worker_id
+
+CHANNEL = "ndw_chat"
+HISTORY_SIZE = 10000
+RESEND_INTERVAL = 1
+""" seconds till a resend is requested again for the same gap """
+
+
+class Bus:
+
+    def __init__(self, worker: int, handler: Callable[[dict], Any]):
+        self.worker = worker
+        self.handler = handler
+        """ called with the messages of the other workers """
+        self.published = 0
+        self.received = 0
+        self.epoch = uuid.uuid4().hex
+        self._history: Deque[dict] = collections.deque(maxlen=HISTORY_SIZE)
+        """ the last published messages, for resend requests """
+        self._last: Dict[int, Tuple[str, int]] = {}
+        """ worker → (epoch, sequence number) of the last handled message """
+        self._requested: Dict[int, Tuple[Tuple[str, int], float]] = {}
+        """ worker → last handled message and time of the last resend request for it """
+
+    def publish(self, message: dict):
+        """ message is a dict with a "type", it is sent asynchronously and in order """
+        self.published += 1
+        message = {**message, "worker": self.worker, "epoch": self.epoch, "seq": self.published}
+        self._history.append(message)
+        self._send(message)
+
+    def _send(self, message: dict):
+        raise NotImplementedError()
+
+    def _receive(self, message: dict):
+        worker = message["worker"]
+        if worker == self.worker:
+            return
+        if message["type"] == "resend":
+            self._resend(message["since"].get(str(self.worker)))
+            return
+        last = self._last.get(worker)
+        if last and last[0] == message["epoch"]:
+            if message["seq"] <= last[1]:
+                return
+            if message["seq"] > last[1] + 1:
+                # handled in order after the missing messages have been resent
+                self._request_resend(worker, last)
+                return
+        self._last[worker] = (message["epoch"], message["seq"])
+        self.received += 1
+        try:
+            self.handler(message)
+        except Exception as ex:
+            logging.exception(ex)
+
+    def _request_resend(self, worker: int, last: Tuple[str, int]):
+        requested = self._requested.get(worker)
+        if requested and requested[0] == last and time.monotonic() - requested[1] < RESEND_INTERVAL:
+            return
+        logging.warning(f"Missed bus messages of worker {worker} after {last[1]}, requesting them again")
+        self._requested[worker] = (last, time.monotonic())
+        self._send({"type": "resend", "worker": self.worker, "since": {str(worker): last}})
+
+    def request_resends(self):
+        """ asks all known workers for the messages after the last handled ones, e.g. after a new subscription """
+        if self._last:
+            self._send({"type": "resend", "worker": self.worker,
+                        "since": {str(worker): last for worker, last in self._last.items()}})
+
+    def _resend(self, since: Optional[List]):
+        """ resends the messages after since = (epoch, sequence number) """
+        if not since or since[0] != self.epoch or since[1] >= self.published:
+            return
+        if not self._history or self._history[0]["seq"] > since[1] + 1:
+            logging.error(f"Bus messages after {since[1]} are no longer available, a worker missed them")
+        for message in self._history:
+            if message["seq"] > since[1]:
+                self._send(message)
+
+    async def start(self):
+        """ subscribes to the bus, messages that are published afterwards are received """
+        pass
+
+    async def close(self):
+        pass
+
+
+class LocalBus(Bus):
+    """ delivers the messages to the other LocalBus instances of this process """
+
+    _buses: List["LocalBus"] = []
+
+    async def start(self):
+        LocalBus._buses.append(self)
+
+    def _send(self, message: dict):
+        for bus in LocalBus._buses:
+            if bus is not self:
+                asyncio.get_event_loop().call_soon(bus._receive, message)
+
+    async def close(self):
+        if self in LocalBus._buses:
+            LocalBus._buses.remove(self)
+
+
+def _encode_command(*args: str) -> bytes:
+    parts = [f"*{len(args)}\r\n".encode()]
+    for arg in args:
+        data = arg.encode()
+        parts.append(f"${len(data)}\r\n".encode() + data + b"\r\n")
+    return b"".join(parts)
+
+
+async def _read_reply(reader: asyncio.StreamReader) -> Any:
+    """ reads a RESP value (errors are returned as exceptions) """
+    line = (await reader.readuntil(b"\r\n"))[:-2]
+    kind, rest = line[:1], line[1:].decode()
+    if kind == b"+":
+        return rest
+    if kind == b"-":
+        return RuntimeError(rest)
+    if kind == b":":
+        return int(rest)
+    if kind == b"$":
+        if int(rest) < 0:
+            return None
+        return (await reader.readexactly(int(rest) + 2))[:-2].decode()
+    if kind == b"*":
+        return [await _read_reply(reader) for _ in range(int(rest))] if int(rest) >= 0 else None
+    raise ValueError(f"Unknown RESP reply {line!r}")
+
+
+class RespBus(Bus):
+    """
+    Redis protocol bus with a connection for publishing and one for the subscription. The replies
+    to PUBLISH are read in the background, messages without a reply are published again on the
+    next connection (the receivers drop duplicates).
+    """
+
+    def __init__(self, worker: int, handler: Callable[[dict], Any], host: str, port: int):
+        super().__init__(worker, handler)
+        self.host = host
+        self.port = port
+        self._queue: List[bytes] = []
+        self._unacknowledged: Deque[bytes] = collections.deque()
+        """ published messages without a reply, in publishing order """
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._has_messages = asyncio.Event()
+        self._tasks: List[asyncio.Task] = []
+
+    async def start(self):
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        writer.write(_encode_command("SUBSCRIBE", CHANNEL))
+        await writer.drain()
+        await _read_reply(reader)  # subscribe confirmation
+        self._tasks = [asyncio.ensure_future(self._subscription(reader, writer)),
+                       asyncio.ensure_future(self._publisher())]
+
+    def _send(self, message: dict):
+        self._queue.append(_encode_command("PUBLISH", CHANNEL, dumps(message)))
+        self._has_messages.set()
+
+    async def _subscription(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        while True:
+            try:
+                while True:
+                    reply = await _read_reply(reader)
+                    if isinstance(reply, list) and reply[0] == "message":
+                        self._receive(loads(reply[2]))
+            except (ConnectionError, asyncio.IncompleteReadError) as ex:
+                logging.error(f"Lost the bus subscription, reconnecting: {ex}")
+            writer.close()
+            while True:
+                await asyncio.sleep(1)
+                try:
+                    reader, writer = await asyncio.open_connection(self.host, self.port)
+                    writer.write(_encode_command("SUBSCRIBE", CHANNEL))
+                    await writer.drain()
+                    await _read_reply(reader)  # subscribe confirmation
+                    break
+                except (OSError, asyncio.IncompleteReadError) as ex:
+                    logging.error(f"Could not connect to the bus: {ex}")
+            # the messages of the other workers while the subscription was lost
+            self.request_resends()
+
+    async def _publisher(self):
+        while True:
+            await self._has_messages.wait()
+            self._has_messages.clear()
+            messages, self._queue = self._queue, []
+            self._unacknowledged.extend(messages)
+            try:
+                if self._writer is None:
+                    reader, self._writer = await asyncio.open_connection(self.host, self.port)
+                    asyncio.ensure_future(self._read_replies(reader, self._writer))
+                    messages = list(self._unacknowledged)
+                self._writer.write(b"".join(messages))
+                await self._writer.drain()
+            except OSError as ex:
+                logging.error(f"Could not publish {len(self._unacknowledged)} messages to the bus, retrying: {ex}")
+                self._reconnect(self._writer)
+                await asyncio.sleep(1)
+                self._has_messages.set()
+
+    def _reconnect(self, writer: Optional[asyncio.StreamWriter]):
+        """ publishes the unacknowledged messages on a new connection if writer is still the current one """
+        if writer is not None and writer is self._writer:
+            writer.close()
+            self._writer = None
+            self._has_messages.set()
+
+    async def _read_replies(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                reply = await _read_reply(reader)
+                if isinstance(reply, Exception):
+                    logging.error(f"Bus error: {reply}")
+                if writer is self._writer and self._unacknowledged:
+                    self._unacknowledged.popleft()
+        except (ConnectionError, asyncio.IncompleteReadError) as ex:
+            logging.error(f"Lost the bus connection for publishing: {ex}")
+            self._reconnect(writer)
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+
+
+def create_bus(handler: Callable[[dict], Any]) -> Bus:
+    if config().bus == "local":
+        return LocalBus(worker_id(), handler)
+    if config().bus == "resp":
+        return RespBus(worker_id(), handler, config().bus_host, config().bus_port)
+    raise ValueError(f"Unknown bus {config().bus}")
+
+
+class StandInServer:
+    """ minimal server for the PUBLISH, SUBSCRIBE and PING commands of the Redis protocol """
+
+    def __init__(self):
+        self.channels: Dict[str, Set[asyncio.StreamWriter]] = {}
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                command = await _read_reply(reader)
+                name = command[0].upper()
+                if name == "PUBLISH":
+                    message = _encode_command("message", command[1], command[2])
+                    subscribers = self.channels.get(command[1], set())
+                    for subscriber in subscribers:
+                        subscriber.write(message)
+                    writer.write(f":{len(subscribers)}\r\n".encode())
+                elif name == "SUBSCRIBE":
+                    for i, channel in enumerate(command[1:]):
+                        self.channels.setdefault(channel, set()).add(writer)
+                        # ["subscribe", channel, number of subscriptions]
+                        writer.write(b"*3\r\n" + _encode_command("subscribe", channel)[4:] + f":{i + 1}\r\n".encode())
+                elif name == "PING":
+                    writer.write(b"+PONG\r\n")
+                else:
+                    writer.write(f"-ERR unknown command '{name}'\r\n".encode())
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            for subscribers in self.channels.values():
+                subscribers.discard(writer)
+            writer.close()
+
+
+async def run_stand_in_server(host: str, port: int) -> asyncio.AbstractServer:
+    return await asyncio.start_server(StandInServer().handle, host, port)
+
+
+def cli():
+    parser = argparse.ArgumentParser(description="Stand-in for a Redis server as bus between the workers")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=6379)
+    args = parser.parse_args()
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(run_stand_in_server(args.host, args.port))
+    logging.info(f"Bus stand-in listening on {args.host}:{args.port}")
+    loop.run_forever()
+
+
+if __name__ == '__main__':
+    cli()
@@ -0,0 +1,131 @@
+"""
+Cache for the encoded responses of the read-mostly endpoints (/tracks, /has_quiz, /current_question,
+/scores, /my_rank, /messages and /host_message).
+
+Responses are stored by path and query with their body, a gzip compressed body and an ETag,
+so a hit only costs a dictionary lookup. Every entry depends on tags ("messages", "scores", …)
+and the mutation paths in db.py and quiz.py call `invalidate` with the tags of the data they
+changed. Only successful responses are cached, so the key of an authenticated entry contains
+the correct password.
+"""
+
+import functools
+import gzip
+import hashlib
+from collections import OrderedDict
+from typing import Dict, Set, Tuple, Optional, Iterable
+
+from aiohttp import web
+from aiohttp.abc import Request
+
+from ndw_chat.metrics import counter
+
+CACHE_REQUESTS = counter("ndw_response_cache_requests_total", "requests of cached endpoints by result")
+
+MAX_ENTRIES = 1000
+GZIP_MIN_SIZE = 512
+""" smaller bodies are not compressed """
+
+Key = Tuple[str, Tuple[Tuple[str, str], ...]]
+
+
+class CachedResponse:
+
+    __slots__ = ("body", "gzipped", "content_type", "etag", "tags")
+
+    def __init__(self, body: bytes, content_type: str, tags: Iterable[str]):
+        self.body = body
+        self.gzipped = gzip.compress(body, compresslevel=6) if len(body) >= GZIP_MIN_SIZE else None
+        self.content_type = content_type
+        self.etag = f'"{hashlib.blake2b(body, digest_size=8).hexdigest()}"'
+        self.tags = tuple(tags)
+
+    def respond(self, request: Request) -> web.Response:
+        headers = {"ETag": self.etag, "Cache-Control": "no-cache", "Vary": "Accept-Encoding"}
+        if self.etag in [tag.strip() for tag in request.headers.get("If-None-Match", "").split(",")]:
+            return web.Response(status=304, headers=headers)
+        if self.gzipped is not None and "gzip" in request.headers.get("Accept-Encoding", ""):
+            headers["Content-Encoding"] = "gzip"
+            return web.Response(body=self.gzipped, content_type=self.content_type, headers=headers)
+        return web.Response(body=self.body, content_type=self.content_type, headers=headers)
+
+
+class ResponseCache:
+    """ least recently used responses by key, dropped when one of their tags is invalidated """
+
+    def __init__(self, max_entries: int = MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.entries: OrderedDict = OrderedDict()
+        self.by_tag: Dict[str, Set[Key]] = {}
+        self.invalidations = 0
+        """ number of invalidate calls, responses computed during one of them are not cached """
+
+    def get(self, key: Key) -> Optional[CachedResponse]:
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+        return entry
+
+    def put(self, key: Key, entry: CachedResponse):
+        self._remove(key)
+        self.entries[key] = entry
+        for tag in entry.tags:
+            self.by_tag.setdefault(tag, set()).add(key)
+        if len(self.entries) > self.max_entries:
+            self._remove(next(iter(self.entries)))
+
+    def _remove(self, key: Key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            for tag in entry.tags:
+                keys = self.by_tag.get(tag)
+                if keys is not None:
+                    keys.discard(key)
+
+    def invalidate(self, *tags: str):
+        self.invalidations += 1
+        for tag in tags:
+            for key in self.by_tag.pop(tag, set()):
+                self._remove(key)
+
+
+_cache = ResponseCache()
+
+
+def response_cache() -> ResponseCache:
+    return _cache
+
+
+def invalidate(*tags: str):
+    """ drops the cached responses that depend on one of the tags, call after changing their data """
+    _cache.invalidate(*tags)
+
+
+def cached(*tags: str):
+    """
+    decorator for request handlers whose responses only change with the data of the tags,
+    successful responses are cached and answered with ETag, If-None-Match and gzip support
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(request: Request):
+            key = (request.path, tuple(sorted(request.query.items())))
+            entry = _cache.get(key)
+            if entry is None:
+                invalidations = _cache.invalidations
+                response = await func(request)
+                if response.status != 200 or not isinstance(response.body, bytes):
+                    CACHE_REQUESTS.inc(result="uncacheable")
+                    return response
+                entry = CachedResponse(response.body, response.content_type, tags)
+                if invalidations == _cache.invalidations:
+                    _cache.put(key, entry)
+                CACHE_REQUESTS.inc(result="miss")
+            else:
+                CACHE_REQUESTS.inc(result="hit")
+            return entry.respond(request)
+
+        return wrapper
+
+    return decorator
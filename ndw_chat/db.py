@@ -1,20 +1,50 @@
+"""
+Tables of the messages, host messages and quiz data with a resident index of the messages.
+
+With `shard_tracks` (see Config) the messages of every track are kept in a `Shard` of their own:
+journal files `db.track-<track>.*`, index, id sequence and storage writer thread, so a burst of
+messages in one track doesn't delay the writes of the others. The queries over all tracks merge the
+shards, the message versions are ordered across all shards. Without it all tracks share one shard
+that uses the `messages` table of the main database.
+
+The message versions come from the persisted `message_versions` sequence, so they keep increasing
+across restarts, even if the messages with the largest versions have been deleted meanwhile.
+"""
+
+import heapq
+import itertools
 import time
+import urllib.parse
+import uuid
+from collections import OrderedDict
 from dataclasses import dataclass
-from typing import Optional, List
+from typing import Optional, List, Dict, Tuple, Callable, Iterable
 
 from dataclasses_json import dataclass_json
-from tinydb import TinyDB, Query
-from tinydb.table import Table
+from tinydb import Query
 
-from ndw_chat.util import base_path, config
+from ndw_chat.cache import invalidate
+from ndw_chat.metrics import histogram, timed
+from ndw_chat.retention import archive, expiry_time, archive_expired
+from ndw_chat.executor import DEFAULT_WRITER, storage_writer
+from ndw_chat.sequences import sequence, Sequence
+from ndw_chat.serialization import fast_dict, SLOTS
+from ndw_chat.storage import open_database, JournalTable, JournalDatabase
+from ndw_chat.util import base_path, config, worker_id, is_primary
 
 RAW = "raw"
 VISIBLE = "visible"
 ARCHIVED = "archived"
 
+DB_SECONDS = histogram("ndw_db_operation_seconds", "duration of the storage operations")
+
+VERSIONS = "message_versions"
+_EPOCH = uuid.uuid4().hex
 
+
+@fast_dict
 @dataclass_json
-@dataclass
+@dataclass(**SLOTS)
 class Message:
     id: int
     track: str
@@ -22,38 +52,414 @@ class Message:
     time: float
     """ unix time at creation """
     content: str
+    version: int = 0
+    """ increased on every change, larger than the versions of all previously changed messages """
+    external_id: Optional[str] = None
+    """ id of the message in the source system (e.g. YouTube), used to drop duplicates """
+    archived_at: Optional[float] = None
+    """ unix time at which the message was archived (if it is archived) """
 
 
-_db: Optional[TinyDB] = None
+_db = None
+_record_listener: Optional[Callable[[dict], None]] = None
 
 
-def db(table: str) -> Table:
+def db(table: str) -> JournalTable:
+    """ returns the table of the configured storage backend (journal or TinyDB, see storage.py) """
     global _db
-    if not _db:
-        _db = TinyDB(base_path() / "db.json", indent=4, separators=(',', ': '))
+    if _db is None:
+        worker_options = {}
+        if config().workers > 1:
+            worker_options = {"read_only": not is_primary(), "id_offset": worker_id(), "id_stride": config().workers,
+                              "on_record": _record_listener}
+        _db = open_database(config().storage, base_path(), config().snapshot_interval, **worker_options)
         _db.table("host_messages")
         _db.table("messages")
     return _db.table(table)
 
 
-def get_messages() -> List[Message]:
-    return [Message.from_dict(msg) for msg in db("messages")]
+def set_record_listener(listener: Callable[[dict], None]):
+    """ listener is called with every journal record of this worker, used to publish them (see bus.py) """
+    global _record_listener
+    _record_listener = listener
+    if _db is not None:
+        _db.on_record = listener
+
+
+def apply_remote_record(record: dict) -> List[dict]:
+    """ applies the journal record of another worker and updates the message index, returns the removed documents """
+    table = db(record["table"])
+    removed = []
+    if record["op"] == "remove":
+        removed = [doc for doc in (table.get(doc_id=doc_id) for doc_id in record["ids"]) if doc is not None]
+    elif record["table"] == "messages" and _index:
+        record = _with_local_versions(record)
+    _db.apply_remote(record)
+    # the cache tags of the messages and host_messages tables are their names
+    invalidate(record["table"])
+    if record["table"] == "messages" and _index:
+        for doc in removed:
+            if doc["id"] in _index.by_id:
+                _index.remove(doc["id"])
+        if record["op"] != "remove":
+            for doc_id in record["ids"]:
+                msg = Message.from_dict(table.get(doc_id=doc_id))
+                if msg.id in _index.by_id:
+                    _index.remove(msg.id)
+                _index.add(msg, doc_id)
+    return removed
+
+
+def _with_local_versions(record: dict) -> dict:
+    """
+    the messages record with new versions of this worker, as the versions are only ordered per
+    worker (see messages_epoch), the table and the index use the same versions
+    """
+    shard = message_shards()[0]
+    if record["op"] == "insert":
+        return {**record, "docs": [{**doc, "version": _next_version(shard)} for doc in record["docs"]]}
+    if "version" in record["fields"]:
+        return {**record, "fields": {**record["fields"], "version": _next_version(shard)}}
+    return record
+
+
+class MessageIndex:
+    """
+    Resident index of the messages table: messages by id with secondary indexes per track and
+    per state. It is only modified together with the table (in the functions below).
+    """
+
+    def __init__(self):
+        self.by_id: Dict[int, Message] = {}
+        self.doc_ids: Dict[int, int] = {}
+        """ message id → document id in the messages table """
+        self.by_track: Dict[str, Dict[int, Message]] = {}
+        self.by_state: Dict[str, Dict[int, Message]] = {RAW: {}, VISIBLE: {}, ARCHIVED: {}}
+        self._ordered = True
+        """ by_id is ordered by message id """
+        self.by_version: OrderedDict = OrderedDict()
+        """ message id → message, ordered by version """
+        self.version = 0
+        self.by_external_id: Dict[str, Message] = {}
+        self.archived_at: OrderedDict = OrderedDict()
+        """ message id → time at which it was archived, ordered by time (see archived) """
+        self._archived_ordered = True
+        self.max_id = -1
+        """ largest id of all messages that were added since the start """
+
+    def changed(self, msg: Message):
+        """ call after the version of the message has been increased """
+        self.by_version[msg.id] = msg
+        self.by_version.move_to_end(msg.id)
+
+    def add(self, msg: Message, doc_id: int):
+        if self.by_id and msg.id < next(reversed(self.by_id)):
+            self._ordered = False
+        self.version = max(self.version, msg.version)
+        self.max_id = max(self.max_id, msg.id)
+        if msg.state == ARCHIVED:
+            # messages that were archived before the time was stored count as archived at the start
+            if msg.archived_at is None:
+                msg.archived_at = time.time()
+            if self.archived_at and msg.archived_at < self.archived_at[next(reversed(self.archived_at))]:
+                self._archived_ordered = False
+            self.archived_at[msg.id] = msg.archived_at
+        self.by_version[msg.id] = msg
+        self.by_id[msg.id] = msg
+        if msg.external_id is not None:
+            self.by_external_id[msg.external_id] = msg
+        self.doc_ids[msg.id] = doc_id
+        self.by_track.setdefault(msg.track, {})[msg.id] = msg
+        self.by_state.setdefault(msg.state, {})[msg.id] = msg
+
+    def remove(self, id: int):
+        msg = self.by_id.pop(id)
+        del self.by_version[id]
+        self.archived_at.pop(id, None)
+        if msg.external_id is not None:
+            del self.by_external_id[msg.external_id]
+        del self.doc_ids[id]
+        del self.by_track[msg.track][id]
+        del self.by_state[msg.state][id]
+
+    def set_state(self, id: int, new_state: str, version: int, archived_at: Optional[float]):
+        msg = self.by_id[id]
+        del self.by_state[msg.state][id]
+        msg.state = new_state
+        msg.version = version
+        msg.archived_at = archived_at
+        self.by_state.setdefault(new_state, {})[id] = msg
+        self.archived_at.pop(id, None)
+        if new_state == ARCHIVED:
+            self.archived_at[id] = archived_at
+        self.changed(msg)
+
+    def archived(self) -> OrderedDict:
+        """ archived_at ordered by time """
+        if not self._archived_ordered:
+            self.archived_at = OrderedDict(sorted(self.archived_at.items(), key=lambda item: item[1]))
+            self._archived_ordered = True
+        return self.archived_at
+
+    def ordered(self) -> Dict[int, Message]:
+        """ by_id ordered by message id """
+        if not self._ordered:
+            self.by_id = dict(sorted(self.by_id.items()))
+            for messages in [*self.by_track.values(), *self.by_state.values()]:
+                ordered = sorted(messages.items())
+                messages.clear()
+                messages.update(ordered)
+            self._ordered = True
+        return self.by_id
+
+    def messages(self, track: Optional[str] = None, state: Optional[str] = None) -> List[Message]:
+        """ messages ordered by id """
+        self.ordered()
+        if track is None and state is None:
+            return list(self.by_id.values())
+        if state is None:
+            return list(self.by_track.get(track, {}).values())
+        if track is None:
+            return list(self.by_state.get(state, {}).values())
+        return [msg for msg in self.by_track.get(track, {}).values() if msg.state == state]
+
+    def changes(self, since: int, track: Optional[str] = None, state: Optional[str] = None,
+                limit: Optional[int] = None) -> Tuple[List[Message], bool]:
+        """
+        messages with a version larger than since, ordered by version, and whether there are more
+        than limit of them
+        """
+        changed = []
+        for msg in reversed(self.by_version.values()):
+            if msg.version <= since:
+                break
+            if (track is None or msg.track == track) and (state is None or msg.state == state):
+                changed.append(msg)
+        changed.reverse()
+        if limit is not None and len(changed) > limit:
+            return changed[:limit], True
+        return changed, False
+
+
+_index: Optional[MessageIndex] = None
+
+
+def index() -> MessageIndex:
+    """ index of the messages table of the main database, only used without shard_tracks """
+    global _index
+    if not _index:
+        _index = MessageIndex()
+        for doc in sorted(db("messages"), key=lambda doc: doc.get("version", 0)):
+            _index.add(Message.from_dict(doc), doc.doc_id)
+        _restore_version(_index)
+    return _index
 
 
-def add_message(track: str, content: str) -> Message:
-    msg = Message(len(db("messages")), track, RAW, time.time(), content)
-    db("messages").insert(msg.to_dict())
-    return msg
+@dataclass
+class Shard:
+    """ messages of a track (or of all tracks without shard_tracks) """
+    index: MessageIndex
+    table: JournalTable
+    sequence: Sequence
+    writer: str
+    """ name of the storage writer thread of the table """
+    id_stride: int = 1
+    id_offset: int = 0
+    """ the ids of the messages are id_offset modulo id_stride, so they are unique across the shards """
+
+    def allocate(self, count: int) -> List[int]:
+        return [value * self.id_stride + self.id_offset for value in self.sequence.allocate(count)]
+
+
+_shards: Optional[Dict[str, Shard]] = None
+
+
+def shard_file_name(track: str) -> str:
+    return f"db.track-{urllib.parse.quote(track, safe='')}"
+
+
+def _open_shard(track: str) -> Shard:
+    writer = f"messages.{track}"
+    table = JournalDatabase(base_path(), shard_file_name(track), config().snapshot_interval,
+                            writer=storage_writer(writer)).table("messages")
+    shard_index = MessageIndex()
+    for doc in sorted(table, key=lambda doc: doc.get("version", 0)):
+        shard_index.add(Message.from_dict(doc), doc.doc_id)
+    _restore_version(shard_index)
+    tracks = get_tracks()
+    # ids of tracks that are no longer configured are never allocated
+    offset = tracks.index(track) if track in tracks else 0
+    shard_sequence = sequence(writer, lambda: max(shard.index.max_id for shard in _shards.values()) // len(tracks) + 1)
+    return Shard(shard_index, table, shard_sequence, writer, len(tracks), offset)
+
+
+def shards() -> Dict[str, Shard]:
+    """
+    track → shard with shard_tracks, the messages of the main database and of tracks that are no longer
+    configured are moved into shards on the first call
+    """
+    global _shards
+    if _shards is None:
+        legacy = db("messages")
+        tracks = get_tracks() + sorted({doc["track"] for doc in legacy} - set(get_tracks()))
+        tracks += sorted({urllib.parse.unquote(path.name[len("db.track-"):-len(".journal")])
+                          for path in base_path().glob("db.track-*.journal")} - set(tracks))
+        _shards = {track: _open_shard(track) for track in tracks}
+        moved = []
+        for doc in sorted(legacy, key=lambda doc: doc.get("version", 0)):
+            shard = _shards[doc["track"]]
+            if doc["id"] not in shard.index.by_id:
+                shard.index.add(Message.from_dict(doc), shard.table.insert(dict(doc)))
+            moved.append(doc.doc_id)
+        if moved:
+            # the shards are persisted before the messages are removed from the main database
+            for shard in _shards.values():
+                shard.table.database.compact().result()
+            legacy.remove(doc_ids=moved)
+    return _shards
+
+
+def message_shards(track: Optional[str] = None) -> List[Shard]:
+    """ the shard of the track or all shards if track is None """
+    if not config().shard_tracks:
+        return [Shard(index(), db("messages"), sequence("messages", lambda: index().max_id + 1), DEFAULT_WRITER)]
+    if track is None:
+        return list(shards().values())
+    return [shards()[track]] if track in shards() else []
+
+
+def message_writers(tracks: Iterable[str]) -> List[str]:
+    """ names of the storage writers of the messages of the tracks, see storage_barrier """
+    return sorted({shard.writer for track in tracks for shard in message_shards(track)})
+
+
+def _shard_of(id: int) -> Optional[Shard]:
+    for shard in message_shards():
+        if id in shard.index.by_id:
+            return shard
+    return None
+
+
+def _version_sequence() -> Sequence:
+    return sequence(VERSIONS, lambda: messages_version() + 1)
+
+
+def _restore_version(message_index: MessageIndex):
+    """ the version of a loaded index is at least the largest version that may have been handed out before """
+    message_index.version = max(message_index.version, _version_sequence().file.read(VERSIONS) - 1)
+
+
+def prefetch_sequences():
+    """ leases the first blocks of the message id and version sequences in the background """
+    for shard in message_shards():
+        shard.sequence.prefetch()
+    _version_sequence().prefetch()
+
+
+def _next_version(shard: Shard) -> int:
+    """ version for a change in the shard, larger than the versions of all shards and of all previous runs """
+    shard.index.version = _version_sequence().next()
+    return shard.index.version
+
+
+@timed(DB_SECONDS, operation="get_messages")
+def get_messages(track: Optional[str] = None, state: Optional[str] = None) -> List[Message]:
+    """ returns the messages (ordered by id), the returned objects must not be modified """
+    track_shards = message_shards(track)
+    if len(track_shards) == 1:
+        return track_shards[0].index.messages(track, state)
+    return list(heapq.merge(*(shard.index.messages(track, state) for shard in track_shards),
+                            key=lambda msg: msg.id))
+
+
+def get_message(id: int) -> Optional[Message]:
+    shard = _shard_of(id)
+    return shard.index.by_id[id] if shard else None
+
+
+@timed(DB_SECONDS, operation="get_changed_messages")
+def get_changed_messages(since: int, track: Optional[str] = None, state: Optional[str] = None,
+                         limit: Optional[int] = None) -> Tuple[List[Message], bool]:
+    """ see MessageIndex.changes """
+    track_shards = message_shards(track)
+    if len(track_shards) == 1:
+        return track_shards[0].index.changes(since, track, state, limit)
+    changes = [shard.index.changes(since, track, state, limit) for shard in track_shards]
+    changed = list(heapq.merge(*(msgs for msgs, _ in changes), key=lambda msg: msg.version))
+    if limit is not None and len(changed) > limit:
+        return changed[:limit], True
+    return changed, any(more for _, more in changes)
+
+
+def get_message_by_external_id(external_id: str) -> Optional[Message]:
+    for shard in message_shards():
+        msg = shard.index.by_external_id.get(external_id)
+        if msg:
+            return msg
+    return None
+
+
+def messages_epoch() -> str:
+    """
+    versions of responses with the same epoch are comparable: with multiple workers the messages
+    of the others get local versions (see apply_remote_record), so every worker process has its own epoch
+    """
+    if config().workers == 1:
+        return "0"
+    return f"{worker_id()}-{_EPOCH}"
 
 
+def messages_version() -> int:
+    return max((shard.index.version for shard in message_shards()), default=0)
+
+
+def add_message(track: str, content: str) -> Message:
+    return add_messages([(track, content, None)])[0]
+
+
+@timed(DB_SECONDS, operation="add_messages")
+def add_messages(messages: List[Tuple[str, str, Optional[str]]]) -> List[Message]:
+    """ adds the (track, content, external id) messages with a single write per shard """
+    msgs: List[Optional[Message]] = [None] * len(messages)
+    positions: Dict[str, Tuple[Shard, List[int]]] = {}
+    for i, (track, _, _) in enumerate(messages):
+        shard = message_shards(track)[0]
+        positions.setdefault(shard.writer, (shard, []))[1].append(i)
+    for shard, shard_positions in positions.values():
+        for id, i in zip(shard.allocate(len(shard_positions)), shard_positions):
+            track, content, external_id = messages[i]
+            msgs[i] = Message(id, track, RAW, time.time(), content, _next_version(shard), external_id)
+        shard_msgs = [msgs[i] for i in shard_positions]
+        for msg, doc_id in zip(shard_msgs, shard.table.insert_multiple([msg.to_dict() for msg in shard_msgs])):
+            shard.index.add(msg, doc_id)
+    invalidate("messages")
+    return msgs
+
+
+@timed(DB_SECONDS, operation="set_state")
 def set_state(id: int, new_state: str):
-    db("messages").update({"state": new_state}, Query().id == id)
+    shard = _shard_of(id)
+    version = _next_version(shard)
+    archived_at = time.time() if new_state == ARCHIVED else None
+    shard.table.update({"state": new_state, "version": version, "archived_at": archived_at},
+                       doc_ids=[shard.index.doc_ids[id]])
+    shard.index.set_state(id, new_state, version, archived_at)
+    invalidate("messages")
 
 
+@timed(DB_SECONDS, operation="set_content")
 def set_content(id: int, content: str):
-    db("messages").update({"content": content}, Query().id == id)
+    shard = _shard_of(id)
+    version = _next_version(shard)
+    shard.table.update({"content": content, "version": version}, doc_ids=[shard.index.doc_ids[id]])
+    msg = shard.index.by_id[id]
+    msg.content = content
+    msg.version = version
+    shard.index.changed(msg)
+    invalidate("messages")
 
 
+@timed(DB_SECONDS, operation="get_host_message")
 def get_host_message(track: str) -> str:
     val = db("host_messages").search(Query().track == track)
     if val:
@@ -61,8 +467,10 @@ def get_host_message(track: str) -> str:
     return ""
 
 
+@timed(DB_SECONDS, operation="set_host_message")
 def set_host_message(track: str, text: str):
     db("host_messages").upsert({"track": track, "text": text}, Query().track == track)
+    invalidate("host_messages")
 
 
 def get_tracks() -> List[str]:
@@ -92,7 +500,7 @@ def validate_track(track: str) -> str:
 
 
 def validate_message_id(id: int) -> int:
-    if not db("messages").search(Query().id == id):
+    if _shard_of(id) is None:
         raise UnknownMessage()
     return id
 
@@ -103,5 +511,26 @@ def validate_state(state: str) -> str:
     return state
 
 
+@timed(DB_SECONDS, operation="delete_old_messages")
 def delete_old_messages():
-    db("messages").remove(Query().time <= time.time() - config().delete_after_days * 24 * 60 * 60)
+    """
+    moves the expired messages (oldest first) and the messages that were archived more than
+    `archive_after_minutes` ago out of the messages table (of every shard), see retention.py
+    """
+    min_time = expiry_time()
+    min_archive_time = time.time() - config().archive_after_minutes * 60
+    for shard in message_shards():
+        shard_index = shard.index
+        expired = list(itertools.takewhile(lambda msg: msg.time <= min_time, shard_index.ordered().values()))
+        archived_at = shard_index.archived()
+        archived_ids = itertools.takewhile(lambda id: archived_at[id] <= min_archive_time, archived_at)
+        # expired messages are only archived if archive_retention_days is set
+        archived = [msg for msg in map(shard_index.by_id.get, list(archived_ids)) if msg.time > min_time]
+        archive().append("messages", [msg.to_dict() for msg in archived + (expired if archive_expired() else [])],
+                         shard.writer)
+        old_ids = [msg.id for msg in expired + archived]
+        if old_ids:
+            shard.table.remove(doc_ids=[shard_index.doc_ids[id] for id in old_ids])
+            for id in old_ids:
+                shard_index.remove(id)
+            invalidate("messages")
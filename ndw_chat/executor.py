@@ -0,0 +1,130 @@
+"""
+Execution layer that keeps blocking work off the aiohttp event loop.
+
+- all file writes of the storage backends run in a single storage writer thread, in the order
+  in which they were submitted (with `shard_tracks` every track has its own writer thread for its messages)
+- blocking calls (like the DNS lookups of the email validation) run in a thread pool
+- CPU heavy work (like encoding the scores) runs in a thread or process pool (`cpu_pool` in Config)
+"""
+
+import asyncio
+import atexit
+import concurrent.futures
+import logging
+import queue
+import threading
+import time
+from typing import Callable, Any, Optional, Dict
+
+from ndw_chat.util import config
+
+
+class StorageWriter:
+    """ single thread that executes the submitted functions in order """
+
+    def __init__(self, name: str = "storage"):
+        self._queue: queue.Queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name=f"{name}-writer", daemon=True)
+        self._thread.start()
+        atexit.register(self.flush)
+
+    def submit(self, func: Callable, *args) -> concurrent.futures.Future:
+        future = concurrent.futures.Future()
+        self._queue.put((func, args, future))
+        return future
+
+    def pending(self) -> int:
+        return self._queue.qsize()
+
+    def flush(self):
+        """ blocks till all previously submitted functions are executed """
+        self.submit(lambda: None).result()
+
+    def _run(self):
+        while True:
+            func, args, future = self._queue.get()
+            try:
+                future.set_result(func(*args))
+            except BaseException as ex:
+                logging.exception(ex)
+                future.set_exception(ex)
+
+
+DEFAULT_WRITER = "storage"
+_storage_writers: Dict[str, StorageWriter] = {}
+
+
+def storage_writer(name: str = DEFAULT_WRITER) -> StorageWriter:
+    if name not in _storage_writers:
+        _storage_writers[name] = StorageWriter(name)
+    return _storage_writers[name]
+
+
+def storage_writers() -> Dict[str, StorageWriter]:
+    return _storage_writers
+
+
+def storage_pending() -> int:
+    """ number of writes queued for all storage writer threads """
+    return sum(writer.pending() for writer in _storage_writers.values())
+
+
+async def storage_barrier(*names: str):
+    """
+    waits till all previously submitted writes of the named storage writers (of all writers if none are
+    passed) are done, without blocking the event loop
+    """
+    writers = [storage_writer(name) for name in names] or list(_storage_writers.values()) or [storage_writer()]
+    await asyncio.gather(*(asyncio.wrap_future(writer.submit(lambda: None)) for writer in writers))
+
+
+_blocking_pool: Optional[concurrent.futures.ThreadPoolExecutor] = None
+_cpu_pool: Optional[concurrent.futures.Executor] = None
+
+
+def blocking_pool() -> concurrent.futures.ThreadPoolExecutor:
+    global _blocking_pool
+    if not _blocking_pool:
+        _blocking_pool = concurrent.futures.ThreadPoolExecutor(max_workers=8, thread_name_prefix="blocking")
+    return _blocking_pool
+
+
+async def run_blocking(func: Callable, *args) -> Any:
+    return await asyncio.get_event_loop().run_in_executor(blocking_pool(), func, *args)
+
+
+async def run_cpu(func: Callable, *args) -> Any:
+    """ func and its arguments have to be picklable if the process pool is used """
+    global _cpu_pool
+    if not _cpu_pool:
+        if config().cpu_pool == "process":
+            _cpu_pool = concurrent.futures.ProcessPoolExecutor(max_workers=config().cpu_workers)
+        else:
+            _cpu_pool = concurrent.futures.ThreadPoolExecutor(max_workers=config().cpu_workers,
+                                                              thread_name_prefix="cpu")
+    return await asyncio.get_event_loop().run_in_executor(_cpu_pool, func, *args)
+
+
+class LoopLagMonitor:
+    """ measures how much later than requested a sleep on the event loop returns """
+
+    def __init__(self, interval: float = 0.1):
+        self.interval = interval
+        self.last = 0.0
+        self.max = 0.0
+        self.mean = 0.0
+        """ exponential moving average """
+
+    async def run(self):
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.last = max(0.0, time.perf_counter() - start - self.interval)
+            self.max = max(self.max, self.last)
+            self.mean = 0.9 * self.mean + 0.1 * self.last
+
+    def stats(self) -> dict:
+        return {"last": self.last, "max": self.max, "mean": self.mean}
+
+
+loop_lag = LoopLagMonitor()
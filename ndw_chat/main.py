@@ -2,20 +2,34 @@
 Based partly by https://stackoverflow.com/a/54908617
 """
 
-import json
+import atexit
+import functools
 import logging
-from typing import List, Dict, Callable
+import os
+import signal
+import sys
+import time
+from typing import Dict, Callable, Optional, Awaitable
 
+from ndw_chat.startup import startup, readiness_middleware
 import aiohttp_cors as aiohttp_cors
-import coloredlogs as coloredlogs
 from aiohttp.abc import Request
 
 import ndw_chat.quiz as quiz
+from ndw_chat.broadcast import ScoreBroadcaster, Subscriptions, Subscriber, EventLog, Event, fanout_stats, \
+    ViewerChannels, Frame, negotiate_protocol
+from ndw_chat.admission import Admission, admitted
+from ndw_chat.bus import create_bus, Bus
+from ndw_chat.cache import cached, response_cache
 from ndw_chat.db import add_message, validate_track, set_state, get_messages, validate_message_id, \
-    validate_state, set_host_message, get_host_message, get_tracks, set_content, delete_old_messages
-from ndw_chat.util import config, to_dict
-
-coloredlogs.install()
+    validate_state, set_host_message, get_host_message, get_tracks, set_content, delete_old_messages, get_message, \
+    get_changed_messages, messages_version, add_messages, get_message_by_external_id, ValidationException, RAW, \
+    set_record_listener, apply_remote_record, message_shards, message_writers, prefetch_sequences, messages_epoch
+from ndw_chat import metrics
+from ndw_chat.executor import storage_barrier, loop_lag, storage_writers, run_blocking
+from ndw_chat.retention import archive, purge_archive, expiry_time, DAY
+from ndw_chat.serialization import dumps, loads
+from ndw_chat.util import config, to_dict, log_sampled, is_primary, worker_id
 
 from aiohttp import web, WSMsgType
 import asyncio
@@ -25,38 +39,147 @@ logging.basicConfig(level=logging.INFO,
                     datefmt='%m-%d %H:%M',
                     )
 
-authenticated_websockets: List[web.WebSocketResponse] = []
+subscriptions = Subscriptions()
+event_log = EventLog()
+viewer_channels = ViewerChannels()
+
 
+def queued_frames() -> int:
+    return sum(len(s.queue) for s in subscriptions.subscribers.values())
 
-async def propagate(command: str, arguments: dict, receiver: web.WebSocketResponse = None):
-    global authenticated_websockets
-    for websocket in ([receiver] if receiver else authenticated_websockets):
-        await websocket.send_json({"command": command, "arguments": arguments})
 
+admission = Admission(queued_frames)
 
-async def handle_set_state(source: web.WebSocketResponse, arguments: dict):
-    set_state(validate_message_id(arguments["id"]), validate_state(arguments["state"]))
-    await propagate("set_state", arguments)
+HTTP_SECONDS = metrics.histogram("ndw_http_request_seconds", "duration of the HTTP handlers")
+COMMAND_SECONDS = metrics.histogram("ndw_command_seconds", "duration of the websocket commands")
+COMMAND_ERRORS = metrics.counter("ndw_command_errors_total", "websocket commands that raised an exception")
+PROPAGATE_SECONDS = metrics.histogram("ndw_propagate_seconds", "duration of serializing and enqueueing a command")
+PROPAGATED_FRAMES = metrics.counter("ndw_propagated_frames_total", "frames enqueued for websocket clients")
+metrics.gauge("ndw_websocket_clients", "authenticated websocket clients", lambda: len(subscriptions.subscribers))
+metrics.gauge("ndw_viewer_streams", "server-sent event streams of viewers", lambda: viewer_channels.count())
+metrics.gauge("ndw_queued_frames", "frames queued for all websocket clients", queued_frames)
+metrics.gauge("ndw_fanout_frames", "sent, dropped and coalesced frames and evicted clients since the start",
+              lambda: {metrics.labels(kind=kind): value for kind, value in vars(fanout_stats).items()})
+metrics.gauge("ndw_event_loop_lag_seconds", "lag of the event loop (last, max and moving average)",
+              lambda: {metrics.labels(stat=stat): value for stat, value in loop_lag.stats().items()})
+metrics.gauge("ndw_storage_writer_pending", "writes queued for the storage writer threads",
+              lambda: {metrics.labels(writer=name): writer.pending() for name, writer in storage_writers().items()})
+metrics.gauge("ndw_response_cache_entries", "cached responses", lambda: len(response_cache().entries))
+metrics.gauge("ndw_bus_messages", "messages published to and received from the other workers",
+              lambda: {metrics.labels(direction="published"): bus().published,
+                       metrics.labels(direction="received"): bus().received})
 
 
-async def handle_set_content(source: web.WebSocketResponse, arguments: dict):
+async def propagate(command: str, arguments: dict, receiver: Subscriber = None,
+                    track: Optional[str] = None, state: Optional[str] = None, skip_state: Optional[str] = None,
+                    publish: bool = True, frame: Optional[Frame] = None):
+    """
+    enqueues the command for the receiver or for all subscribers of the track (all subscribers if None),
+    see Subscriptions.receivers for the state filters, events for tracks are added to the event log
+    and published to the other workers if publish is set, frame is the already encoded frame of
+    a command without track
+    """
+    start = time.perf_counter()
+    if publish and not receiver:
+        bus().publish({"type": "propagate", "command": command, "arguments": arguments, "track": track,
+                       "state": state, "skip_state": skip_state})
+    # these commands contain the whole state, so older queued frames can be replaced
+    coalesce_key = f"{command}:{track}" if command in COALESCED_COMMANDS else None
+    if track and not receiver:
+        seq = event_log.next_seq()
+        frame = Frame({"command": command, "arguments": arguments, "seq": seq})
+        event_log.add(Event(seq, frame, track, state, skip_state, coalesce_key))
+    elif frame is None:
+        frame = Frame({"command": command, "arguments": arguments})
+    receivers = [receiver] if receiver else subscriptions.receivers(track, state, skip_state)
+    # encode once per protocol of the receivers, not in their writer tasks
+    for protocol in {subscriber.protocol for subscriber in receivers}:
+        frame.encode(protocol)
+    for subscriber in receivers:
+        subscriber.send(frame, coalesce_key)
+    PROPAGATE_SECONDS.observe(time.perf_counter() - start, command=command)
+    PROPAGATED_FRAMES.inc(len(receivers), command=command)
+
+
+COALESCED_COMMANDS = {"set_current_question", "set_host_message", "scores"}
+
+
+def _send_scores_frame(frame: Frame) -> Awaitable:
+    return propagate(frame.message["command"], frame.message["arguments"], publish=False, frame=frame)
+
+
+# every worker broadcasts the deltas of its own scores
+score_broadcaster = ScoreBroadcaster(lambda: quiz.user_scores(limit=config().score_broadcast_limit or None),
+                                     _send_scores_frame,
+                                     lambda: {subscriber.protocol for subscriber in subscriptions.subscribers.values()})
+quiz.set_engine_listener(score_broadcaster.schedule)
+
+
+def handle_bus_message(message: dict):
+    """ applies the journal records and propagates the events of the other workers """
+    if not startup.is_ready():
+        # the tables are still loaded in another thread
+        startup.defer(functools.partial(handle_bus_message, message))
+        return
+    if message["type"] == "records":
+        scores_changed = False
+        for record in message["records"]:
+            scores_changed |= quiz.apply_remote_record(record, apply_remote_record(record))
+        if scores_changed and config().has_quiz:
+            score_broadcaster.schedule()
+    elif message["type"] == "propagate":
+        asyncio.ensure_future(propagate(message["command"], message["arguments"], track=message["track"],
+                                        state=message["state"], skip_state=message["skip_state"], publish=False))
+        if message["command"] == "set_current_question":
+            publish_viewer_question(message["track"])
+
+
+_bus: Optional[Bus] = None
+
+
+def bus() -> Bus:
+    global _bus
+    if _bus is None:
+        _bus = create_bus(handle_bus_message)
+        if config().workers > 1:
+            set_record_listener(lambda record: _bus.publish({"type": "records", "records": [record]}))
+    return _bus
+
+
+async def handle_set_state(source: Subscriber, arguments: dict):
+    msg = get_message(validate_message_id(arguments["id"]))
+    prev_state = msg.state
+    set_state(msg.id, validate_state(arguments["state"]))
+    await propagate("set_state", arguments, track=msg.track, state=prev_state)
+    # subscribers that did not show the message before, did not receive it yet
+    await propagate("push_message", msg.to_dict(), track=msg.track, state=msg.state, skip_state=prev_state)
+
+
+async def handle_set_content(source: Subscriber, arguments: dict):
     set_content(validate_message_id(arguments["id"]), arguments["content"])
-    await propagate("set_content", arguments)
+    msg = get_message(arguments["id"])
+    await propagate("set_content", arguments, track=msg.track, state=msg.state)
 
 
-async def handle_set_host_message(source: web.WebSocketResponse, arguments: dict):
+async def handle_set_host_message(source: Subscriber, arguments: dict):
     set_host_message(arguments["track"], arguments["message"])
-    await propagate("set_host_message", arguments)
+    await propagate("set_host_message", arguments, track=arguments["track"])
 
 
-async def handle_set_current_question(source: web.WebSocketResponse, query: dict):
+async def handle_set_current_question(source: Subscriber, query: dict):
     quiz.set_current_question(query["track"], query["question_id"])
     await propagate_current_question(query["track"])
+    publish_viewer_question(query["track"])
 
 
-async def handle_enable_current_question(source: web.WebSocketResponse, query: dict):
+async def handle_enable_current_question(source: Subscriber, query: dict):
     quiz.enable_current_question(query["track"], bool(query["enabled"]))
     await propagate_current_question(query["track"])
+    publish_viewer_question(query["track"])
+
+
+async def handle_get_scores(source: Subscriber, arguments: dict):
+    await propagate("scores", score_broadcaster.current(), source)
 
 
 SERVER_COMMANDS = {
@@ -64,23 +187,96 @@ SERVER_COMMANDS = {
     "set_content": handle_set_content,
     "set_host_message": handle_set_host_message,
     "set_current_question": handle_set_current_question,
-    "enable_current_question": handle_enable_current_question
+    "enable_current_question": handle_enable_current_question,
+    "get_scores": handle_get_scores
 }
 
 
+def _valid_length(content: str) -> bool:
+    return 2 <= len(content) <= config().length_limit
+
+
+@metrics.timed(HTTP_SECONDS, handler="send")
+@admitted(admission, "send")
 async def http_handler(request: Request):
-    query = await request.json()
+    query = await request.json(loads=loads)
     track = query["track"]
     content = query["content"]
-    if len(content) > config().length_limit or len(content) < 2:
-        logging.info("Discard message that is too long")
+    if not _valid_length(content):
+        log_sampled("Discard message that is too long")
         return web.Response(status=406)
     msg = add_message(validate_track(track), content)
-    logging.info(f"New message in {msg.track}: {msg.content}")
-    await propagate("push_message", msg.to_dict())
+    log_sampled(f"New message in {msg.track}: {msg.content}")
+    await propagate("push_message", msg.to_dict(), track=msg.track, state=msg.state)
+    await storage_barrier(*message_writers([msg.track]))
     return web.Response(text="ok")
 
 
+def _valid_batch_item(item) -> bool:
+    """ whether the item has a string track and content and an optional string external_id """
+    return isinstance(item, dict) and isinstance(item.get("track"), str) and isinstance(item.get("content"), str) \
+        and isinstance(item.get("external_id", ""), (str, type(None)))
+
+
+def _batch_items(body) -> Optional[list]:
+    return body.get("messages") if isinstance(body, dict) and isinstance(body.get("messages"), list) else None
+
+
+async def _batch_tokens(request: Request) -> int:
+    """ one admission token per message, batches with more than max_batch_size messages get a 413 """
+    items = _batch_items(await request.json(loads=loads)) or []
+    if len(items) > config().max_batch_size:
+        raise web.HTTPRequestEntityTooLarge(max_size=config().max_batch_size, actual_size=len(items))
+    return max(len(items), 1)
+
+
+@metrics.timed(HTTP_SECONDS, handler="send_batch")
+@admitted(admission, "send_batch", tokens=_batch_tokens)
+async def http_batch_handler(request: Request):
+    """
+    adds a list of messages ({"track", "content", optional "external_id"}) at once and returns
+    a result per message, messages with an already known external id and malformed messages are skipped
+    """
+    items = _batch_items(await request.json(loads=loads))
+    if items is None:
+        return web.Response(status=400)
+    results = []
+    new_messages = []
+    external_ids = set()
+    for item in items:
+        if not _valid_batch_item(item):
+            results.append({"success": False, "error": "invalid"})
+            continue
+        external_id = item.get("external_id")
+        if external_id is not None:
+            known = get_message_by_external_id(external_id)
+            if known or external_id in external_ids:
+                results.append({"success": False, "error": "duplicate", "id": known.id if known else None})
+                continue
+        try:
+            validate_track(item["track"])
+        except ValidationException:
+            results.append({"success": False, "error": "unknown_track"})
+            continue
+        if not _valid_length(item["content"]):
+            results.append({"success": False, "error": "length"})
+            continue
+        external_ids.add(external_id)
+        results.append({"success": True})
+        new_messages.append((item["track"], item["content"], external_id))
+    msgs = iter(add_messages(new_messages) if new_messages else [])
+    for result in results:
+        if result["success"]:
+            result["id"] = next(msgs).id
+    log_sampled(f"Added {len(new_messages)} of {len(items)} messages")
+    added = [get_message(result["id"]) for result in results if result["success"]]
+    for track in {msg.track for msg in added}:
+        await propagate("push_messages", {"messages": [msg.to_dict() for msg in added if msg.track == track]},
+                        track=track, state=RAW)
+    await storage_barrier(*message_writers({msg.track for msg in added}))
+    return web.Response(text=dumps({"results": results}), content_type="application/json")
+
+
 HANDLERS: Dict[str, Callable] = {}
 
 
@@ -89,7 +285,7 @@ def register_handler(location: str):
 
     def wrapper(func):
         assert location not in HANDLERS
-        HANDLERS[location] = func
+        HANDLERS[location] = metrics.timed(HTTP_SECONDS, handler=location)(func)
         return func
 
     return wrapper
@@ -106,7 +302,7 @@ def authenticated_request(func):
         if "password" not in query or query["password"] != config().password:
             logging.error("Authentication unsuccessful")
             return web.Response(status=406)
-        return web.Response(text=json.dumps(await func(query)),
+        return web.Response(text=dumps(await func(query)),
                             content_type="application/json")
     return wrapper
 
@@ -117,24 +313,64 @@ def unauthenticated_request(func):
     """
     async def wrapper(request: Request):
         query = request.query
-        return web.Response(text=json.dumps(await func(query)),
+        return web.Response(text=dumps(await func(query)),
                             content_type="application/json")
     return wrapper
 
 
 @register_handler("messages")
+@cached("messages")
 @authenticated_request
 async def get_messages_handler(query: dict):
-    return [msg.to_dict() for msg in sorted(get_messages(), key=lambda v: v.id)]
+    """
+    all messages (optionally filtered by track and state) or, if since is passed, the messages
+    that changed after this version, at most limit (at least 1) messages per call; since is only
+    valid with the epoch of its response, with another epoch all messages are returned from the
+    start with "resync": true (the client drops its messages)
+    """
+    track = query.get("track")
+    state = query.get("state")
+    if "since" not in query:
+        return [msg.to_dict() for msg in get_messages(track, state)]
+    limit = max(int(query["limit"]), 1) if "limit" in query else None
+    resync = query.get("epoch", messages_epoch()) != messages_epoch()
+    messages, more = get_changed_messages(0 if resync else int(query["since"]), track, state, limit)
+    return {"messages": [msg.to_dict() for msg in messages],
+            "version": messages[-1].version if more else messages_version(),
+            "more": more, "epoch": messages_epoch(), "resync": resync}
+
+
+@register_handler("archive")
+@authenticated_request
+async def get_archive_handler(query: dict):
+    """
+    archived records of the table (default: messages) of the days since till until (YYYY-MM-DD),
+    optionally filtered by track and state, at most limit records
+    """
+    table = query.get("table", "messages")
+    if table not in ["messages", "quiz_answers", "quiz_users"]:
+        return {"error": "unknown table"}
+    min_time = expiry_time() - config().archive_retention_days * DAY
+    track = query.get("track")
+    state = query.get("state")
+
+    def matches(doc: dict) -> bool:
+        return doc["time"] > min_time and (track is None or doc.get("track") == track) and \
+               (state is None or doc.get("state") == state)
+
+    return await run_blocking(archive().query, table, query.get("since"), query.get("until"), matches,
+                              int(query["limit"]) if "limit" in query else None)
 
 
 @register_handler("host_message")
+@cached("host_messages")
 @authenticated_request
 async def get_host_message_handler(query: dict):
     return {"message": get_host_message(track=query["track"])}
 
 
 @register_handler("tracks")
+@cached()
 @unauthenticated_request
 async def get_tracks_handler(query: dict):
     return {"tracks": get_tracks()}
@@ -147,9 +383,11 @@ async def get_check_password_handler(query: dict):
 
 
 @register_handler("register_quiz_user")
+@admitted(admission, "register_quiz_user")
 @unauthenticated_request
 async def register_quiz_user_handler(query: dict):
-    user_id = quiz.register_user(query["pseudonym"], query["email"])
+    user_id = await quiz.register_user(query["pseudonym"], query["email"])
+    await storage_barrier()
     return {"success": user_id is not None, "user_id": user_id}
 
 
@@ -163,7 +401,12 @@ async def user_registered_handler(query: dict):
     return {"registered": False}
 
 
+def _registered_quiz_user(user_id: str) -> bool:
+    return user_id.isdigit() and quiz.get_user(int(user_id)) is not None
+
+
 @register_handler("submit_quiz_answer")
+@admitted(admission, "submit_quiz_answer", quiz_user=_registered_quiz_user)
 @unauthenticated_request
 async def submit_quiz_answer_handler(query: dict):
     user_id = int(query["user_id"])
@@ -171,91 +414,157 @@ async def submit_quiz_answer_handler(query: dict):
     if quiz.answered(user_id, question_id):
         return {"success": False, "already_answered": True}
     answer = quiz.add_answer(user_id, question_id, query["answer"])
-    await propagate("scores", quiz.user_scores().to_dict())
+    if answer:
+        score_broadcaster.schedule()
+        await storage_barrier()
     return {"success": answer is not None, "already_answered": False}
 
 
 
+def _viewer_question(track: str) -> Optional[quiz.QuizQuestion]:
+    """ the current question of the track if it is enabled """
+    if not quiz.is_current_question_enabled(track):
+        return None
+    return quiz.get_current_question(track)
+
+
 @register_handler("unanswered_question")
-@unauthenticated_request
-async def get_unanswered_question_handler(query: dict):
+async def get_unanswered_question_handler(request: Request):
+    """
+    the current question (if it is enabled and not answered by the passed user), supports
+    If-None-Match with the ETag of the previous response
+    """
+    query = request.query
     track = query["track"]
-    cur_q = quiz.get_current_question(track)
-    success_return = {"question": None}
-    if not quiz.is_current_question_enabled(track):
-        return {"question": None}
-    if "user_id" in query:
-        user_id = int(query["user_id"])
-        if cur_q and not quiz.answered(user_id, cur_q.id):
-            return {"question": cur_q.to_dict()}
-        return {"question": None}
-    else:
-        return {"question": cur_q.to_dict()}
+    cur_q = _viewer_question(track)
+    if cur_q and "user_id" in query and quiz.answered(int(query["user_id"]), cur_q.id):
+        cur_q = None
+    etag = f'"{event_log.epoch}-{quiz.current_question_version(track)}-{cur_q.id if cur_q else ""}"'
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if etag in [tag.strip() for tag in request.headers.get("If-None-Match", "").split(",")]:
+        return web.Response(status=304, headers=headers)
+    return web.Response(text=dumps({"question": to_dict(cur_q)}), content_type="application/json",
+                        headers=headers)
 
 
 @register_handler("scores")
+@cached("scores")
 @authenticated_request
 async def get_scores_handler(query: dict):
-    return quiz.user_scores().to_dict()
+    """ the ranking from the optional "offset" with at most "limit" users and the number of ranked users """
+    offset = max(int(query.get("offset", 0)), 0)
+    limit = max(int(query["limit"]), 0) if "limit" in query else None
+    return {**quiz.user_scores(offset, limit).to_dict(), "total": quiz.ranked_users()}
 
 
-def _get_current_question_dict(track: str):
-    return {"current": to_dict(quiz.get_current_question(track)),
-            "next": to_dict(quiz.get_next_question(track)),
-            "prev": to_dict(quiz.get_prev_question(track)),
-            "current_enabled": quiz.is_current_question_enabled(track)}
+@register_handler("my_rank")
+@cached("scores")
+@unauthenticated_request
+async def get_my_rank_handler(query: dict):
+    """ rank (starting at 1, None before the first answer) and score of the quiz user "user_id" """
+    rank = quiz.user_rank(int(query["user_id"]))
+    return {"rank": rank[0] + 1 if rank else None, "score": rank[1] if rank else None,
+            "total": quiz.ranked_users()}
 
 
 @register_handler("current_question")
+@cached("current_question")
 @unauthenticated_request
 async def get_current_question_handler(query: dict):
-    return _get_current_question_dict(query["track"])
+    return quiz.current_question_dict(query["track"])
+
+
+def publish_viewer_question(track: str):
+    viewer_channels.publish(track, "question", {"track": track, "question": to_dict(_viewer_question(track))})
+
+
+async def quiz_events_handler(request: Request):
+    """
+    unauthenticated server-sent event stream of the enabled current question of a track, sends
+    a "question" event on connect and on every change (see publish_viewer_question)
+    """
+    track = request.query.get("track")
+    if track not in get_tracks():
+        return web.Response(status=406)
+    response = web.StreamResponse(headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache",
+                                           "X-Accel-Buffering": "no"})
+    await response.prepare(request)
+    viewer = viewer_channels.add(track, viewer_channels.encode(
+        "question", {"track": track, "question": to_dict(_viewer_question(track))}))
+    try:
+        while True:
+            # the comment keeps proxies from closing idle streams
+            await response.write(await viewer.next(timeout=15) or b": ping\n\n")
+    except ConnectionResetError:
+        pass
+    finally:
+        viewer_channels.remove(viewer)
+    return response
 
 
 async def propagate_current_question(track: str, receiver=None):
     await propagate("set_current_question", {
         "track": track,
-        "question": _get_current_question_dict(track)
-    }, receiver)
+        "question": quiz.current_question_dict(track)
+    }, receiver, track=track)
+
+
+@register_handler("stats")
+@authenticated_request
+async def get_stats_handler(query: dict):
+    return {"fanout": subscriptions.stats(), "loop_lag": loop_lag.stats()}
 
 
 @register_handler("has_quiz")
+@cached()
 @unauthenticated_request
-async def get_has_quiz_handler():
+async def get_has_quiz_handler(query: dict):
     return {"has_quiz": config().has_quiz}
 
 
-async def propagate_initial_quiz_info(receiver: web.WebSocketResponse):
+async def propagate_initial_quiz_info(receiver: Subscriber):
     if config().has_quiz:
-        await propagate("scores", quiz.user_scores().to_dict(), receiver)
+        await propagate("scores", score_broadcaster.current(), receiver)
         for track_conf in config().tracks:
-            await propagate_current_question(track_conf.name, receiver)
+            if receiver.tracks is None or track_conf.name in receiver.tracks:
+                await propagate_current_question(track_conf.name, receiver)
         await propagate("has_quiz", {"has_quiz": True}, receiver)
 
 
 async def websocket_handler(request: Request):
-    ws = web.WebSocketResponse(autoping=True, heartbeat=10000)
+    ws = web.WebSocketResponse(autoping=True, heartbeat=10000, compress=config().websocket_compression)
     await ws.prepare(request)
     try:
         msg = await ws.receive()
         logging.info(f"Initial request {msg}")
-        if msg.type == WSMsgType.TEXT and json.loads(msg.data)["password"] == config().password:
+        initial = loads(msg.data) if msg.type == WSMsgType.TEXT else {}
+        if initial.get("password") == config().password:
             logging.info(f"Authentication successful")
         else:
             logging.error("Authentication unsuccessful")
             return
-        authenticated_websockets.append(ws)
+        # optional subscription to specific tracks and message states and optional "msgpack" protocol
+        subscriber = Subscriber(ws, initial.get("tracks"), initial.get("states"),
+                                negotiate_protocol(initial.get("protocol")))
+        subscriptions.add(subscriber)
+        resume = initial.get("resume") or {}
+        missed_events = event_log.since(resume.get("epoch"), resume.get("seq", 0)) if resume else None
+        await propagate("hello", {"epoch": event_log.epoch, "seq": event_log.seq,
+                                  "resumed": missed_events is not None, "protocol": subscriber.protocol}, subscriber)
+        for event in missed_events or []:
+            if subscriber.receives(event.track, event.state, event.skip_state):
+                subscriber.send(event.frame, event.coalesce_key)
         try:
             await asyncio.sleep(0.02)
-            await propagate_initial_quiz_info(ws)
+            await propagate_initial_quiz_info(subscriber)
         except:
             pass
         while True:
             msg = await ws.receive()
-            if (msg.type == WSMsgType.TEXT and msg.data == 'close') or msg.type == WSMsgType.CLOSE:
+            if (msg.type == WSMsgType.TEXT and msg.data == 'close') or \
+                    msg.type in [WSMsgType.CLOSE, WSMsgType.CLOSING, WSMsgType.CLOSED, WSMsgType.ERROR]:
                 await ws.close()
                 logging.info("Closed connection")
-                authenticated_websockets.remove(ws)
                 break
             if msg.type == WSMsgType.PING or str(msg.data) == '{"kind":"ping"}':
                 await ws.pong(msg.data)
@@ -263,23 +572,47 @@ async def websocket_handler(request: Request):
             if msg.type == WSMsgType.PONG:
                 await ws.ping(msg.data)
                 continue
-            parsed_msg = json.loads(msg.data)
+            parsed_msg = loads(msg.data)
             command = parsed_msg["command"]
             arguments = parsed_msg["arguments"]
-            logging.info(f"Execute command {command} with arguments {arguments}")
+            log_sampled(f"Execute command {command} with arguments {arguments}")
             try:
-                await SERVER_COMMANDS[command](ws, arguments)
+                handler = SERVER_COMMANDS[command]
+                with COMMAND_SECONDS.time(command=command):
+                    await handler(subscriber, arguments)
             except BaseException as ex:
+                COMMAND_ERRORS.inc(command=command if command in SERVER_COMMANDS else "unknown")
                 logging.exception(ex)
     except Exception as ex:
         logging.exception(ex)
+    finally:
+        subscriptions.remove(ws)
+
+
+async def ready_handler(request: Request):
+    """ 200 once the tables and the quiz are loaded, 503 before, see startup.py """
+    return web.Response(status=200 if startup.is_ready() else 503, text=dumps(startup.to_dict()),
+                        content_type="application/json")
+
+
+async def metrics_handler(request: Request):
+    """ metrics in the Prometheus text format, the password is passed as query parameter or bearer token """
+    if request.query.get("password", request.headers.get("Authorization", "")[len("Bearer "):]) != config().password:
+        logging.error("Authentication unsuccessful")
+        return web.Response(status=406)
+    return web.Response(text=metrics.render(), content_type="text/plain", charset="utf-8",
+                        headers={"X-Content-Type-Options": "nosniff"})
 
 
 def create_runner(path: str = ""):
-    app = web.Application()
+    app = web.Application(middlewares=[readiness_middleware({path + '/ready', path + '/metrics'})])
     cors = aiohttp_cors.setup(app)
     routes = app.add_routes([
                                 web.post(path + '/send', http_handler),
+                                web.post(path + '/send_batch', http_batch_handler),
+                                web.get(path + '/ready', ready_handler),
+                                web.get(path + '/metrics', metrics_handler),
+                                web.get(path + '/quiz_events', quiz_events_handler),
                                 web.get(path + '/ws', websocket_handler)
                             ] + [web.get(path + "/" + location, handler) for location, handler in HANDLERS.items()])
     for r in routes:
@@ -287,26 +620,76 @@ def create_runner(path: str = ""):
     return web.AppRunner(app)
 
 
-async def start_server(host="127.0.0.1"):
+def load_data():
+    """ loads the tables and the quiz, blocks """
+    message_shards()
+    prefetch_sequences()
+    if config().has_quiz:
+        quiz.quiz()
+        quiz.quiz_index()
+        quiz.quiz_state()
+        quiz.scoring_engine()
+        quiz.user_sequence().prefetch()
+
+
+async def start_server(host="127.0.0.1") -> web.AppRunner:
+    """ binds the port first and then loads the data in another thread, requests wait for it (see startup.py) """
     runner = create_runner(config().path)
     await runner.setup()
-    site = web.TCPSite(runner, host, config().port)
+    site = web.TCPSite(runner, host, config().port, reuse_port=config().workers > 1)
     await site.start()
+    startup.listening()
+    asyncio.ensure_future(loop_lag.run())
+    try:
+        # subscribe before loading the tables, so that no record of the other workers is missed
+        await bus().start()
+        await run_blocking(load_data)
+    except BaseException:
+        startup.failed()
+        raise
+    startup.set_ready()
+    return runner
 
 
 async def delete_old_data():
+    """ runs on the primary worker, the others apply its removals """
     while True:
         delete_old_messages()
         quiz.delete_old_users_and_answers()
+        purge_archive()
         await asyncio.sleep(100)
 
 
+def start_workers():
+    """ starts the workers 1 to workers - 1 as child processes of the primary """
+    import subprocess
+    workers = [subprocess.Popen([sys.executable, "-m", "ndw_chat.main"], env={**os.environ, "NDW_WORKER_ID": str(i)})
+               for i in range(1, config().workers)]
+    atexit.register(lambda: [worker.terminate() for worker in workers])
+    # exit (and run the atexit handlers) on SIGTERM too
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+
 def cli():
-    if config().has_quiz:
-        quiz.quiz()
+    import coloredlogs
+    coloredlogs.install()
+    if config().workers > 1:
+        if config().bus == "local":
+            logging.error("Multiple workers need a shared bus (bus: resp)")
+            exit(1)
+        if is_primary() and "NDW_WORKER_ID" not in os.environ:
+            start_workers()
+        logging.info(f"Starting worker {worker_id()} of {config().workers}")
+    if config().shard_tracks and (config().workers > 1 or config().storage != "journal"):
+        logging.error("shard_tracks needs the journal storage and a single worker")
+        exit(1)
+    if config().has_quiz and not quiz.quiz_file().exists():
+        quiz.write_quiz_template()
+        exit(0)
     loop = asyncio.new_event_loop()
     loop.run_until_complete(start_server(config().host))
-    loop.run_until_complete(delete_old_data())
+    if is_primary():
+        loop.run_until_complete(delete_old_data())
     loop.run_forever()
 
 
@@ -0,0 +1,178 @@
+"""
+Minimal in-process metrics registry with counters, histograms and gauges that is rendered in the
+Prometheus text format on the authenticated /metrics endpoint.
+
+Observing a value only updates a few numbers on the event loop thread, so it is cheap enough for
+the hot paths (handlers, websocket commands, storage operations and the fan-out).
+"""
+
+import asyncio
+import bisect
+import functools
+import time
+from contextlib import contextmanager
+from typing import Dict, Tuple, List, Callable, Union
+
+Labels = Tuple[Tuple[str, str], ...]
+
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+
+
+def _labels(labels: Dict[str, object]) -> Labels:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _format_labels(labels: Labels) -> str:
+    if not labels:
+        return ""
+    escaped = (v.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for _, v in labels)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(labels, escaped)) + "}"
+
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class Metric:
+
+    type = "untyped"
+
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+
+    def samples(self) -> List[Tuple[str, Labels, float]]:
+        raise NotImplementedError()
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        lines.extend(f"{name}{_format_labels(labels)} {_format_value(value)}" for name, labels, value in self.samples())
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+
+    type = "counter"
+
+    def __init__(self, name: str, help: str):
+        super().__init__(name, help)
+        self.values: Dict[Labels, float] = {}
+
+    def inc(self, value: float = 1, **labels):
+        key = _labels(labels)
+        self.values[key] = self.values.get(key, 0) + value
+
+    def samples(self) -> List[Tuple[str, Labels, float]]:
+        return [(self.name, labels, value) for labels, value in self.values.items()]
+
+
+class Histogram(Metric):
+
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, help)
+        self.buckets = buckets
+        self.counts: Dict[Labels, List[int]] = {}
+        """ labels → count per bucket (not cumulative), the last entry is the +Inf bucket """
+        self.sums: Dict[Labels, float] = {}
+
+    def observe(self, value: float, **labels):
+        key = _labels(labels)
+        counts = self.counts.get(key)
+        if counts is None:
+            counts = self.counts[key] = [0] * (len(self.buckets) + 1)
+            self.sums[key] = 0
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sums[key] += value
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self) -> List[Tuple[str, Labels, float]]:
+        samples = []
+        for labels, counts in self.counts.items():
+            cumulative = 0
+            for bound, count in zip(list(self.buckets) + ["+Inf"], counts):
+                cumulative += count
+                samples.append((f"{self.name}_bucket", labels + (("le", str(bound)),), cumulative))
+            samples.append((f"{self.name}_sum", labels, self.sums[labels]))
+            samples.append((f"{self.name}_count", labels, cumulative))
+        return samples
+
+
+class Gauge(Metric):
+    """ value that is computed when the metrics are rendered """
+
+    type = "gauge"
+
+    def __init__(self, name: str, help: str, compute: Callable[[], Union[float, Dict[Labels, float]]]):
+        super().__init__(name, help)
+        self.compute = compute
+
+    def samples(self) -> List[Tuple[str, Labels, float]]:
+        value = self.compute()
+        if isinstance(value, dict):
+            return [(self.name, labels, v) for labels, v in value.items()]
+        return [(self.name, (), value)]
+
+
+_metrics: Dict[str, Metric] = {}
+
+
+def _register(metric: Metric) -> Metric:
+    assert metric.name not in _metrics
+    _metrics[metric.name] = metric
+    return metric
+
+
+def counter(name: str, help: str) -> Counter:
+    return _register(Counter(name, help))
+
+
+def histogram(name: str, help: str, buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+    return _register(Histogram(name, help, buckets))
+
+
+def gauge(name: str, help: str, compute: Callable[[], Union[float, Dict[Labels, float]]]) -> Gauge:
+    """ compute returns the value or a dict that maps the labels (see `labels`) to values """
+    return _register(Gauge(name, help, compute))
+
+
+def labels(**labels) -> Labels:
+    return _labels(labels)
+
+
+def timed(metric: Histogram, **labels):
+    """ decorator that observes the duration of every call of the (sync or async) function """
+
+    def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    metric.observe(time.perf_counter() - start, **labels)
+        else:
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    metric.observe(time.perf_counter() - start, **labels)
+        return wrapper
+
+    return decorator
+
+
+def render() -> str:
+    """ all metrics in the Prometheus text exposition format """
+    return "\n".join(metric.render() for metric in _metrics.values()) + "\n"
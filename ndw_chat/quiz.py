@@ -1,21 +1,29 @@
+import asyncio
+import itertools
 import logging
 import statistics
 import time
 from dataclasses import dataclass, field
-from random import random
-from typing import Optional, List, Dict, Set
+from pathlib import Path
+from typing import Optional, List, Dict, Set, Tuple, Callable
 
 import yaml
 from dataclasses_json import dataclass_json  #
-from email_validator import validate_email, EmailNotValidError
 from tinydb import Query
 
+from ndw_chat.cache import invalidate
 from ndw_chat.db import db
-from ndw_chat.util import base_path, config
+from ndw_chat.executor import run_blocking
+from ndw_chat.retention import archive, expiry_time, archive_expired
+from ndw_chat.scoring import ScoringEngine, parse_float
+from ndw_chat.sequences import sequence, Sequence
+from ndw_chat.serialization import fast_dict, SLOTS
+from ndw_chat.util import base_path, config, log_sampled, to_dict, is_primary
 
 
+@fast_dict
 @dataclass_json
-@dataclass
+@dataclass(**SLOTS)
 class QuizUser:
     id: int
     pseudonym: str
@@ -23,8 +31,9 @@ class QuizUser:
     time: float
 
 
+@fast_dict
 @dataclass_json
-@dataclass
+@dataclass(**SLOTS)
 class QuizAnswer:
     answer: str
     question: int
@@ -32,8 +41,9 @@ class QuizAnswer:
     time: float
 
 
+@fast_dict
 @dataclass_json
-@dataclass
+@dataclass(**SLOTS)
 class QuizQuestion:
     track: str
     slot: int
@@ -58,15 +68,17 @@ class Quiz:
                                                                                 ["A", "B", "C"], "A")])
 
 
+@fast_dict
 @dataclass_json
-@dataclass
+@dataclass(**SLOTS)
 class QuizUserScore:
     user: QuizUser
     score: float
 
 
+@fast_dict
 @dataclass_json
-@dataclass
+@dataclass(**SLOTS)
 class QuizUserScores:
     scores: List[QuizUserScore]
     """ first has largest score """
@@ -79,56 +91,139 @@ QUIZ_FILE = "quiz.yaml"
 _quiz: Optional[Quiz] = None
 
 
+def quiz_file() -> Path:
+    return base_path() / QUIZ_FILE
+
+
 def quiz() -> Quiz:
+    """ the quiz of the quiz file, a quiz without questions if there is no quiz file """
     global _quiz
     if _quiz:
         return _quiz
-    quiz_file = base_path() / QUIZ_FILE
-    if quiz_file.exists():
-        with quiz_file.open() as f:
-            _quiz = Quiz.from_dict(yaml.safe_load(f))
-            for i, question in enumerate(_quiz.questions):
-                question.id = i
-                assert (question.estimation is None) ^ (question.choice is None)
-            return _quiz
-    else:
-        with quiz_file.open("w") as f:
-            yaml.dump(Quiz().to_dict(), f)
-            print(f"Please update the template quiz file at {quiz_file}")
-        exit(0)
+    if not quiz_file().exists():
+        logging.warning(f"There is no quiz file at {quiz_file()}")
+        _quiz = Quiz([])
+        return _quiz
+    with quiz_file().open() as f:
+        _quiz = Quiz.from_dict(yaml.safe_load(f))
+        for i, question in enumerate(_quiz.questions):
+            question.id = i
+            assert (question.estimation is None) ^ (question.choice is None)
+        return _quiz
+
+
+def write_quiz_template():
+    with quiz_file().open("w") as f:
+        yaml.dump(Quiz().to_dict(), f)
+        print(f"Please update the template quiz file at {quiz_file()}")
+
+
+class QuizIndex:
+    """
+    Resident index of the quiz_users and quiz_answers tables: users by id, pseudonym and email and
+    the answered (user, question) pairs. It is only modified together with the tables.
+    """
+
+    def __init__(self):
+        self.users: Dict[int, QuizUser] = {}
+        self.by_pseudonym: Dict[str, QuizUser] = {}
+        self.by_email: Dict[str, QuizUser] = {}
+        self.answered: Dict[Tuple[int, int], int] = {}
+        """ (user id, question id) → number of stored answers, more than one only till the primary removed them """
+
+    def add_user(self, user: QuizUser):
+        self.users[user.id] = user
+        self.by_pseudonym[user.pseudonym] = user
+        self.by_email[user.email] = user
+
+    def remove_user(self, id: int):
+        user = self.users.pop(id, None)
+        if user:
+            if self.by_pseudonym.get(user.pseudonym) is user:
+                del self.by_pseudonym[user.pseudonym]
+            if self.by_email.get(user.email) is user:
+                del self.by_email[user.email]
+
+    def add_answer(self, answer: QuizAnswer):
+        key = (answer.user, answer.question)
+        self.answered[key] = self.answered.get(key, 0) + 1
+
+    def remove_answer(self, user_id: int, question_id: int):
+        key = (user_id, question_id)
+        if self.answered.get(key, 0) > 1:
+            self.answered[key] -= 1
+        else:
+            self.answered.pop(key, None)
+
+
+_quiz_index: Optional[QuizIndex] = None
+
+
+def quiz_index() -> QuizIndex:
+    global _quiz_index
+    if not _quiz_index:
+        _quiz_index = QuizIndex()
+        for user in db("quiz_users"):
+            _quiz_index.add_user(QuizUser.from_dict(user))
+        for answer in db("quiz_answers"):
+            _quiz_index.add_answer(QuizAnswer.from_dict(answer))
+    return _quiz_index
 
 
 def get_registered_users() -> List[QuizUser]:
-    return [QuizUser.from_dict(user) for user in db("quiz_users")]
+    """ the returned objects must not be modified """
+    return list(quiz_index().users.values())
+
+
+def _find_user(pseudonym: str, email: str) -> Tuple[bool, Optional[int]]:
+    """ (is the pseudonym or the email already used, id of the user with both) """
+    user = quiz_index().by_pseudonym.get(pseudonym)
+    if user and user is quiz_index().by_email.get(email):
+        return True, user.id
+    return user is not None or email in quiz_index().by_email, None
+
+
+def normalize_email(email: str) -> Optional[str]:
+    """ validated and normalized email address or None, blocks for the DNS lookups """
+    # imported on first use, it is slow to import
+    from email_validator import validate_email, EmailNotValidError
+    try:
+        return validate_email(email, check_deliverability=config().check_email_deliverability).email
+    except EmailNotValidError as e:
+        logging.info(f"email address {email} invalid: {e}")
+        return None
 
 
-def register_user(pseudonym: str, email: str) -> Optional[int]:
-    """ Registers user (if needed) and returns its id or None """
+async def register_user(pseudonym: str, email: str) -> Optional[int]:
+    """ Registers user (if needed) and returns its id or None, validates the email outside the event loop """
     if not pseudonym or not email:
         return -1
     if len(pseudonym + email) > 1000:
         return -1
-    for user in get_registered_users():
-        if (user.pseudonym == pseudonym) ^ (user.email == email):
-            return None
-        if user.pseudonym == pseudonym and user.email == email:
-            return user.id
-    try:
-        email = validate_email(email).email
-        id = len(db("quiz_users")) + int(random() * 1000) + 1
-        db("quiz_users").insert(QuizUser(id, pseudonym, email, time.time()).to_dict())
-        logging.info(f"registered quiz user {pseudonym} ({email})")
+    used, id = _find_user(pseudonym, email)
+    if used:
         return id
-    except EmailNotValidError as e:
-        logging.info(f"email address {email} invalid: {e}")
+    normalized_email = await run_blocking(normalize_email, email)
+    if not normalized_email:
         return None
+    used, id = _find_user(pseudonym, email)  # registered while the email was validated
+    if used:
+        return id
+    id = user_sequence().next()
+    user = QuizUser(id, pseudonym, normalized_email, time.time())
+    db("quiz_users").insert(user.to_dict())
+    quiz_index().add_user(user)
+    invalidate("scores")
+    logging.info(f"registered quiz user {pseudonym} ({normalized_email})")
+    return id
+
+
+def user_sequence() -> Sequence:
+    return sequence("quiz_users", lambda: max(quiz_index().users, default=0) + 1)
 
 
 def get_user(id: int) -> Optional[QuizUser]:
-    val = db("quiz_users").search(Query().id == id)
-    if val:
-        return QuizUser.from_dict(val[0])
-    return None
+    return quiz_index().users.get(id)
 
 
 def get_questions() -> List[QuizQuestion]:
@@ -140,7 +235,7 @@ def get_answers() -> List[QuizAnswer]:
 
 
 def answered(user_id: int, question_id: int) -> bool:
-    return any(answer.question == question_id and user_id == answer.user for answer in get_answers())
+    return (user_id, question_id) in quiz_index().answered
 
 
 def add_answer(user_id: int, question_id: int, answer: str) -> Optional[QuizAnswer]:
@@ -148,14 +243,18 @@ def add_answer(user_id: int, question_id: int, answer: str) -> Optional[QuizAnsw
         return None
     if answered(user_id, question_id):
         return None
-    if get_user(user_id) is None or all(question.id != question_id for question in get_questions()):
+    if get_user(user_id) is None or get_question(question_id) is None:
         return None
     if all(q.id != question_id for q in get_current_questions() if is_current_question_enabled(q.track)):
         return None
-    answer = QuizAnswer(question=question_id, user=user_id, answer=answer, time=time.time()).to_dict()
-    db("quiz_answers").insert(answer)
-    logging.info(f"answer of user {user_id} to question {question_id}")
-    return answer
+    scoring_engine()
+    answer = QuizAnswer(question=question_id, user=user_id, answer=answer, time=time.time())
+    db("quiz_answers").insert(answer.to_dict())
+    quiz_index().add_answer(answer)
+    _add_to_engine(answer)
+    invalidate("scores")
+    log_sampled(f"answer of user {user_id} to question {question_id}")
+    return answer.to_dict()
 
 
 def get_question(id: int) -> Optional[QuizQuestion]:
@@ -164,57 +263,127 @@ def get_question(id: int) -> Optional[QuizQuestion]:
     return None
 
 
+class TrackQuizState:
+    """ current question of a track and whether it is enabled, changes are written through to the db """
+
+    def __init__(self, track: str, current_id: int = -1, enabled: bool = False):
+        self.track = track
+        self.current_id = current_id
+        self.enabled = enabled
+        self.version = 0
+        """ number of changes since the start """
+        self._dict: Optional[dict] = None
+
+    def current(self) -> Optional[QuizQuestion]:
+        return get_question(self.current_id)
+
+    def to_dict(self) -> dict:
+        """ current, next and previous question and whether the current is enabled, cached till the next change """
+        if self._dict is None:
+            current = self.current()
+            self._dict = {"current": to_dict(current),
+                          "next": to_dict(_next_question(self.track, current)),
+                          "prev": to_dict(_prev_question(self.track, current)),
+                          "current_enabled": self.enabled}
+        return self._dict
+
+    def changed(self):
+        self.version += 1
+        self._dict = None
+        invalidate("current_question")
+
+
+class QuizState:
+    """ the questions by track and slot and the state of every track, loaded once per quiz """
+
+    def __init__(self, quiz: Quiz):
+        self.quiz = quiz
+        self.by_slot: Dict[Tuple[str, int], QuizQuestion] = {}
+        for question in quiz.questions:
+            self.by_slot.setdefault((question.track, question.slot), question)
+        self.tracks: Dict[str, TrackQuizState] = {t.name: TrackQuizState(t.name) for t in config().tracks}
+        for doc in db("current_questions"):
+            self.track(doc["track"], create=True).current_id = doc["id"]
+        for doc in db("current_question_enabled"):
+            self.track(doc["track"], create=True).enabled = doc["enabled"]
+
+    def track(self, track: str, create: bool = False) -> TrackQuizState:
+        """ the state of the track, a new unstored state for unknown tracks if not create """
+        if track not in self.tracks:
+            if not create:
+                return TrackQuizState(track)
+            self.tracks[track] = TrackQuizState(track)
+        return self.tracks[track]
+
+
+_quiz_state: Optional[QuizState] = None
+
+
+def quiz_state() -> QuizState:
+    global _quiz_state
+    if not _quiz_state or _quiz_state.quiz is not quiz():
+        _quiz_state = QuizState(quiz())
+    return _quiz_state
+
+
 def get_current_question(track: str) -> Optional[QuizQuestion]:
-    val = db("current_questions").search(Query().track == track)
-    if val:
-        return get_question(val[0]["id"])
-    return None
+    return quiz_state().track(track).current()
 
 
 def get_current_questions() -> List[QuizQuestion]:
-    return [get_current_question(t.name) for t in config().tracks if get_current_question(t.name)]
+    return [question for question in (get_current_question(t.name) for t in config().tracks) if question]
+
+
+def current_question_dict(track: str) -> dict:
+    """ see TrackQuizState.to_dict, the returned dict must not be modified """
+    return quiz_state().track(track).to_dict()
+
+
+def current_question_version(track: str) -> int:
+    return quiz_state().track(track).version if config().has_quiz else 0
 
 
 def get_question_for_slot(track: str, slot: int) -> Optional[QuizQuestion]:
-    return ([q for q in get_questions() if q.track == track and q.slot == slot] + [None])[0]
+    return quiz_state().by_slot.get((track, slot))
 
 
-def get_next_question(track: str) -> Optional[QuizQuestion]:
-    cur = get_current_question(track)
+def _next_question(track: str, cur: Optional[QuizQuestion]) -> Optional[QuizQuestion]:
     if cur:
         return get_question_for_slot(track, cur.slot + 1)
     return get_question_for_slot(track, 0) or get_question_for_slot(track, 1)
 
 
-def get_prev_question(track: str) -> Optional[QuizQuestion]:
-    cur = get_current_question(track)
+def _prev_question(track: str, cur: Optional[QuizQuestion]) -> Optional[QuizQuestion]:
     if cur:
         return get_question_for_slot(track, cur.slot - 1)
     return None
 
 
+def get_next_question(track: str) -> Optional[QuizQuestion]:
+    return _next_question(track, get_current_question(track))
+
+
+def get_prev_question(track: str) -> Optional[QuizQuestion]:
+    return _prev_question(track, get_current_question(track))
+
+
 def set_current_question(track: str, question_id: int):
     if get_question(question_id) or question_id == -1:
         db("current_questions").upsert({"track": track, "id": question_id}, Query().track == track)
+        quiz_state().track(track, create=True).current_id = question_id
         enable_current_question(track, False)
 
 
 def enable_current_question(track: str, enabled: bool):
     db("current_question_enabled").upsert({"track": track, "enabled": enabled}, Query().track == track)
+    state = quiz_state().track(track, create=True)
+    state.enabled = enabled
+    state.changed()
 
 
 def is_current_question_enabled(track: str) -> bool:
-    val = db("current_question_enabled").search(Query().track == track)
-    if val:
-        return val[0]["enabled"]
-    return False
-
-
-def parse_float(text: str) -> float:
-    try:
-        return float(text)
-    except ValueError:
-        return float("-inf")
+    """ always False without has_quiz, so the viewer endpoints don't load the quiz """
+    return config().has_quiz and quiz_state().track(track).enabled
 
 
 def get_slots() -> Set[int]:
@@ -225,7 +394,93 @@ def count_answers(question_id: int) -> int:
     return db("quiz_answers").count(Query().question_id == question_id)
 
 
-def user_scores() -> QuizUserScores:
+_engine: Optional[ScoringEngine] = None
+_engine_generation = 0
+_engine_pending: Optional[List[QuizAnswer]] = None
+""" answers that were added after the snapshot of the running rebuild """
+_engine_listener: Optional[Callable[[], None]] = None
+
+
+def scoring_engine() -> ScoringEngine:
+    """ engine that is fed with all stored answers, built on first use (main.load_data builds it at startup) """
+    global _engine
+    if not _engine:
+        _engine = _build_engine(list(db("quiz_answers")))
+    return _engine
+
+
+def _build_engine(docs: List[dict]) -> ScoringEngine:
+    engine = ScoringEngine(get_questions(), [t.name for t in config().tracks], get_slots())
+    engine.load((doc["user"], doc["question"], doc["answer"]) for doc in docs)
+    return engine
+
+
+def _add_to_engine(answer: QuizAnswer):
+    if _engine:
+        _engine.add(answer.user, answer.question, answer.answer)
+    if _engine_pending is not None:
+        _engine_pending.append(answer)
+
+
+def set_engine_listener(listener: Callable[[], None]):
+    """ the listener is called on the event loop after the engine has been rebuilt in the background """
+    global _engine_listener
+    _engine_listener = listener
+
+
+def rebuild_scoring_engine():
+    """
+    rebuilds the engine after answers or users were removed: on the event loop in the blocking
+    pool while the previous engine answers (the answers added meanwhile are added afterwards),
+    otherwise on the next use
+    """
+    global _engine, _engine_generation, _engine_pending
+    _engine_generation += 1
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        _engine = None
+        _engine_pending = None
+        return
+    # the doc ids of the workers are not ordered by time, so the later answers are collected
+    _engine_pending = []
+    asyncio.ensure_future(_rebuild_engine(_engine_generation, list(db("quiz_answers"))))
+
+
+async def _rebuild_engine(generation: int, docs: List[dict]):
+    global _engine, _engine_pending
+    engine = await run_blocking(_build_engine, docs)
+    if generation != _engine_generation:
+        # removed again meanwhile, the newer rebuild replaces it
+        return
+    for answer in _engine_pending:
+        engine.add(answer.user, answer.question, answer.answer)
+    _engine, _engine_pending = engine, None
+    invalidate("scores")
+    if _engine_listener:
+        _engine_listener()
+
+
+def user_scores(offset: int = 0, limit: Optional[int] = None) -> QuizUserScores:
+    """ the scores of the ranks offset till offset + limit (all if limit is None) with all answer counts """
+    engine = scoring_engine()
+    users = quiz_index().users
+    return QuizUserScores([QuizUserScore(users.get(user), score) for user, score in engine.scores(offset, limit)],
+                          dict(engine.count), {q.id: q.to_dict() for q in get_questions()})
+
+
+def ranked_users() -> int:
+    """ number of users with at least one answer """
+    return len(scoring_engine().leaderboard)
+
+
+def user_rank(user_id: int) -> Optional[Tuple[int, float]]:
+    """ rank (starting at 0) and score of the user or None if the user has not answered yet """
+    return scoring_engine().rank(user_id)
+
+
+def recompute_user_scores() -> QuizUserScores:
+    """ computes the scores from scratch, used to check the incremental scoring engine """
     count: Dict[int, int] = {q.id: 0 for q in get_questions()}
     all_answers_per_q: Dict[int, List[float]] = {}
     for answer in get_answers():
@@ -265,6 +520,71 @@ def user_scores() -> QuizUserScores:
                           {q.id: q.to_dict() for q in get_questions()})
 
 
+def _remove_expired(table: str) -> List[dict]:
+    """
+    removes the expired documents of the table, assumes that the documents are ordered by time,
+    only the expired documents and the first not expired one are visited
+    """
+    min_time = expiry_time()
+    expired = list(itertools.takewhile(lambda doc: doc["time"] <= min_time, db(table)))
+    if expired:
+        if archive_expired():
+            archive().append(table, expired)
+        db(table).remove(doc_ids=[doc.doc_id for doc in expired])
+    return expired
+
+
 def delete_old_users_and_answers():
-    for table in ["quiz_answers", "quiz_users"]:
-        db(table).remove(Query().time <= time.time() - config().delete_after_days * 24 * 60 * 60)
+    """ removes the expired answers and users (oldest first), see retention.py """
+    old_answers = _remove_expired("quiz_answers")
+    for answer in old_answers:
+        quiz_index().remove_answer(answer["user"], answer["question"])
+    old_users = _remove_expired("quiz_users")
+    for user in old_users:
+        quiz_index().remove_user(user["id"])
+    if old_answers or old_users:
+        rebuild_scoring_engine()
+        invalidate("scores")
+
+
+def apply_remote_record(record: dict, removed: List[dict]) -> bool:
+    """
+    updates the quiz indexes and states after the journal record of another worker has been
+    applied (see db.apply_remote_record), returns whether the scores changed
+    """
+    table = record["table"]
+    docs = [db(table).get(doc_id=doc_id) for doc_id in record["ids"]] if record["op"] != "remove" else []
+    if table in ["quiz_users", "quiz_answers"]:
+        invalidate("scores")
+    if table == "quiz_users":
+        for doc in docs:
+            quiz_index().add_user(QuizUser.from_dict(doc))
+        for doc in removed:
+            quiz_index().remove_user(doc["id"])
+        if removed:
+            rebuild_scoring_engine()
+        return True
+    if table == "quiz_answers":
+        for doc in docs:
+            answer = QuizAnswer.from_dict(doc)
+            if is_primary() and answered(answer.user, answer.question):
+                # answered on two workers at once: the primary keeps the answer that it got first,
+                # the removal is published to the other workers
+                db(table).remove(doc_ids=[doc.doc_id])
+                continue
+            quiz_index().add_answer(answer)
+            _add_to_engine(answer)
+        for doc in removed:
+            quiz_index().remove_answer(doc["user"], doc["question"])
+        if removed:
+            rebuild_scoring_engine()
+        return True
+    if table in ["current_questions", "current_question_enabled"]:
+        for doc in docs:
+            state = quiz_state().track(doc["track"], create=True)
+            if table == "current_questions":
+                state.current_id = doc["id"]
+            else:
+                state.enabled = doc["enabled"]
+            state.changed()
+    return False
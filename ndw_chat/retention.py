@@ -0,0 +1,120 @@
+"""
+Archive for the records that are moved out of the tables: archived messages (`archive_after_minutes`
+after they were archived) and, if `archive_retention_days` is set, expired messages and quiz records.
+
+The records are appended to gzip compressed JSON lines segments per table and day of the record
+(`archive/<table>/<YYYY-MM-DD>.jsonl.gz`) in the storage writer thread of their table. Every append adds a new
+gzip member, so segments are never rewritten. Segments are deleted as a whole once all of their
+records are older than `delete_after_days + archive_retention_days`.
+"""
+
+import gzip
+import logging
+import os
+import threading
+import time
+import zlib
+from pathlib import Path
+from typing import List, Optional, Callable, Dict
+
+from ndw_chat.executor import DEFAULT_WRITER, storage_writer
+from ndw_chat.serialization import dumps, loads
+from ndw_chat.util import base_path, config
+
+DAY = 24 * 60 * 60
+
+
+def _day(timestamp: float) -> str:
+    return time.strftime("%Y-%m-%d", time.gmtime(timestamp))
+
+
+class Archive:
+
+    def __init__(self, folder: Path):
+        self.folder = folder
+        self._lock = threading.Lock()
+        """ the writes of the storage writer threads of the shards (see db.py) go to the same segments """
+
+    def segment(self, table: str, day: str) -> Path:
+        return self.folder / table / f"{day}.jsonl.gz"
+
+    def append(self, table: str, docs: List[dict], writer: str = DEFAULT_WRITER):
+        """
+        appends the documents (with a "time" field) to the segments of their days in the passed
+        storage writer thread, use the writer of the table, so the removal is written afterwards
+        """
+        by_day: Dict[str, List[str]] = {}
+        for doc in docs:
+            by_day.setdefault(_day(doc["time"]), []).append(dumps(doc) + "\n")
+        if by_day:
+            storage_writer(writer).submit(self._write, table, by_day)
+
+    def _write(self, table: str, by_day: Dict[str, List[str]]):
+        with self._lock:
+            for day, lines in by_day.items():
+                segment = self.segment(table, day)
+                segment.parent.mkdir(parents=True, exist_ok=True)
+                with gzip.open(segment, "at", encoding="utf-8") as f:
+                    f.writelines(lines)
+
+    def days(self, table: str) -> List[str]:
+        if not (self.folder / table).exists():
+            return []
+        return sorted(file.name[:-len(".jsonl.gz")] for file in (self.folder / table).glob("*.jsonl.gz"))
+
+    def query(self, table: str, since: Optional[str] = None, until: Optional[str] = None,
+              matches: Callable[[dict], bool] = lambda doc: True, limit: Optional[int] = None) -> List[dict]:
+        """
+        matching documents of the days since till until (inclusive, YYYY-MM-DD), ordered by day and
+        archiving order, blocks for reading the segments
+        """
+        docs = []
+        for day in self.days(table):
+            if (since and day < since) or (until and day > until):
+                continue
+            try:
+                with gzip.open(self.segment(table, day), "rt", encoding="utf-8") as f:
+                    for line in f:
+                        doc = loads(line)
+                        if matches(doc):
+                            docs.append(doc)
+                            if limit is not None and len(docs) >= limit:
+                                return docs
+            except (EOFError, zlib.error, gzip.BadGzipFile, ValueError) as ex:
+                # the last member might still be written
+                logging.info(f"Stop reading archive segment {table}/{day}: {ex}")
+        return docs
+
+    def purge(self, before: float):
+        """ deletes the segments of the days before the passed time in the storage writer thread """
+        storage_writer().submit(self._purge, _day(before))
+
+    def _purge(self, before_day: str):
+        with self._lock:
+            for table in os.listdir(self.folder) if self.folder.exists() else []:
+                for day in self.days(table):
+                    if day < before_day:
+                        self.segment(table, day).unlink()
+
+
+_archive: Optional[Archive] = None
+
+
+def archive() -> Archive:
+    global _archive
+    if not _archive:
+        _archive = Archive(base_path() / "archive")
+    return _archive
+
+
+def expiry_time() -> float:
+    """ records created before this time are removed from the tables """
+    return time.time() - config().delete_after_days * DAY
+
+
+def archive_expired() -> bool:
+    return config().archive_retention_days > 0
+
+
+def purge_archive():
+    archive().purge(expiry_time() - config().archive_retention_days * DAY)
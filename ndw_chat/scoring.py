@@ -0,0 +1,222 @@
+"""
+Incremental computation of the quiz scores.
+
+The engine produces the same scores as the full recomputation in `quiz.recompute_user_scores`:
+the answers of an estimation question are ranked by their distance to the solution (ties are
+broken by answer order) and every answer gets 2 / (rank + 2) points, using the last rank of all
+answers with the same value. Choice questions give 1 point for the correct answer. The score of a
+user is the sum over all slots of the mean points over all tracks. The users are ranked by their
+scores in a `Leaderboard`, users with the same score in the order of their first answer.
+
+The points are computed from the ranks when the totals are updated, an answer only records from
+which entry of its ranking on the ranks changed. `ScoringEngine.load` adds the stored answers and
+sorts every ranking once.
+
+`tests/test_scoring.py` compares the engine with the full recomputation on random quizzes.
+"""
+
+import bisect
+import math
+import statistics
+from typing import Dict, List, Tuple, Set, Iterable, Optional
+
+
+def parse_float(text: str) -> float:
+    try:
+        value = float(text)
+        return float("-inf") if math.isnan(value) else value
+    except ValueError:
+        return float("-inf")
+
+
+class EstimationRanking:
+    """ answers of an estimation question, ordered by their distance to the solution """
+
+    def __init__(self, solution: float):
+        self.solution = solution
+        self.entries: List[Tuple[float, int]] = []
+        """ sorted (distance, answer sequence number) """
+        self.users: Dict[int, int] = {}
+        """ answer sequence number → user """
+        self.first_seq: Dict[float, int] = {}
+        """ value → sequence number of the first answer with this value """
+        self.last_seq: Dict[float, int] = {}
+        """ value → sequence number of the last answer with this value """
+        self._changed_from: Optional[Tuple[float, int]] = None
+        """ first entry whose points may have changed since the last `changed_users` call """
+
+    def add(self, seq: int, value: float, user: int):
+        """ adds an answer, seq has to be larger than all previous ones """
+        bisect.insort(self.entries, (abs(self.solution - value), seq))
+        self._record(seq, value, user)
+        # the entries after the new one and the answers with the same value get new points
+        first = (abs(self.solution - value), self.first_seq[value])
+        if self._changed_from is None or first < self._changed_from:
+            self._changed_from = first
+
+    def extend(self, answers: Iterable[Tuple[int, float, int]]):
+        """ adds (sequence number, value, user) answers with increasing sequence numbers, sorts once """
+        for seq, value, user in answers:
+            self.entries.append((abs(self.solution - value), seq))
+            self._record(seq, value, user)
+        self.entries.sort()
+        self._changed_from = self.entries[0] if self.entries else None
+
+    def _record(self, seq: int, value: float, user: int):
+        self.users[seq] = user
+        self.first_seq.setdefault(value, seq)
+        self.last_seq[value] = seq
+
+    def changed_users(self) -> Set[int]:
+        """ the users whose points may have changed since the last call """
+        if self._changed_from is None:
+            return set()
+        pos = bisect.bisect_left(self.entries, self._changed_from)
+        self._changed_from = None
+        return {self.users[seq] for _, seq in self.entries[pos:]}
+
+    def points(self, value: float) -> float:
+        rank = bisect.bisect_left(self.entries, (abs(self.solution - value), self.last_seq[value]))
+        return 2 / (rank + 2)
+
+
+class Leaderboard:
+    """
+    Users sorted by descending score and then by the order in which they were added. Changing a
+    score is a binary search and a list insert, ranks and ranges are read without sorting.
+    """
+
+    def __init__(self):
+        self.entries: List[Tuple[float, int, int]] = []
+        """ sorted (negated score, order, user) """
+        self.keys: Dict[int, Tuple[float, int, int]] = {}
+        """ user → entry """
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def set(self, user: int, score: float):
+        key = self.keys.get(user)
+        if key is None:
+            order = len(self.keys)
+        elif key[0] == -score:
+            return
+        else:
+            order = key[1]
+            del self.entries[bisect.bisect_left(self.entries, key)]
+        key = self.keys[user] = (-score, order, user)
+        bisect.insort(self.entries, key)
+
+    def update(self, scores: Dict[int, float]):
+        """ sets the scores of known users, sorts all entries once if many of them changed """
+        if len(scores) * 4 < len(self.entries):
+            for user, score in scores.items():
+                self.set(user, score)
+            return
+        for user, score in scores.items():
+            _, order, _ = self.keys[user]
+            self.keys[user] = (-score, order, user)
+        self.entries = sorted(self.keys.values())
+
+    def range(self, offset: int = 0, limit: Optional[int] = None) -> List[Tuple[int, float]]:
+        """ (user, score) pairs of the ranks offset till offset + limit (exclusive) """
+        end = None if limit is None else offset + limit
+        return [(user, -score) for score, _, user in self.entries[offset:end]]
+
+    def rank(self, user: int) -> Optional[Tuple[int, float]]:
+        """ rank (starting at 0) and score of the user or None if the user is unknown """
+        key = self.keys.get(user)
+        if key is None:
+            return None
+        return bisect.bisect_left(self.entries, key), -key[0]
+
+
+class ScoringEngine:
+    """
+    Keeps the answer counts, a ranking per estimation question and the answered question per
+    user, slot and track. Only the totals of users whose points may have changed are recomputed.
+    """
+
+    def __init__(self, questions: list, tracks: List[str], slots: Iterable[int]):
+        self.questions = {q.id: q for q in questions}
+        self.tracks = tracks
+        self.slots = list(slots)
+        self.count: Dict[int, int] = {q.id: 0 for q in questions}
+        self.rankings = {q.id: EstimationRanking(q.estimation_solution) for q in questions if q.estimation}
+        self.cells: Dict[int, Dict[int, Dict[str, Tuple[int, str]]]] = {}
+        """ user → slot → track → (question id, answer), users are ordered by their first answer """
+        self.totals: Dict[int, float] = {}
+        self.leaderboard = Leaderboard()
+        self._dirty: Set[int] = set()
+        self._dirty_rankings: Set[int] = set()
+        self._seq = 0
+
+    def add(self, user: int, question_id: int, answer: str):
+        question = self._add_cell(user, question_id, answer)
+        if question.estimation:
+            self.rankings[question_id].add(self._seq, parse_float(answer), user)
+            self._dirty_rankings.add(question_id)
+        self._seq += 1
+
+    def load(self, answers: Iterable[Tuple[int, int, str]]):
+        """ adds many (user, question id, answer) answers and computes the totals """
+        estimations: Dict[int, List[Tuple[int, float, int]]] = {}
+        for user, question_id, answer in answers:
+            question = self._add_cell(user, question_id, answer)
+            if question.estimation:
+                estimations.setdefault(question_id, []).append((self._seq, parse_float(answer), user))
+            self._seq += 1
+        for question_id, estimated in estimations.items():
+            self.rankings[question_id].extend(estimated)
+            self._dirty_rankings.add(question_id)
+        self._update()
+
+    def _add_cell(self, user: int, question_id: int, answer: str):
+        question = self.questions[question_id]
+        self.count[question_id] += 1
+        if user not in self.cells:
+            self.cells[user] = {slot: {} for slot in self.slots}
+            self.totals[user] = 0
+            self.leaderboard.set(user, 0)
+        self.cells[user][question.slot][question.track] = (question_id, answer)
+        self._dirty.add(user)
+        return question
+
+    def _points(self, question_id: int, answer: str) -> float:
+        if question_id in self.rankings:
+            return self.rankings[question_id].points(parse_float(answer))
+        return 1 if self.questions[question_id].choice_solution == answer else 0
+
+    def _total(self, user: int) -> float:
+        summed = 0
+        for slot, cells in self.cells[user].items():
+            points = {track: 0 for track in self.tracks}
+            for track, (question_id, answer) in cells.items():
+                points[track] = self._points(question_id, answer)
+            nonzero = [value for value in points.values() if value]
+            if len(nonzero) > 1:
+                summed += statistics.mean(points.values())
+            elif points:
+                # a single value divided once is the exactly rounded mean too
+                summed += sum(nonzero) / len(points)
+        return summed
+
+    def _update(self):
+        for question_id in self._dirty_rankings:
+            self._dirty.update(self.rankings[question_id].changed_users())
+        self._dirty_rankings.clear()
+        for user in self._dirty:
+            self.totals[user] = self._total(user)
+        self.leaderboard.update({user: self.totals[user] for user in self._dirty})
+        self._dirty.clear()
+
+    def scores(self, offset: int = 0, limit: Optional[int] = None) -> List[Tuple[int, float]]:
+        """ (user, score) pairs of the ranks offset till offset + limit, the first has the largest score """
+        self._update()
+        return self.leaderboard.range(offset, limit)
+
+    def rank(self, user: int) -> Optional[Tuple[int, float]]:
+        """ see Leaderboard.rank """
+        self._update()
+        return self.leaderboard.rank(user)
+
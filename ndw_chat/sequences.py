@@ -0,0 +1,109 @@
+"""
+Persisted id sequences for the messages and the quiz users and for the versions of the messages.
+
+The ids are handed out from blocks that are leased from `sequences.json` under an exclusive file
+lock, so they are unique across restarts and across the workers that share the folder (see bus.py)
+and increasing within a worker. Leasing a block writes the file once, the ids of a block that are
+not used before a restart are skipped. The next block is leased in the blocking thread pool when
+half of the current block is used, so the event loop only waits for the file if the ids are
+allocated faster than a block can be leased (or for more ids than a block has).
+"""
+
+import concurrent.futures
+import os
+import threading
+from pathlib import Path
+from typing import Optional, Callable, Dict, List, Tuple
+
+try:
+    import fcntl
+except ImportError:  # no locking between processes, which only matters for multiple workers
+    fcntl = None
+
+from ndw_chat.executor import blocking_pool
+from ndw_chat.serialization import dumps, loads
+from ndw_chat.util import base_path, config
+
+
+class SequenceFile:
+    """ JSON file with the next unleased id per sequence """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.lock_path = path.with_name(path.name + ".lock")
+        self._lock = threading.Lock()
+        """ the sequences lease their blocks in different threads """
+
+    def lease(self, name: str, count: int, minimum: int) -> Tuple[int, int]:
+        """ reserves count ids of the sequence that are at least minimum, returns the range (start, end) """
+        with self._lock, self.lock_path.open("a") as lock:
+            if fcntl:
+                fcntl.flock(lock, fcntl.LOCK_EX)  # released when the file is closed
+            values = loads(self.path.read_text(encoding="utf-8")) if self.path.exists() else {}
+            start = max(values.get(name, 0), minimum)
+            values[name] = start + count
+            tmp_file = self.path.with_name(self.path.name + ".tmp")
+            with tmp_file.open("w", encoding="utf-8") as f:
+                f.write(dumps(values))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_file, self.path)
+        return start, start + count
+
+    def read(self, name: str) -> int:
+        """ the next unleased id of the sequence, 0 if it has not been leased yet """
+        values = loads(self.path.read_text(encoding="utf-8")) if self.path.exists() else {}
+        return values.get(name, 0)
+
+
+class Sequence:
+
+    def __init__(self, file: SequenceFile, name: str, minimum: Callable[[], int], block_size: int):
+        self.file = file
+        self.name = name
+        self.minimum = minimum
+        """ lower bound for new blocks, e.g. the highest id in the table + 1 for data without a sequence """
+        self.block_size = block_size
+        self._next = 0
+        self._end = 0
+        self._prefetched: Optional[concurrent.futures.Future] = None
+        """ lease of the next block """
+
+    def allocate(self, count: int) -> List[int]:
+        """ returns count new ids, switches to the next block if the current one is used up """
+        if self._next + count > self._end:
+            self._next, self._end = self._next_block(count)
+        ids = list(range(self._next, self._next + count))
+        self._next += count
+        self.prefetch()
+        return ids
+
+    def prefetch(self):
+        """ leases the next block in the background if less than half of the current block is left """
+        if self._prefetched is None and self._end - self._next < self.block_size / 2:
+            self._prefetched = blocking_pool().submit(self.file.lease, self.name, self.block_size, self.minimum())
+
+    def _next_block(self, count: int) -> Tuple[int, int]:
+        if self._prefetched is not None:
+            prefetched, self._prefetched = self._prefetched, None
+            start, end = prefetched.result()
+            if end - start >= count:
+                return start, end
+        return self.file.lease(self.name, max(count, self.block_size), self.minimum())
+
+    def next(self) -> int:
+        return self.allocate(1)[0]
+
+
+_sequence_file: Optional[SequenceFile] = None
+_sequences: Dict[str, Sequence] = {}
+
+
+def sequence(name: str, minimum: Callable[[], int]) -> Sequence:
+    """ returns the sequence with the passed name, minimum is only used when the first one is created """
+    global _sequence_file
+    if name not in _sequences:
+        if not _sequence_file:
+            _sequence_file = SequenceFile(base_path() / "sequences.json")
+        _sequences[name] = Sequence(_sequence_file, name, minimum, config().id_block_size)
+    return _sequences[name]
@@ -0,0 +1,109 @@
+"""
+Fast serialization of the records and the responses.
+
+- `dumps` and `loads` use orjson if it is installed and the compact json module output otherwise
+- `packb` encodes MessagePack for the websocket clients that negotiated it (if msgpack is installed)
+- `fast_dict` replaces the reflection based `to_dict` and `from_dict` methods of a dataclass_json
+  class with generated code for its fields
+- `SLOTS` (use `@dataclass(**SLOTS)`) makes the records use `__slots__` on Python >= 3.10
+"""
+
+import dataclasses
+import json
+import sys
+import typing
+from typing import Any, Union, Tuple, Optional
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+SLOTS = {"slots": True} if sys.version_info >= (3, 10) else {}
+
+
+def dumps(obj: Any) -> str:
+    if orjson:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode()
+    return json.dumps(obj, separators=(',', ':'))
+
+
+def loads(text: Union[str, bytes]) -> Any:
+    if orjson:
+        return orjson.loads(text)
+    return json.loads(text)
+
+
+def packb(obj: Any) -> bytes:
+    return msgpack.packb(obj)
+
+
+def _field_kind(hint: Any) -> Tuple[str, Optional[type]]:
+    """ ("value" | "list" | "dict" | "record" | "record_list", record class) """
+    args = [arg for arg in typing.get_args(hint) if arg is not type(None)]
+    if typing.get_origin(hint) is Union and len(args) == 1:  # Optional
+        hint = args[0]
+        args = typing.get_args(hint)
+    origin = typing.get_origin(hint)
+    if origin is list:
+        if args and hasattr(args[0], "__fast_dict__"):
+            return "record_list", args[0]
+        return "list", None
+    if origin is dict:
+        return "dict", None
+    if hasattr(hint, "__fast_dict__"):
+        return "record", hint
+    return "value", None
+
+
+def fast_dict(cls):
+    """
+    decorator for dataclass_json classes, generates to_dict and from_dict methods that produce the
+    same dicts for fields of JSON types, lists and dicts of them and other fast_dict classes
+    """
+    hints = typing.get_type_hints(cls)
+    namespace = {"cls": cls}
+    encoders = []
+    decoders = []
+    for i, field in enumerate(dataclasses.fields(cls)):
+        name = field.name
+        kind, record = _field_kind(hints[name])
+        namespace[f"record{i}"] = record
+        value = f"self.{name}"
+        encoders.append(f"{name!r}: " + {
+            "value": value,
+            "list": f"None if {value} is None else list({value})",
+            "dict": f"None if {value} is None else dict({value})",
+            "record": f"None if {value} is None else {value}.to_dict()",
+            "record_list": f"None if {value} is None else [v.to_dict() for v in {value}]"}[kind])
+        if field.default is not dataclasses.MISSING:
+            namespace[f"default{i}"] = field.default
+            value = f"d.get({name!r}, default{i})"
+        elif field.default_factory is not dataclasses.MISSING:
+            namespace[f"factory{i}"] = field.default_factory
+            value = f"(d[{name!r}] if {name!r} in d else factory{i}())"
+        else:
+            value = f"d[{name!r}]"
+        decoders.append(f"{name}=" + {
+            "value": value,
+            "list": f"None if (v := {value}) is None else list(v)",
+            "dict": f"None if (v := {value}) is None else dict(v)",
+            "record": f"None if (v := {value}) is None else record{i}.from_dict(v)",
+            "record_list": f"None if (v := {value}) is None else [record{i}.from_dict(r) for r in v]"}[kind])
+    code = f"""
+def to_dict(self, encode_json=False):
+    return {{{", ".join(encoders)}}}
+
+def from_dict(d, *, infer_missing=False):
+    return cls({", ".join(decoders)})
+"""
+    exec(code, namespace)
+    cls.to_dict = namespace["to_dict"]
+    cls.from_dict = staticmethod(namespace["from_dict"])
+    cls.__fast_dict__ = True
+    return cls
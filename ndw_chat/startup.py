@@ -0,0 +1,103 @@
+"""
+Readiness of the server while it starts: the port is bound first and the tables and the quiz are
+loaded in the background (see main.start_server), so clients can connect right after a restart.
+
+- requests that arrive while loading wait till the data is loaded (at most READY_TIMEOUT seconds,
+  then they get a 503 with Retry-After), /ready and /metrics are answered right away
+- /ready returns 200 once the data is loaded and 503 before, both with the state and the seconds
+  from the import of the server modules till the phases "listening", "ready" and "first_request"
+"""
+
+import time
+
+STARTED = time.monotonic()
+""" time at which the server modules were imported """
+
+import asyncio
+import logging
+from typing import Dict, Optional, Callable, List, Set
+
+from aiohttp import web
+from aiohttp.abc import Request
+
+from ndw_chat.metrics import gauge, labels
+
+READY_TIMEOUT = 30
+
+
+class Startup:
+
+    def __init__(self):
+        self.state = "starting"
+        """ "starting", "loading" (the port is bound), "ready" or "failed" """
+        self.durations: Dict[str, float] = {}
+        """ phase → seconds since STARTED """
+        self._ready: Optional[asyncio.Event] = None
+        self._deferred: List[Callable[[], None]] = []
+
+    def reached(self, phase: str):
+        self.durations[phase] = time.monotonic() - STARTED
+        logging.info(f"Startup phase {phase} reached after {self.durations[phase]:.3f}s")
+
+    def listening(self):
+        self.state = "loading"
+        self.reached("listening")
+
+    def set_ready(self):
+        self.state = "ready"
+        self.reached("ready")
+        self._event().set()
+        deferred, self._deferred = self._deferred, []
+        for func in deferred:
+            func()
+
+    def failed(self):
+        self.state = "failed"
+
+    def is_ready(self) -> bool:
+        return self.state == "ready"
+
+    def defer(self, func: Callable[[], None]):
+        """ calls func now if the data is loaded and otherwise right after it is loaded """
+        if self.is_ready():
+            func()
+        else:
+            self._deferred.append(func)
+
+    async def wait(self, timeout: float) -> bool:
+        """ waits at most timeout seconds till the data is loaded, returns whether it is loaded """
+        try:
+            await asyncio.wait_for(self._event().wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    def _event(self) -> asyncio.Event:
+        # created on first use, so it belongs to the loop of the server
+        if self._ready is None:
+            self._ready = asyncio.Event()
+        return self._ready
+
+    def to_dict(self) -> dict:
+        return {"ready": self.is_ready(), "state": self.state, "durations": self.durations}
+
+
+startup = Startup()
+
+gauge("ndw_startup_seconds", "seconds from the import of the server modules till the startup phases",
+      lambda: {labels(phase=phase): seconds for phase, seconds in startup.durations.items()})
+
+
+def readiness_middleware(ungated: Set[str]):
+    """ middleware that lets the requests of all paths except the ungated ones wait till the data is loaded """
+
+    @web.middleware
+    async def middleware(request: Request, handler):
+        if request.path not in ungated:
+            if not startup.is_ready() and not await startup.wait(READY_TIMEOUT):
+                return web.Response(status=503, headers={"Retry-After": "1"})
+            if "first_request" not in startup.durations:
+                startup.reached("first_request")
+        return await handler(request)
+
+    return middleware
@@ -0,0 +1,313 @@
+"""
+Storage backends for the tables used in db.py and quiz.py.
+
+The default "journal" backend keeps all tables in memory, appends every change to a
+write-ahead journal and periodically compacts the journal into a snapshot. The snapshot has
+the same layout as a TinyDB db.json file, so an existing db.json can be used as the initial
+snapshot and a snapshot can be copied back to db.json to switch to the "tinydb" backend.
+
+Both backends change the tables in memory and do the file writes in the storage writer thread
+(see executor.py).
+"""
+
+import concurrent.futures
+import json
+import logging
+import os
+import threading
+from pathlib import Path
+from typing import Dict, List, Callable, Optional, Iterator, Any, IO
+
+from tinydb import TinyDB
+from tinydb.storages import Storage
+from tinydb.table import Document
+
+from ndw_chat.executor import storage_writer, StorageWriter
+from ndw_chat.serialization import dumps, loads
+
+Condition = Callable[[Dict[str, Any]], bool]
+
+
+class JournalTable:
+    """
+    In memory table with the subset of the TinyDB table API that is used in this project.
+    Conditions are arbitrary callables, so TinyDB queries (`Query().id == id`) work as before,
+    and returned documents carry their `doc_id` like TinyDB documents.
+    """
+
+    def __init__(self, database: "JournalDatabase", name: str, docs: Dict[int, dict]):
+        self.database = database
+        self.name = name
+        self._docs = docs
+        next_id = max(docs, default=0) + 1
+        # every worker uses its own residue class of ids (see JournalDatabase)
+        self._next_id = next_id + (database.id_offset - next_id) % database.id_stride
+
+    def insert(self, doc: dict) -> int:
+        return self.insert_multiple([doc])[0]
+
+    def insert_multiple(self, docs: List[dict]) -> List[int]:
+        stride = self.database.id_stride
+        ids = list(range(self._next_id, self._next_id + len(docs) * stride, stride))
+        self._next_id += len(docs) * stride
+        docs = [dict(doc) for doc in docs]
+        self._apply({"op": "insert", "table": self.name, "ids": ids, "docs": docs})
+        return ids
+
+    def _doc_ids(self, cond: Optional[Condition], doc_ids: Optional[List[int]]) -> List[int]:
+        if doc_ids is not None:
+            return [doc_id for doc_id in doc_ids if doc_id in self._docs]
+        return [doc_id for doc_id, doc in self._docs.items() if cond(doc)]
+
+    def update(self, fields: dict, cond: Optional[Condition] = None,
+               doc_ids: Optional[List[int]] = None) -> List[int]:
+        ids = self._doc_ids(cond, doc_ids)
+        if ids:
+            self._apply({"op": "update", "table": self.name, "ids": ids, "fields": dict(fields)})
+        return ids
+
+    def upsert(self, doc: dict, cond: Condition) -> List[int]:
+        return self.update(doc, cond) or [self.insert(doc)]
+
+    def remove(self, cond: Optional[Condition] = None, doc_ids: Optional[List[int]] = None) -> List[int]:
+        ids = self._doc_ids(cond, doc_ids)
+        if ids:
+            self._apply({"op": "remove", "table": self.name, "ids": ids})
+        return ids
+
+    def search(self, cond: Condition) -> List[Document]:
+        return [Document(doc, doc_id) for doc_id, doc in self._docs.items() if cond(doc)]
+
+    def get(self, cond: Optional[Condition] = None, doc_id: Optional[int] = None) -> Optional[Document]:
+        if doc_id is not None:
+            doc = self._docs.get(doc_id)
+            return Document(doc, doc_id) if doc is not None else None
+        return (self.search(cond) + [None])[0]
+
+    def count(self, cond: Condition) -> int:
+        return sum(1 for doc in self._docs.values() if cond(doc))
+
+    def all(self) -> List[Document]:
+        return list(self)
+
+    def __len__(self) -> int:
+        return len(self._docs)
+
+    def __iter__(self) -> Iterator[Document]:
+        """ iterates lazily (in insertion order) like TinyDB, the table must not be changed meanwhile """
+        for doc_id, doc in self._docs.items():
+            yield Document(doc, doc_id)
+
+    def _apply(self, record: dict):
+        self.database.apply(record)
+        self.database.append(record)
+
+
+class JournalDatabase:
+    """
+    Tables are restored from `<name>.snapshot.json` and the records of `<name>.journal`.
+    All journal records use explicit document ids and assign absolute values, so replaying a
+    journal on top of a snapshot that already contains (some of) its changes is harmless.
+
+    With multiple workers (see bus.py) only the primary writes the files, the other workers load
+    them read-only. Every record is passed to on_record (to publish it) and the records of the
+    other workers are applied via apply_remote. Inserted documents get ids with
+    `id % id_stride == id_offset`, so the workers never use the same ids.
+    """
+
+    def __init__(self, folder: Path, name: str = "db", snapshot_interval: int = 1000,
+                 legacy_file: Optional[Path] = None, read_only: bool = False, id_offset: int = 0,
+                 id_stride: int = 1, on_record: Optional[Callable[[dict], None]] = None,
+                 writer: Optional[StorageWriter] = None):
+        self.snapshot_file = folder / f"{name}.snapshot.json"
+        self.journal_file = folder / f"{name}.journal"
+        self.snapshot_interval = snapshot_interval
+        self.read_only = read_only
+        self.id_offset = id_offset
+        self.id_stride = id_stride
+        self.on_record = on_record
+        self.writer = writer or storage_writer()
+        """ thread that writes the files """
+        self._tables: Dict[str, Dict[int, dict]] = {}
+        self._table_objects: Dict[str, JournalTable] = {}
+        self._records_since_snapshot = 0
+        if read_only:
+            self._load_read_only()
+        elif not self.snapshot_file.exists() and legacy_file and legacy_file.exists():
+            logging.info(f"Migrate {legacy_file} to {self.snapshot_file}")
+            self._load_snapshot(legacy_file)
+            self.write_snapshot()
+        else:
+            self._load_snapshot(self.snapshot_file)
+            self._replay_journal()
+        self._journal: Optional[IO] = None if read_only else self.journal_file.open("a", encoding="utf-8")
+
+    def table(self, name: str) -> JournalTable:
+        if name not in self._table_objects:
+            self._table_objects[name] = JournalTable(self, name, self._tables.setdefault(name, {}))
+        return self._table_objects[name]
+
+    def _load_snapshot(self, file: Path):
+        if not file.exists() or file.stat().st_size == 0:
+            return
+        with file.open(encoding="utf-8") as f:
+            for table, docs in loads(f.read()).items():
+                self._tables[table] = {int(doc_id): doc for doc_id, doc in docs.items()}
+
+    def _load_read_only(self):
+        """ loads the files of the primary, again if the primary replaced the snapshot in the meantime """
+        while True:
+            snapshot = self._snapshot_stat()
+            self._tables.clear()
+            self._load_snapshot(self.snapshot_file)
+            self._replay_journal(truncate=False)
+            if snapshot == self._snapshot_stat():
+                return
+
+    def _snapshot_stat(self) -> Optional[tuple]:
+        if not self.snapshot_file.exists():
+            return None
+        stat = self.snapshot_file.stat()
+        return stat.st_ino, stat.st_mtime_ns
+
+    def _replay_journal(self, truncate: bool = True):
+        if not self.journal_file.exists():
+            return
+        valid_length = 0
+        with self.journal_file.open("rb") as f:
+            for line in f:
+                try:
+                    # a record without its newline was torn, the next record would be appended to its line
+                    if not line.endswith(b"\n"):
+                        raise ValueError("missing newline")
+                    self.apply(loads(line))
+                except ValueError:
+                    logging.error(f"Discard incomplete journal entries after byte {valid_length} "
+                                  f"of {self.journal_file}")
+                    break
+                valid_length += len(line)
+                self._records_since_snapshot += 1
+        if truncate and valid_length != self.journal_file.stat().st_size:
+            with self.journal_file.open("r+b") as f:
+                f.truncate(valid_length)
+
+    def apply(self, record: dict):
+        docs = self._tables.setdefault(record["table"], {})
+        if record["op"] == "insert":
+            for doc_id, doc in zip(record["ids"], record["docs"]):
+                docs[doc_id] = doc
+        elif record["op"] == "update":
+            for doc_id in record["ids"]:
+                if doc_id in docs:
+                    docs[doc_id].update(record["fields"])
+        elif record["op"] == "remove":
+            for doc_id in record["ids"]:
+                docs.pop(doc_id, None)
+        else:
+            raise ValueError(f"Unknown journal operation {record['op']}")
+
+    def append(self, record: dict):
+        self._persist(record)
+        if self.on_record:
+            self.on_record(record)
+
+    def apply_remote(self, record: dict):
+        """ applies and persists the record of another worker """
+        self.apply(record)
+        self._persist(record)
+
+    def _persist(self, record: dict):
+        if self.read_only:
+            return
+        self.writer.submit(self._write_line, dumps(record) + "\n")
+        self._records_since_snapshot += 1
+        if self._records_since_snapshot >= self.snapshot_interval:
+            self.compact()
+
+    def _write_line(self, line: str):
+        self._journal.write(line)
+        self._journal.flush()
+
+    def _copy(self) -> Dict[str, Dict[str, dict]]:
+        return {table: {str(doc_id): dict(doc) for doc_id, doc in docs.items()}
+                for table, docs in self._tables.items()}
+
+    def write_snapshot(self, tables: Optional[Dict[str, Dict[str, dict]]] = None):
+        """ atomically replace the snapshot file with the passed or the current state """
+        _write_json_atomically(self.snapshot_file, tables or self._copy())
+
+    def _write_snapshot_and_truncate(self, tables: Dict[str, Dict[str, dict]]):
+        self.write_snapshot(tables)
+        self._journal.truncate(0)
+        self._journal.seek(0)
+
+    def compact(self) -> concurrent.futures.Future:
+        """ copies the current state and writes it as the new snapshot in the storage writer thread """
+        self._records_since_snapshot = 0
+        return self.writer.submit(self._write_snapshot_and_truncate, self._copy())
+
+    def close(self):
+        if not self.read_only:
+            self.compact().result()
+            self._journal.close()
+
+
+def _write_json_atomically(file: Path, data: Any, **kwargs):
+    tmp_file = file.with_name(file.name + ".tmp")
+    with tmp_file.open("w", encoding="utf-8") as f:
+        if kwargs:
+            json.dump(data, f, **kwargs)
+        else:
+            f.write(dumps(data))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_file, file)
+
+
+class BackgroundJSONStorage(Storage):
+    """
+    TinyDB storage that keeps the data in memory and writes the JSON file in the storage writer
+    thread. Writes that are submitted while a previous write is pending are coalesced.
+    """
+
+    def __init__(self, path: Path, **kwargs):
+        self.path = path
+        self.kwargs = kwargs
+        self._data: Optional[Dict[str, Dict[str, dict]]] = None
+        if path.exists() and path.stat().st_size > 0:
+            with path.open(encoding="utf-8") as f:
+                self._data = loads(f.read())
+        self._pending: Optional[Dict[str, Dict[str, dict]]] = None
+        self._lock = threading.Lock()
+
+    def read(self) -> Optional[Dict[str, Dict[str, Any]]]:
+        return self._data
+
+    def write(self, data: Dict[str, Dict[str, Any]]):
+        self._data = data
+        copy = {table: {doc_id: dict(doc) for doc_id, doc in docs.items()} for table, docs in data.items()}
+        with self._lock:
+            submit = self._pending is None
+            self._pending = copy
+        if submit:
+            storage_writer().submit(self._write_pending)
+
+    def _write_pending(self):
+        with self._lock:
+            data, self._pending = self._pending, None
+        _write_json_atomically(self.path, data, **self.kwargs)
+
+
+def open_database(backend: str, folder: Path, snapshot_interval: int, **worker_options):
+    """
+    returns an object with a `table(name)` method for the passed backend name,
+    the worker_options (see JournalDatabase) are only supported by the journal backend
+    """
+    if backend == "journal":
+        return JournalDatabase(folder, snapshot_interval=snapshot_interval, legacy_file=folder / "db.json",
+                               **worker_options)
+    if backend == "tinydb":
+        if worker_options.get("id_stride", 1) > 1:
+            raise ValueError("The tinydb storage backend does not support multiple workers")
+        return TinyDB(folder / "db.json", storage=BackgroundJSONStorage)
+    raise ValueError(f"Unknown storage backend {backend}")
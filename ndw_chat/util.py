@@ -1,4 +1,6 @@
+import logging
 import os
+import random
 from dataclasses import dataclass, field
 from pathlib import Path
 from typing import Optional, List, Union, Dict, Any
@@ -30,6 +32,64 @@ class Config:
     host: str = "127.0.0.1"
     path: str = ""
     has_quiz: bool = False
+    storage: str = "journal"
+    """ "journal" (append-only journal with snapshots) or "tinydb" (rewrites db.json on every change) """
+    snapshot_interval: int = 1000
+    """ number of journal records after which the journal is compacted into a snapshot """
+    score_broadcasts_per_second: float = 2
+    score_broadcast_limit: int = 100
+    """ number of top ranked users in the scores sent to the websocket clients, 0: all """
+    send_queue_size: int = 1000
+    """ maximum number of frames queued per websocket client """
+    send_queue_policy: str = "drop_oldest"
+    """ what to do if the queue of a client is full: "drop_oldest", "drop_newest" or "evict" the client """
+    evict_after_dropped_frames: int = 100
+    event_log_size: int = 1000
+    """ number of events that are kept to replay them for reconnecting websocket clients """
+    cpu_pool: str = "thread"
+    """ "thread" or "process" pool for CPU heavy work like encoding the scores """
+    cpu_workers: int = 2
+    check_email_deliverability: bool = True
+    """ check the domain of quiz user emails via DNS """
+    log_sample_rate: float = 1
+    """ fraction of the per message and per command info log lines that are logged """
+    archive_after_minutes: float = 60
+    """ time after which archived messages are moved from the messages table to the archive (see retention.py) """
+    archive_retention_days: float = 0
+    """ days that expired records are kept in the archive after delete_after_days, 0: they are deleted """
+    workers: int = 1
+    """ number of server processes that share the port, worker 0 starts the others (see bus.py) """
+    bus: str = "local"
+    """ "local" (single process) or "resp" (Redis or `python -m ndw_chat.bus` at bus_host:bus_port) """
+    bus_host: str = "127.0.0.1"
+    bus_port: int = 6379
+    id_block_size: int = 100
+    """ number of message and quiz user ids that a worker reserves at once (see sequences.py) """
+    client_rate_limit: float = 10
+    """ requests per second per client address on /send, /send_batch and /register_quiz_user, 0: no limit """
+    client_rate_burst: int = 50
+    quiz_user_rate_limit: float = 1
+    """ requests per second per quiz user on /submit_quiz_answer, 0: no limit """
+    quiz_user_rate_burst: int = 5
+    answer_client_rate_limit: float = 20
+    """ answers per second per client address, 0: no limit """
+    answer_client_rate_burst: int = 200
+    """ larger than client_rate_burst, as a whole audience can answer at once from behind one address """
+    ingest_rate_limit: float = 500
+    """ requests per second of all clients on these endpoints, 0: no limit """
+    ingest_rate_burst: int = 1000
+    max_batch_size: int = 2000
+    """ messages per /send_batch request (larger ones get a 413), every message takes an admission token """
+    shed_storage_pending: int = 10000
+    """ these requests are rejected while more writes are queued for the storage writer threads """
+    shed_queued_frames: int = 100000
+    """ these requests are rejected while more frames are queued for all websocket clients """
+    client_address_header: Optional[str] = None
+    """ header with the client address behind a reverse proxy, e.g. X-Forwarded-For """
+    websocket_compression: bool = True
+    """ permessage-deflate for the websocket clients that offer it, costs CPU per client and frame """
+    shard_tracks: bool = False
+    """ every track gets its own message journal, index, id sequence and storage writer thread (see db.py) """
 
 _config: Optional[Config] = None
 CONFIG_FILE = "config.yaml"
@@ -51,6 +111,21 @@ def config() -> Config:
         exit(0)
 
 
+def worker_id() -> int:
+    """ id of this server process, 0 is the primary that writes the storage files """
+    return int(os.getenv("NDW_WORKER_ID", "0"))
+
+
+def is_primary() -> bool:
+    return worker_id() == 0
+
+
+def log_sampled(message: str):
+    """ logs the info message of a hot path with the probability `log_sample_rate` (see Config) """
+    if config().log_sample_rate >= 1 or random.random() < config().log_sample_rate:
+        logging.info(message)
+
+
 def to_dict(val: Optional[Any]) -> Union[Dict, List, str, None]:
     if val is None or isinstance(val, list) or isinstance(val, dict) or isinstance(val, str):
         return val
@@ -23,6 +23,11 @@ setuptools.setup(
         'setuptools~=58.3.0   ',
         'email-validator~=1.1.3'
     ],
+    extras_require={
+        "fast": ["orjson>=3.6", "msgpack>=1.0"],
+        "batch": ["numpy>=1.20"],
+        "test": ["pytest"]
+    },
     # url="<<< URL TO DOC WEBSITE OR GIT PROJECT >>>",
     packages=setuptools.find_packages(),
     classifiers=[
@@ -35,6 +40,7 @@ setuptools.setup(
         "console_scripts": [
             "ndw_chat_server=ndw_chat.main:cli",
             "ndw_chat_youtube=ndw_chat.youtube:cli",
+            "ndw_chat_scores=ndw_chat.batch_scoring:cli",
         ]
     }
 )
@@ -0,0 +1,54 @@
+import asyncio
+from pathlib import Path
+
+import pytest
+
+from ndw_chat import cache, db, executor, quiz, retention, sequences, util
+from ndw_chat.util import Config, TrackConfig
+
+
+def restart():
+    """ waits for the pending writes and drops the loaded data, like a restart of the server """
+    for writer in list(executor.storage_writers().values()):
+        writer.flush()
+    db._db = None
+    db._index = None
+    db._shards = None
+    quiz._quiz = None
+    quiz._quiz_index = None
+    quiz._quiz_state = None
+    quiz._engine = None
+    sequences._sequence_file = None
+    sequences._sequences.clear()
+    retention._archive = None
+    cache._cache = cache.ResponseCache()
+    from ndw_chat.main import admission
+    admission._limiters.clear()
+
+
+@pytest.fixture
+def home(tmp_path: Path, monkeypatch) -> Path:
+    """ empty NDW_HOME with the tracks room1 and room2 and without quiz """
+    monkeypatch.setenv("NDW_HOME", str(tmp_path))
+    restart()
+    util._config = Config(tracks=[TrackConfig("room1", ""), TrackConfig("room2", "")],
+                          check_email_deliverability=False)
+    yield tmp_path
+    restart()
+    util._config = None
+
+
+@pytest.fixture
+def serve(home: Path):
+    """ serve(test) runs the coroutine test(client) with an aiohttp test client of the server """
+    from aiohttp.test_utils import TestClient, TestServer
+    from ndw_chat.main import create_runner
+    from ndw_chat.startup import startup
+
+    async def run(test):
+        startup._ready = None
+        startup.set_ready()
+        async with TestClient(TestServer(create_runner().app)) as client:
+            return await test(client)
+
+    return lambda test: asyncio.run(run(test))
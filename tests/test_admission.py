@@ -0,0 +1,95 @@
+from ndw_chat import admission, quiz, util
+from ndw_chat.admission import Admission, RateLimiter, TokenBucket
+from ndw_chat.db import db
+
+
+def test_token_bucket():
+    bucket = TokenBucket(2, 3, now=0)
+    assert [bucket.take(0) for _ in range(3)] == [0, 0, 0]
+    assert bucket.take(0) == 0.5
+    assert bucket.take(0.5) == 0
+    # a batch takes its tokens if at least one is available and leaves the bucket in debt
+    assert bucket.take(1, count=5) == 0
+    assert bucket.tokens == -4
+    assert bucket.take(1) == 2.5
+    assert bucket.take(4) == 0
+    assert bucket.take(100) == 0 and bucket.tokens == 2
+
+
+def test_rate_limiter(monkeypatch):
+    monkeypatch.setattr(admission, "MAX_KEYS", 2)
+    limiter = RateLimiter(1, 1)
+    assert limiter.take("a", 0) == 0 and limiter.take("a", 0) == 1
+    limiter.take("b", 0)
+    limiter.take("a", 0)
+    limiter.take("c", 0)
+    assert list(limiter.buckets) == ["a", "c"]
+    assert all(RateLimiter(0, 0).take("a", 0) == 0 for _ in range(10))
+
+
+def test_shedding(home, monkeypatch):
+    frames = [0]
+    checker = Admission(lambda: frames[0])
+    assert checker.check("client", "a") is None
+    frames[0] = util.config().shed_queued_frames + 1
+    assert checker.check("client", "a") == ("overload", admission.OVERLOAD_RETRY_AFTER)
+    frames[0] = 0
+    monkeypatch.setattr(admission, "storage_pending", lambda: util.config().shed_storage_pending + 1)
+    assert checker.check("client", "a") == ("overload", admission.OVERLOAD_RETRY_AFTER)
+    monkeypatch.setattr(admission, "storage_pending", lambda: 0)
+    assert checker.check("client", "a") is None
+
+
+def create_quiz(users: int):
+    quiz.config().has_quiz = True
+    quiz._quiz = quiz.Quiz([quiz.QuizQuestion("room1", 1, "estimate", "units", 10, None, None, 0)])
+    for user in range(1, users + 1):
+        db("quiz_users").insert(quiz.QuizUser(user, f"user{user}", f"user{user}@example.com", 0).to_dict())
+    quiz.set_current_question("room1", 0)
+    quiz.enable_current_question("room1", True)
+
+
+def answer(client, user_id):
+    return client.get("/submit_quiz_answer", params={"user_id": str(user_id), "question_id": "0", "answer": "10"})
+
+
+def test_answers_are_limited_per_quiz_user(home, serve):
+    create_quiz(1)
+    util.config().quiz_user_rate_burst = 2
+
+    async def test(client):
+        responses = [await answer(client, 1) for _ in range(3)]
+        return [response.status for response in responses], responses[-1].headers.get("Retry-After")
+
+    statuses, retry_after = serve(test)
+    assert statuses == [200, 200, 429] and retry_after == "1"
+
+
+def test_answers_are_limited_per_address(home, serve):
+    create_quiz(5)
+    util.config().answer_client_rate_limit = 0.5
+    util.config().answer_client_rate_burst = 3
+
+    async def test(client):
+        responses = [await answer(client, user) for user in range(1, 6)]
+        return [response.status for response in responses], responses[-1].headers.get("Retry-After")
+
+    statuses, retry_after = serve(test)
+    assert statuses == [200, 200, 200, 429, 429] and retry_after == "2"
+    assert len(quiz.get_answers()) == 3
+
+
+def test_unknown_quiz_users_do_not_take_ingest_tokens(home, serve):
+    create_quiz(1)
+    util.config().ingest_rate_burst = 2
+    util.config().ingest_rate_limit = 0.001
+
+    async def test(client):
+        unknown = [(await answer(client, user)).status for user in range(100, 110)]
+        known = [(await answer(client, 1)).status for _ in range(3)]
+        return unknown, known
+
+    unknown, known = serve(test)
+    assert unknown == [200] * 10
+    assert known == [200, 200, 429]
+    assert len(quiz.get_answers()) == 1
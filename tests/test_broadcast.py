@@ -0,0 +1,37 @@
+import asyncio
+
+import pytest
+
+from ndw_chat import executor, quiz, serialization, util
+from ndw_chat.broadcast import ScoreBroadcaster
+from ndw_chat.serialization import loads
+
+
+@pytest.mark.parametrize("cpu_pool", ["thread", "process"])
+def test_score_frames_are_encoded_in_the_cpu_pool(home, cpu_pool: str):
+    util.config().cpu_pool = cpu_pool
+    executor._cpu_pool = None
+    user = quiz.QuizUser(1, "user1", "user1@example.com", 0)
+    scores = [quiz.QuizUserScores([], {}, {}), quiz.QuizUserScores([quiz.QuizUserScore(user, 1.0)], {0: 1}, {})]
+    protocols = ["json", "msgpack"] if serialization.msgpack else ["json"]
+    sent = []
+
+    async def send(frame):
+        # the frame arrives encoded for the protocols of the subscribers
+        sent.append({protocol: frame._encoded.get(protocol) for protocol in protocols})
+
+    async def test():
+        broadcaster = ScoreBroadcaster(lambda: scores[-1], send, lambda: protocols)
+        broadcaster.snapshot = {**scores[0].to_dict(), "version": 0}
+        broadcaster.schedule()
+        await broadcaster._task
+
+    try:
+        asyncio.run(test())
+    finally:
+        executor._cpu_pool.shutdown()
+        executor._cpu_pool = None
+    assert all(encoded is not None for encoded in sent[0].values())
+    delta = loads(sent[0]["json"])
+    assert delta["command"] == "scores_delta"
+    assert delta["arguments"]["ranks"] == {"0": {"user_id": 1, "score": 1.0}}
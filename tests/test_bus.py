@@ -0,0 +1,64 @@
+import asyncio
+import socket
+
+from ndw_chat.bus import LocalBus, RespBus, run_stand_in_server
+
+
+async def wait_for(condition, timeout: float = 5):
+    for _ in range(int(timeout / 0.01)):
+        if condition():
+            return
+        await asyncio.sleep(0.01)
+    raise TimeoutError()
+
+
+def test_local_bus_resends_missed_messages(home):
+    async def run():
+        received = []
+        receiver = LocalBus(0, lambda message: received.append(message["n"]))
+        sender = LocalBus(1, lambda message: None)
+        await receiver.start()
+        await sender.start()
+        try:
+            sender.publish({"type": "test", "n": 1})
+            send, sender._send = sender._send, lambda message: None
+            sender.publish({"type": "test", "n": 2})  # lost
+            sender._send = send
+            sender.publish({"type": "test", "n": 3})
+            sender._send(sender._history[0])  # duplicate
+            await wait_for(lambda: len(received) == 3)
+            await asyncio.sleep(0.05)
+            return received
+        finally:
+            await receiver.close()
+            await sender.close()
+
+    assert asyncio.run(run()) == [1, 2, 3]
+
+
+def test_resp_bus_publishes_again_after_a_lost_connection(home):
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+
+    async def run():
+        server = await run_stand_in_server("127.0.0.1", port)
+        received = []
+        receiver = RespBus(0, lambda message: received.append(message["n"]), "127.0.0.1", port)
+        sender = RespBus(1, lambda message: None, "127.0.0.1", port)
+        await receiver.start()
+        await sender.start()
+        try:
+            sender.publish({"type": "test", "n": 1})
+            await wait_for(lambda: received == [1])
+            sender._writer.close()
+            sender.publish({"type": "test", "n": 2})
+            await wait_for(lambda: len(received) == 2)
+            await asyncio.sleep(0.1)
+            return received
+        finally:
+            await receiver.close()
+            await sender.close()
+            server.close()
+
+    assert asyncio.run(run()) == [1, 2]
@@ -0,0 +1,115 @@
+import asyncio
+
+from ndw_chat import db, quiz
+from ndw_chat.cache import response_cache, invalidate
+
+
+def cached_paths() -> set:
+    return {path for path, _ in response_cache().entries}
+
+
+def create_quiz():
+    quiz.config().has_quiz = True
+    quiz.config().tracks = quiz.config().tracks[:1]
+    quiz._quiz = quiz.Quiz([quiz.QuizQuestion("room1", 1, "estimate", "units", 10, None, None, 0)])
+    for user in [1, 2]:
+        db.db("quiz_users").insert(quiz.QuizUser(user, f"user{user}", f"user{user}@example.com", 0).to_dict())
+    quiz.set_current_question("room1", 0)
+    quiz.enable_current_question("room1", True)
+
+
+async def messages(client) -> list:
+    response = await client.get("/messages", params={"password": "test", "since": "0"})
+    return [(msg["content"], msg["state"]) for msg in (await response.json())["messages"]]
+
+
+async def scores(client) -> list:
+    response = await client.get("/scores", params={"password": "test"})
+    return [(score["user"]["id"], score["score"]) for score in (await response.json())["scores"]]
+
+
+def test_messages_are_invalidated(home, serve):
+    async def test(client):
+        assert await messages(client) == []
+        assert cached_paths() == {"/messages"}
+        msg = db.add_message("room1", "first")
+        assert cached_paths() == set()
+        assert await messages(client) == [("first", db.RAW)]
+        db.set_state(msg.id, db.VISIBLE)
+        assert await messages(client) == [("first", db.VISIBLE)]
+        # a message of another worker
+        db.apply_remote_record({"table": "messages", "op": "insert", "ids": [1001],
+                                "docs": [db.Message(7, "room2", db.RAW, 1.0, "remote").to_dict()]})
+        assert await messages(client) == [("first", db.VISIBLE), ("remote", db.RAW)]
+
+    serve(test)
+
+
+def test_scores_are_invalidated(home, serve):
+    create_quiz()
+
+    async def test(client):
+        assert await scores(client) == []
+        quiz.add_answer(1, 0, "10")
+        assert await scores(client) == [(1, 1.0)]
+        await client.get("/my_rank", params={"user_id": "1"})
+        assert cached_paths() == {"/scores", "/my_rank"}
+        assert await quiz.register_user("user3", "user3@example.com") == 3
+        assert cached_paths() == set()
+        # an answer of another worker
+        await scores(client)
+        doc_id = db.db("quiz_answers").insert(quiz.QuizAnswer(question=0, user=2, answer="5", time=1.0).to_dict())
+        quiz.apply_remote_record({"table": "quiz_answers", "op": "insert", "ids": [doc_id]}, [])
+        assert await scores(client) == [(1, 1.0), (2, 2 / 3)]
+        # the rebuilt engine replaces the cached scores of the previous one
+        db.db("quiz_answers").remove(doc_ids=[doc_id])
+        quiz.quiz_index().remove_answer(2, 0)
+        quiz.rebuild_scoring_engine()
+        assert cached_paths() == {"/scores"}
+        while quiz._engine_pending is not None:
+            await asyncio.sleep(0.01)
+        assert await scores(client) == [(1, 1.0)]
+
+    serve(test)
+
+
+def test_responses_computed_during_an_invalidation_are_not_cached(home, serve, monkeypatch):
+    calls = []
+
+    def current_question_dict(track: str) -> dict:
+        calls.append(track)
+        if len(calls) == 1:
+            # the question changes while the response is computed
+            invalidate("current_question")
+        return {"current": None, "next": None, "prev": None, "current_enabled": False}
+
+    monkeypatch.setattr(quiz, "current_question_dict", current_question_dict)
+
+    async def test(client):
+        for _ in range(3):
+            response = await client.get("/current_question", params={"track": "room1"})
+            assert response.status == 200
+
+    serve(test)
+    assert len(calls) == 2
+
+
+def test_not_modified_and_gzip(home, serve):
+    db.add_messages([("room1", f"message {i}", None) for i in range(50)])
+
+    async def test(client):
+        params = {"password": "test", "since": "0"}
+        response = await client.get("/messages", params=params, headers={"Accept-Encoding": "gzip"})
+        # the client decompresses the body
+        assert response.headers["Content-Encoding"] == "gzip"
+        body = await response.read()
+        etag = response.headers["ETag"]
+        plain = await client.get("/messages", params=params, headers={"Accept-Encoding": "identity"})
+        assert "Content-Encoding" not in plain.headers and await plain.read() == body
+        not_modified = await client.get("/messages", params=params, headers={"If-None-Match": etag})
+        assert not_modified.status == 304 and not_modified.headers["ETag"] == etag
+        db.add_message("room1", "changed")
+        changed = await client.get("/messages", params=params, headers={"If-None-Match": etag})
+        assert changed.status == 200 and changed.headers["ETag"] != etag
+
+    serve(test)
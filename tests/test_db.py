@@ -0,0 +1,101 @@
+import threading
+
+import pytest
+
+from conftest import restart
+from ndw_chat import db
+from ndw_chat.executor import storage_writer
+from ndw_chat.retention import archive
+from ndw_chat.util import config
+
+
+def test_version_survives_deleting_the_latest_message(home):
+    first, second = db.add_messages([("room1", "first", None), ("room2", "second", None)])
+    db.set_state(first.id, db.VISIBLE)
+    version = db.messages_version()
+    shard = db.message_shards("room1")[0]
+    shard.table.remove(doc_ids=[shard.index.doc_ids[first.id]])
+    shard.index.remove(first.id)
+    restart()
+    assert db.messages_version() >= version
+    db.set_state(second.id, db.VISIBLE)
+    assert db.get_message(second.id).version > version
+    assert db.get_changed_messages(version)[0] == [db.get_message(second.id)]
+
+
+def test_shard_archives_in_its_writer(home):
+    config().shard_tracks = True
+    config().archive_after_minutes = 0
+    msg = db.add_message("room1", "archived")
+    db.set_state(msg.id, db.ARCHIVED)
+    # the default writer is blocked, the archive write has to be ordered before the removal in the shard writer
+    release = threading.Event()
+    storage_writer().submit(release.wait)
+    try:
+        db.delete_old_messages()
+        storage_writer("messages.room1").flush()
+        assert [doc["id"] for doc in archive().query("messages")] == [msg.id]
+    finally:
+        release.set()
+    assert db.get_message(msg.id) is None
+
+
+def test_archive_time_survives_a_restart(home):
+    first, second = db.add_messages([("room1", "first", None), ("room1", "second", None)])
+    db.set_state(second.id, db.ARCHIVED)
+    db.set_state(first.id, db.ARCHIVED)
+    db.set_content(second.id, "second, edited")
+    archived_at = dict(db.index().archived_at)
+    # the second message is archived first, but loaded (ordered by version) after the first one
+    restart()
+    assert list(db.index().archived_at) == [first.id, second.id]
+    assert db.index().archived() == archived_at
+    assert list(db.index().archived()) == [second.id, first.id]
+    config().archive_after_minutes = 1
+    db.delete_old_messages()
+    assert len(db.get_messages()) == 2
+
+
+def index_state() -> dict:
+    """ the messages of the indexes by id, track, state, external id and version order """
+    shard_indexes = [shard.index for shard in db.message_shards()]
+    for shard in db.message_shards():
+        # the index matches its table
+        assert {shard.index.doc_ids[id]: msg.to_dict() for id, msg in shard.index.by_id.items()} == \
+               {doc.doc_id: dict(doc) for doc in shard.table}
+    return {"messages": [msg.to_dict() for msg in db.get_messages()],
+            "tracks": {track: [msg.id for msg in db.get_messages(track)] for track in ["room1", "room2"]},
+            "states": {state: [msg.id for msg in db.get_messages(state=state)]
+                       for state in [db.RAW, db.VISIBLE, db.ARCHIVED]},
+            "external_ids": {key: msg.id for index in shard_indexes for key, msg in index.by_external_id.items()},
+            "changes": [msg.id for msg in db.get_changed_messages(0)[0]]}
+
+
+@pytest.mark.parametrize("shard_tracks", [False, True])
+def test_index_is_consistent_after_a_restart(home, shard_tracks: bool):
+    config().shard_tracks = shard_tracks
+    msgs = db.add_messages([("room1", "one", None), ("room2", "two", "yt-2"), ("room1", "three", "yt-3"),
+                            ("room2", "four", None)])
+    db.set_state(msgs[2].id, db.VISIBLE)
+    db.set_content(msgs[0].id, "one, edited")
+    db.set_state(msgs[1].id, db.ARCHIVED)
+    shard = db.message_shards("room2")[0]
+    shard.table.remove(doc_ids=[shard.index.doc_ids[msgs[3].id]])
+    shard.index.remove(msgs[3].id)
+    db.add_message("room2", "five")
+    before = index_state()
+    restart()
+    assert index_state() == before
+
+
+def test_remote_messages_get_local_versions(home):
+    local = db.add_message("room1", "local")
+    record = {"table": "messages", "op": "insert", "ids": [1001],
+              "docs": [db.Message(7, "room2", db.RAW, 1.0, "remote", 5000).to_dict()]}
+    db.apply_remote_record(record)
+    db.apply_remote_record({"table": "messages", "op": "update", "ids": [1001],
+                            "fields": {"state": db.VISIBLE, "version": 5001}})
+    remote = db.get_message(7)
+    assert local.version < remote.version < 5000 and remote.state == db.VISIBLE
+    assert db.get_changed_messages(local.version)[0] == [remote]
+    assert dict(db.db("messages").get(doc_id=1001)) == remote.to_dict()
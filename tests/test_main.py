@@ -0,0 +1,78 @@
+from ndw_chat import db, util
+
+
+def test_changed_messages_limit(home, serve):
+    db.add_messages([("room1", "first", None), ("room1", "second", None)])
+
+    async def test(client):
+        results = []
+        for limit in ["0", "-1", "1"]:
+            response = await client.get("/messages", params={"password": "test", "since": "0", "limit": limit})
+            assert response.status == 200
+            results.append(await response.json())
+        return results
+
+    for result in serve(test):
+        assert [msg["content"] for msg in result["messages"]] == ["first"]
+        assert result["more"]
+
+
+def test_batch_with_malformed_items(home, serve):
+    items = [{"track": "room1", "content": "valid"}, {"track": "room1"}, {"track": "room1", "content": 5},
+             "message", {"track": "room1", "content": "list id", "external_id": ["x"]},
+             {"track": "room3", "content": "unknown track"}, {"track": "room2", "content": "with id", "external_id": "a"}]
+
+    async def test(client):
+        response = await client.post("/send_batch", json={"messages": items})
+        assert response.status == 200
+        return (await response.json())["results"]
+
+    results = serve(test)
+    assert [result.get("error") for result in results] == [None, "invalid", "invalid", "invalid", "invalid",
+                                                            "unknown_track", None]
+    assert [msg.content for msg in db.get_messages()] == ["valid", "with id"]
+
+
+def test_changed_messages_of_another_epoch(home, serve):
+    db.add_messages([("room1", "first", None), ("room1", "second", None)])
+    version = db.messages_version()
+
+    async def get(client, **params):
+        response = await client.get("/messages", params={"password": "test", "since": str(version), **params})
+        return await response.json()
+
+    async def test(client):
+        return await get(client, epoch=db.messages_epoch()), await get(client, epoch="1-other")
+
+    same, other = serve(test)
+    assert same["messages"] == [] and not same["resync"]
+    assert [msg["content"] for msg in other["messages"]] == ["first", "second"]
+    assert other["resync"] and other["epoch"] == db.messages_epoch() == "0"
+
+
+def test_batch_size_is_limited(home, serve):
+    util.config().max_batch_size = 3
+    messages = [{"track": "room1", "content": str(i)} for i in range(4)]
+
+    async def test(client):
+        response = await client.post("/send_batch", json={"messages": messages})
+        return response.status
+
+    assert serve(test) == 413
+    assert db.get_messages() == []
+
+
+def test_batch_takes_a_token_per_message(home, serve):
+    util.config().client_rate_limit = 1
+    util.config().client_rate_burst = 10
+    messages = [{"track": "room1", "content": f"message {i}"} for i in range(8)]
+
+    async def test(client):
+        first = await client.post("/send_batch", json={"messages": messages})
+        second = await client.post("/send_batch", json={"messages": messages})
+        third = await client.post("/send_batch", json={"messages": messages})
+        return first.status, second.status, third.status, third.headers.get("Retry-After")
+
+    first, second, third, retry_after = serve(test)
+    assert (first, second, third) == (200, 200, 429) and int(retry_after) >= 1
+    assert len(db.get_messages()) == 16
@@ -0,0 +1,98 @@
+import asyncio
+import time
+
+from ndw_chat import quiz
+from ndw_chat.db import db, apply_remote_record
+from ndw_chat.main import _viewer_question
+
+
+def test_viewer_endpoints_without_quiz(home, serve):
+    async def test(client):
+        response = await client.get("/unanswered_question", params={"track": "room1", "user_id": "1"})
+        assert response.status == 200
+        assert (await response.json())["question"] is None
+
+    serve(test)
+    assert _viewer_question("room1") is None
+    assert not quiz.quiz_file().exists()
+
+
+def test_quiz_without_quiz_file(home):
+    quiz.config().has_quiz = True
+    assert quiz.quiz().questions == []
+    assert not quiz.is_current_question_enabled("room1")
+    assert not quiz.quiz_file().exists()
+
+
+def create_quiz(users: int):
+    """ an estimation question (solution 10) as the enabled current question of room1 """
+    quiz.config().has_quiz = True
+    quiz._quiz = quiz.Quiz([quiz.QuizQuestion("room1", 1, "estimate", "units", 10, None, None, 0)])
+    for user in range(1, users + 1):
+        db("quiz_users").insert(quiz.QuizUser(user, f"user{user}", f"user{user}@example.com", 0).to_dict())
+    quiz.set_current_question("room1", 0)
+    quiz.enable_current_question("room1", True)
+
+
+def test_engine_rebuild_in_background(home):
+    create_quiz(4)
+    quiz.add_answer(1, 0, "10")
+    quiz.add_answer(2, 0, "5")
+    rebuilt = []
+    quiz.set_engine_listener(lambda: rebuilt.append(True))
+
+    async def rebuild():
+        previous = quiz.scoring_engine()
+        quiz.rebuild_scoring_engine()
+        # answers while the engine is rebuilt are added to the previous and the new engine
+        assert quiz.scoring_engine() is previous
+        quiz.add_answer(3, 0, "9")
+        # the ids of the other workers are lower than the ids of earlier local answers
+        record = {"table": "quiz_answers", "op": "insert", "ids": [0],
+                  "docs": [quiz.QuizAnswer("1", 0, 4, 1.0).to_dict()]}
+        quiz.apply_remote_record(record, apply_remote_record(record))
+        while quiz._engine is previous:
+            await asyncio.sleep(0.01)
+
+    try:
+        asyncio.run(rebuild())
+    finally:
+        quiz.set_engine_listener(None)
+    assert rebuilt
+    assert quiz.user_scores().to_dict() == quiz.recompute_user_scores().to_dict()
+    assert [score.user.id for score in quiz.user_scores().scores] == [1, 3, 2, 4]
+    assert quiz.user_scores().count == {0: 4}
+
+
+def test_primary_removes_answers_of_other_workers_to_answered_questions(home):
+    create_quiz(1)
+    quiz.add_answer(1, 0, "10")
+    doc = quiz.QuizAnswer("9", 0, 1, 1.0).to_dict()
+    record = {"table": "quiz_answers", "op": "insert", "ids": [1001], "docs": [doc]}
+    quiz.apply_remote_record(record, apply_remote_record(record))
+    assert [answer.answer for answer in quiz.get_answers()] == ["10"]
+    assert quiz.quiz_index().answered == {(1, 0): 1}
+    assert quiz.user_scores().to_dict() == quiz.recompute_user_scores().to_dict()
+
+
+def test_answer_index_counts_duplicates():
+    index = quiz.QuizIndex()
+    answer = quiz.QuizAnswer("9", 0, 1, 1.0)
+    index.add_answer(answer)
+    index.add_answer(answer)
+    index.remove_answer(1, 0)
+    assert (1, 0) in index.answered
+    index.remove_answer(1, 0)
+    assert (1, 0) not in index.answered
+
+
+def test_expired_users_and_answers_are_removed(home):
+    create_quiz(2)
+    db("quiz_answers").insert(quiz.QuizAnswer(question=0, user=1, answer="10", time=0).to_dict())
+    db("quiz_users").insert(quiz.QuizUser(3, "user3", "user3@example.com", time.time()).to_dict())
+    quiz.add_answer(3, 0, "5")
+    assert quiz.answered(1, 0)
+    quiz.delete_old_users_and_answers()
+    assert [user.id for user in quiz.get_registered_users()] == [3]
+    assert [(answer.user, answer.answer) for answer in quiz.get_answers()] == [(3, "5")]
+    assert not quiz.answered(1, 0) and quiz.get_user(1) is None
@@ -0,0 +1,95 @@
+import io
+import math
+import random
+
+import pytest
+
+from ndw_chat import quiz, util
+from ndw_chat.batch_scoring import batch_user_scores, write_csv
+from ndw_chat.db import db
+from ndw_chat.scoring import parse_float, Leaderboard
+
+
+def test_parse_float():
+    assert parse_float("2.5") == 2.5
+    assert parse_float("inf") == math.inf
+    assert parse_float("x") == -math.inf
+    # NaN can't be ranked by its distance to the solution, so it ranks like an invalid answer
+    assert parse_float("nan") == -math.inf
+    assert parse_float("-NaN") == -math.inf
+
+
+def test_leaderboard():
+    leaderboard = Leaderboard()
+    for user in [1, 2, 3]:
+        leaderboard.set(user, 0)
+    leaderboard.set(3, 2)
+    leaderboard.update({1: 1, 2: 1})
+    assert leaderboard.range() == [(3, 2), (1, 1), (2, 1)]
+    assert leaderboard.range(1, 1) == [(1, 1)]
+    assert leaderboard.rank(2) == (2, 1)
+    assert leaderboard.rank(4) is None
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_engine_matches_recomputation(home, seed: int):
+    """
+    the engine equals quiz.recompute_user_scores after every answer of a random quiz, the batch scores
+    are compared every 20 answers and after a track with answers has been removed from the config
+    """
+    rand = random.Random(seed)
+    util.config().tracks = [util.TrackConfig(f"room{i}", "") for i in range(rand.randint(1, 3))]
+    util.config().has_quiz = True
+    questions = []
+    tracks = util.config().tracks
+    util.config().tracks = tracks + [util.TrackConfig("removed", "")]
+    for slot in range(1, rand.randint(2, 4)):
+        for track in util.config().tracks:
+            if rand.random() < 0.5:
+                questions.append(quiz.QuizQuestion(track.name, slot, "e", "unit", rand.choice([0, 10, 2.5]),
+                                                   None, None, len(questions)))
+            else:
+                questions.append(quiz.QuizQuestion(track.name, slot, "c", None, None, ["A", "B"], "A",
+                                                   len(questions)))
+    quiz._quiz = quiz.Quiz(questions)
+    users = list(range(1, rand.randint(2, 40)))
+    for user in users:
+        db("quiz_users").insert(quiz.QuizUser(user, f"user{user}", f"{user}@example.com", 0).to_dict())
+    for i in range(300):
+        question = rand.choice(questions)
+        quiz.set_current_question(question.track, question.id)
+        quiz.enable_current_question(question.track, True)
+        if question.estimation:
+            answer = rand.choice(["0", "1", "5", "7.5", "10", "12.5", "15", "20", "x", "inf", "nan"])
+        else:
+            answer = rand.choice(question.choice)
+        if rand.random() < 0.05:
+            # rebuilt from the stored answers on the next use
+            quiz._engine = None
+        if quiz.add_answer(rand.choice(users), question.id, answer):
+            assert quiz.user_scores().to_dict() == quiz.recompute_user_scores().to_dict()
+        if i % 20 == 19:
+            assert batch_user_scores().to_dict() == quiz.recompute_user_scores().to_dict()
+    util.config().tracks = tracks
+    quiz._engine = None
+    assert batch_user_scores().to_dict() == quiz.user_scores().to_dict() == quiz.recompute_user_scores().to_dict()
+
+
+def test_csv_of_deleted_users(home):
+    util.config().has_quiz = True
+    quiz._quiz = quiz.Quiz([quiz.QuizQuestion("room1", 1, "c", None, None, ["A", "B"], "A", 0)])
+    quiz.set_current_question("room1", 0)
+    quiz.enable_current_question("room1", True)
+    for user in [1, 2]:
+        db("quiz_users").insert(quiz.QuizUser(user, f"user{user}", f"{user}@example.com", 0).to_dict())
+    quiz.add_answer(2, 0, "A")
+    quiz.add_answer(1, 0, "B")
+    # the answers of a deleted user still count in the batch scores
+    db("quiz_users").remove(doc_ids=[db("quiz_users").get(lambda doc: doc["id"] == 2).doc_id])
+    quiz.quiz_index().remove_user(2)
+    scores = batch_user_scores()
+    assert scores.to_dict() == quiz.recompute_user_scores().to_dict()
+    file = io.StringIO()
+    write_csv(scores, file)
+    assert file.getvalue().splitlines() == ["rank,user_id,pseudonym,email,score", "1,,,,0.5",
+                                            "2,1,user1,1@example.com,0.0"]
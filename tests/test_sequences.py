@@ -0,0 +1,19 @@
+from ndw_chat.sequences import SequenceFile, Sequence
+
+
+def test_next_block_is_leased_in_the_background(home):
+    file = SequenceFile(home / "sequences.json")
+    seq = Sequence(file, "test", lambda: 5, 10)
+    ids = seq.allocate(6)
+    assert ids == list(range(5, 11))
+    seq._prefetched.result()
+    lease = file.lease
+    file.lease = None  # the following blocks come from the prefetched leases
+    ids += seq.allocate(4) + seq.allocate(1)
+    file.lease = lease
+    assert ids == list(range(5, 16))
+    # more than the rest of the block: the rest is skipped
+    ids += seq.allocate(25)
+    assert ids[-25:] == list(range(25, 50))
+    restarted = Sequence(SequenceFile(home / "sequences.json"), "test", lambda: 0, 10)
+    assert restarted.next() > ids[-1]
@@ -0,0 +1,71 @@
+import json
+
+from ndw_chat.storage import JournalDatabase
+
+
+def reopen(folder, **kwargs) -> JournalDatabase:
+    database = JournalDatabase(folder, **kwargs)
+    database.writer.flush()
+    return database
+
+
+def test_replay_drops_a_torn_trailing_record(tmp_path):
+    database = JournalDatabase(tmp_path)
+    database.table("messages").insert({"content": "first"})
+    database.table("messages").insert({"content": "second"})
+    database.writer.flush()
+    journal = tmp_path / "db.journal"
+    complete = journal.read_bytes()
+    journal.write_bytes(complete + b'{"table": "messages", "op": "ins')
+    database = reopen(tmp_path)
+    assert [doc["content"] for doc in database.table("messages")] == ["first", "second"]
+    assert journal.read_bytes() == complete
+    # records after the truncation are replayed after the next restart
+    database.table("messages").insert({"content": "third"})
+    database.writer.flush()
+    assert [doc["content"] for doc in reopen(tmp_path).table("messages")] == ["first", "second", "third"]
+
+
+def test_migrates_db_json(tmp_path):
+    legacy = tmp_path / "db.json"
+    legacy.write_text(json.dumps({"messages": {"1": {"content": "old"}, "3": {"content": "older"}},
+                                  "host_messages": {}}))
+    database = reopen(tmp_path, legacy_file=legacy)
+    messages = database.table("messages")
+    assert {doc.doc_id: doc["content"] for doc in messages} == {1: "old", 3: "older"}
+    assert messages.insert({"content": "new"}) == 4
+    database.writer.flush()
+    assert (tmp_path / "db.snapshot.json").exists()
+    # the snapshot is used from now on, db.json is not read again
+    legacy.write_text(json.dumps({"messages": {}}))
+    assert [doc["content"] for doc in reopen(tmp_path, legacy_file=legacy).table("messages")] == ["old", "older", "new"]
+
+
+def test_replays_the_journal_on_top_of_the_snapshot(tmp_path):
+    database = JournalDatabase(tmp_path)
+    messages = database.table("messages")
+    first = messages.insert({"content": "first", "state": "raw"})
+    second = messages.insert({"content": "second", "state": "raw"})
+    database.compact().result()
+    messages.update({"state": "visible"}, doc_ids=[first])
+    messages.remove(doc_ids=[second])
+    third = messages.insert({"content": "third", "state": "raw"})
+    database.writer.flush()
+    assert json.loads((tmp_path / "db.snapshot.json").read_text())["messages"].keys() == {str(first), str(second)}
+    restored = reopen(tmp_path).table("messages")
+    assert {doc.doc_id: (doc["content"], doc["state"]) for doc in restored} == \
+           {first: ("first", "visible"), third: ("third", "raw")}
+
+
+def test_replay_drops_a_record_without_newline(tmp_path):
+    database = JournalDatabase(tmp_path)
+    for i in [1, 2]:
+        database.table("messages").insert({"n": i})
+    database.writer.flush()
+    journal = tmp_path / "db.journal"
+    journal.write_bytes(journal.read_bytes()[:-1])
+    database = reopen(tmp_path)
+    for i in [3, 4]:
+        database.table("messages").insert({"n": i})
+    database.writer.flush()
+    assert [doc["n"] for doc in reopen(tmp_path).table("messages")] == [1, 3, 4]
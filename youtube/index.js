@@ -4,14 +4,29 @@ import request from "request";
 
 import YouTube from "./youtube.js";
 
-function push(track, content) {
+const batch_server = server.replace(/\/send$/, "/send_batch");
+/** the server rejects larger batches (max_batch_size in its config) */
+const max_batch_size = 2000;
+
+let pending = [];
+
+/** sends all messages of the current poll in one request, the YouTube message ids are used to skip duplicates */
+function push(track, content, external_id) {
+    if (pending.length === 0) {
+        setTimeout(flush, 0);
+    }
+    pending.push({track: track, content: content, external_id: external_id});
+}
+
+function flush() {
+    const messages = pending.splice(0, max_batch_size);
+    if (pending.length > 0) {
+        setTimeout(flush, 0);
+    }
     request.post({
         headers: {'content-type': 'application/json'},
-        url: server,
-        body: JSON.stringify({
-            track: track,
-            content: content
-        })
+        url: batch_server,
+        body: JSON.stringify({messages: messages})
     }, function (error, response, body) {
         // console.log(body);
     });
@@ -30,7 +45,7 @@ for (let track in video_per_track) {
         const publishedAt = Date.parse(data.snippet.publishedAt).valueOf();
         if (publishedAt >= startTime) {
             console.info(`Got messages '${message}' in track ${track}`)
-            push(track, message);
+            push(track, message, data.id);
         }
     })
 